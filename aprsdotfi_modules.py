@@ -18,10 +18,14 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-import requests
 from datetime import datetime
 import logging
-from utility_modules import read_program_config
+import threading
+from utility_modules import read_program_config, read_config_section
+from http_modules import get_http_session
+from cache_modules import ExpiringCache, SingleFlight
+from tracing_modules import trace_span
+from record_modules import AprsfiPosition
 
 #
 # Default user agent for accessing aprs.fi, openstreetmap et al
@@ -32,6 +36,325 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Default settings for the optional 'aprsdotfi_cache' config file section
+# max_entries: max number of cached position reports
+# beacon_interval: expected number of seconds between two position
+# reports of a radiosonde. A cached position expires once the sonde's
+# next report is due (based on the report's 'lasttime')
+# min_ttl / max_ttl: lower / upper limit for an entry's lifetime
+# stale_after: number of seconds after which a sonde without new
+# position reports is considered to be silent (e.g. landed); its last
+# position gets cached for max_ttl seconds
+aprsfi_cache_defaults = {
+    "max_entries": 1000,
+    "beacon_interval": 15.0,
+    "min_ttl": 5.0,
+    "max_ttl": 300.0,
+    "stale_after": 600.0,
+}
+
+aprsfi_cache = None
+aprsfi_cache_config = None
+aprsfi_cache_lock = threading.Lock()
+
+# Concurrent queries for the same target share one aprs.fi request
+aprsfi_flights = SingleFlight(name="aprsfi")
+
+
+def get_aprsfi_cache():
+    """
+    Returns the aprs.fi position cache. The cache gets created on
+    first use, based on the 'aprsdotfi_cache' config file section
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    aprsfi_cache: 'ExpiringCache'
+        aprs.fi position cache
+    """
+
+    global aprsfi_cache, aprsfi_cache_config
+
+    with aprsfi_cache_lock:
+        if aprsfi_cache is None:
+            aprsfi_cache_config = read_config_section(
+                section_name="aprsdotfi_cache", defaults=aprsfi_cache_defaults
+            )
+            aprsfi_cache = ExpiringCache(
+                name="aprsdotfi",
+                max_entries=aprsfi_cache_config["max_entries"],
+                default_ttl=aprsfi_cache_config["min_ttl"],
+            )
+    return aprsfi_cache
+
+
+def get_aprsfi_cache_ttl(success: bool, lasttime: datetime):
+    """
+    Determines how long an aprs.fi position report can be cached.
+    A position stays valid until the sonde's next report is due.
+
+    Parameters
+    ==========
+    success: 'bool'
+        True if aprs.fi did provide a position
+    lasttime: 'datetime'
+        the time when the target last reported its position
+
+    Returns
+    =======
+    ttl: 'float'
+        time-to-live in seconds
+    """
+
+    get_aprsfi_cache()
+    min_ttl = aprsfi_cache_config["min_ttl"]
+    max_ttl = aprsfi_cache_config["max_ttl"]
+
+    if not success or lasttime == datetime.min:
+        return min_ttl
+
+    age = (datetime.utcnow() - lasttime).total_seconds()
+    if age < aprsfi_cache_config["beacon_interval"]:
+        # next position report is due in the future
+        ttl = aprsfi_cache_config["beacon_interval"] - age
+    elif age > aprsfi_cache_config["stale_after"]:
+        # the sonde has gone silent; its position is unlikely to change
+        ttl = max_ttl
+    else:
+        # next position report is overdue and may arrive at any time
+        ttl = min_ttl
+    return min(max_ttl, max(min_ttl, ttl))
+
+
+def get_aprsfi_cache_statistics():
+    """
+    Returns the hit/miss statistics of the aprs.fi position cache
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    statistics: 'dict'
+        see ExpiringCache.get_statistics()
+    """
+
+    return get_aprsfi_cache().get_statistics()
+
+
+def parse_aprsfi_response(json_content: dict, aprs_target_type: str = ""):
+    """
+    Extracts the position from an aprs.fi 'loc' API response
+    Only the very first entry of the response is used.
+
+    Parameters
+    ==========
+    json_content: 'dict'
+        decoded JSON response from aprs.fi
+    aprs_target_type: 'str'
+        APRS target type (see get_position_on_aprsfi). If set, the
+        entry is listed as 'not found' if aprs.fi's target type differs
+
+    Returns
+    =======
+    position: 'AprsfiPosition'
+        see get_aprsfi_report(); callsign is always None
+    """
+
+    success = False
+    latitude = longitude = altitude = 0.0
+    comment = course = speed = None
+
+    lasttime = (
+        datetime.min
+    )  # placeholder value in case we can't determine the aprs.fi 'lasttime' information
+    result = "fail"
+    found = 0  # number of entries found in aprs.fi request (if any)
+
+    # extract web service result. Can either be 'ok' or 'fail'
+    if "result" in json_content:
+        result = json_content["result"]
+    if result == "ok":
+        # extract number of result sets in the response. Must be > 0
+        # regardless of the available number of results, we will only
+        # use the first result
+        if "found" in json_content:
+            found = json_content["found"]
+        if found > 0:
+            # We extract only the very first entry and disregard
+            # entries 2..n whereas ever present
+            # now extract lat/lon/altitude/lasttime
+            entry = json_content["entries"][0]
+
+            # Check if lat/lon are present; this is the essential information that we need to continue
+            if "lat" not in entry and "lng" in entry:
+                success = False
+            else:
+                success = True
+                try:
+                    latitude = float(entry["lat"])
+                    longitude = float(entry["lng"])
+                except ValueError:
+                    latitude = longitude = 0
+                    success = False
+            # Check if the user has asked us for a specific target type
+            if success and aprs_target_type != "":
+                if "type" in entry:
+                    aprsfi_type = entry["type"]
+                    if aprs_target_type != aprsfi_type:
+                        latitude = longitude = 0
+                        success = False
+            # Now check for our optional fields
+            if success and "altitude" in entry:
+                try:
+                    altitude = float(entry["altitude"])
+                except ValueError:
+                    altitude = 0.0
+            if success and "lasttime" in entry:
+                try:
+                    _mylast = float(entry["lasttime"])
+                    lasttime = datetime.utcfromtimestamp(_mylast)
+                except ValueError:
+                    lasttime = datetime.min
+            if success and "comment" in entry:
+                comment = entry["comment"]
+            if success and "course" in entry and "speed" in entry:
+                try:
+                    course = float(entry["course"])
+                    speed = float(entry["speed"])
+                except ValueError:
+                    course = speed = None
+
+    return AprsfiPosition(
+        success=success,
+        latitude=latitude,
+        longitude=longitude,
+        altitude=altitude,
+        lasttime=lasttime,
+        comment=comment,
+        callsign=None,
+        course=course,
+        speed=speed,
+    )
+
+
+def get_aprsfi_report(
+    aprsfi_callsign: str, aprsdotfi_api_key: str, aprs_target_type: str = ""
+):
+    """
+    Get the position report of the given call sign on aprs.fi,
+    including the target's course and speed (if present).
+    Call sign is taken 'as is', e.g. with or without SSID.
+
+    If a query for the user's call sign returns more than one position,
+    then only the very first call sign position on aprs.fi
+    is used by the program.
+
+    Parameters
+    ==========
+    aprsfi_callsign: 'str'
+        Call sign that we want to get the lat/lon coordinates for
+    aprsdotfi_api_key: 'str'
+        aprs.fi api access key
+    aprs_target_type: 'str'
+        APRS target type (a for AIS, l for APRS station, i for APRS item,
+        o for APRS object, w for weather station). If not set then we
+        don't care about the target type - otherwise, we expect the
+        target type returned by aprs.fi to be of this value and list
+        the entry as 'not found' if these differ
+
+    Returns
+    =======
+    position: 'AprsfiPosition'
+        success: True if call was successful
+        latitude / longitude: position if user was found on aprs.fi
+        altitude: altitude in meters if user was found on aprs.fi
+        lasttime: the time when the target last reported this (current)
+        position. If not found, returned default value is of value
+        datetime.min (0001-01-01 00:00:00)
+        comment: aprs.fi comment (or None)
+        callsign: Call sign converted to uppercase
+        course: course over ground in degrees (or None)
+        speed: speed over ground in km/h (or None)
+    """
+
+    aprs_target_type = aprs_target_type.lower()
+    assert aprs_target_type in ["", "a", "l", "i", "o", "w"]
+
+    aprsfi_callsign = aprsfi_callsign.upper()
+
+    # Serve the request from our cache if the target is not
+    # expected to have sent a new position report since our last query
+    cache_key = (aprsfi_callsign, aprs_target_type)
+    found_in_cache, cached_response = get_aprsfi_cache().get(cache_key)
+    if found_in_cache:
+        return cached_response
+
+    return aprsfi_flights.do(
+        cache_key,
+        query_aprsfi_report,
+        aprsfi_callsign=aprsfi_callsign,
+        aprsdotfi_api_key=aprsdotfi_api_key,
+        aprs_target_type=aprs_target_type,
+    )
+
+
+def query_aprsfi_report(
+    aprsfi_callsign: str, aprsdotfi_api_key: str, aprs_target_type: str
+):
+    """
+    Queries aprs.fi for a position report and caches the result;
+    see get_aprsfi_report()
+
+    Parameters
+    ==========
+    aprsfi_callsign: 'str'
+        Call sign (upper case)
+    aprsdotfi_api_key: 'str'
+        aprs.fi api access key
+    aprs_target_type: 'str'
+        APRS target type (lower case) or empty string
+
+    Returns
+    =======
+    see get_aprsfi_report()
+    """
+
+    headers = {"User-Agent": default_user_agent}
+
+    # placeholder value in case we can't get a response from aprs.fi
+    position = AprsfiPosition(
+        False, 0.0, 0.0, 0.0, datetime.min, None, None, None, None
+    )
+
+    try:
+        resp = get_http_session().get(
+            url=f"https://api.aprs.fi/api/get?name={aprsfi_callsign}&what=loc&apikey={aprsdotfi_api_key}&format=json",
+            headers=headers,
+        )
+    except:
+        resp = None
+    if resp:
+        if resp.status_code == 200:
+            with trace_span("aprsfi_parse"):
+                try:
+                    json_content = resp.json()
+                except ValueError:
+                    json_content = {}
+                position = parse_aprsfi_response(
+                    json_content=json_content, aprs_target_type=aprs_target_type
+                )
+
+    position = position._replace(callsign=aprsfi_callsign)
+    get_aprsfi_cache().set(
+        (aprsfi_callsign, aprs_target_type),
+        position,
+        ttl=get_aprsfi_cache_ttl(position.success, position.lasttime),
+    )
+    return position
+
 
 def get_position_on_aprsfi(
     aprsfi_callsign: str, aprsdotfi_api_key: str, aprs_target_type: str = ""
@@ -75,94 +398,16 @@ def get_position_on_aprsfi(
         aprs.fi comment (or None)
     aprsfi_callsign: 'str'
         Call sign converted to uppercase
-    """
-
-    aprs_target_type = aprs_target_type.lower()
-    assert aprs_target_type in ["", "a", "l", "i", "o", "w"]
-
-    headers = {"User-Agent": default_user_agent}
-
-    success = False
-    latitude = longitude = altitude = 0.0
-    comment = None
-
-    lasttime = (
-        datetime.min
-    )  # placeholder value in case we can't determine the aprs.fi 'lasttime' information
-    result = "fail"
-    found = 0  # number of entries found in aprs.fi request (if any)
 
-    aprsfi_callsign = aprsfi_callsign.upper()
+    The first seven fields of get_aprsfi_report()'s record, as a
+    plain tuple for existing callers
+    """
 
-    try:
-        resp = requests.get(
-            url=f"https://api.aprs.fi/api/get?name={aprsfi_callsign}&what=loc&apikey={aprsdotfi_api_key}&format=json",
-            headers=headers,
-        )
-    except:
-        resp = None
-    if resp:
-        if resp.status_code == 200:
-            json_content = resp.json()
-            # extract web service result. Can either be 'ok' or 'fail'
-            if "result" in json_content:
-                result = json_content["result"]
-            if result == "ok":
-                # extract number of result sets in the response. Must be > 0
-                # regardless of the available number of results, we will only
-                # use the first result
-                if "found" in json_content:
-                    found = json_content["found"]
-                if found > 0:
-                    # We extract only the very first entry and disregard
-                    # entries 2..n whereas ever present
-                    # now extract lat/lon/altitude/lasttime
-
-                    # Check if lat/lon are present; this is the essential information that we need to continue
-                    if (
-                        "lat" not in json_content["entries"][0]
-                        and "lng" in json_content["entries"][0]
-                    ):
-                        success = False
-                    else:
-                        success = True
-                        try:
-                            latitude = float(json_content["entries"][0]["lat"])
-                            longitude = float(json_content["entries"][0]["lng"])
-                        except ValueError:
-                            latitude = longitude = 0
-                            success = False
-                    # Check if the user has asked us for a specific target type
-                    if success and aprs_target_type != "":
-                        if "type" in json_content["entries"][0]:
-                            aprsfi_type = json_content["entries"][0]["type"]
-                            if aprs_target_type != aprsfi_type:
-                                latitude = longitude = 0
-                                success = False
-                    # Now check for our optional fields
-                    if success and "altitude" in json_content["entries"][0]:
-                        try:
-                            altitude = float(json_content["entries"][0]["altitude"])
-                        except ValueError:
-                            altitude = 0.0
-                    if success and "lasttime" in json_content["entries"][0]:
-                        try:
-                            _mylast = float(json_content["entries"][0]["lasttime"])
-                            lasttime = datetime.utcfromtimestamp(_mylast)
-                        except ValueError:
-                            lasttime = datetime.min
-                    if success and "comment" in json_content["entries"][0]:
-                        comment = json_content["entries"][0]["comment"]
-
-        return (
-            success,
-            latitude,
-            longitude,
-            altitude,
-            lasttime,
-            comment,
-            aprsfi_callsign,
-        )
+    return get_aprsfi_report(
+        aprsfi_callsign=aprsfi_callsign,
+        aprsdotfi_api_key=aprsdotfi_api_key,
+        aprs_target_type=aprs_target_type,
+    )[:7]
 
 
 if __name__ == "__main__":
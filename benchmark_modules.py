@@ -0,0 +1,1303 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: offline benchmarks for the web site scraping hot paths,
+# based on the recorded upstream responses in the 'fixtures' directory
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import xmltodict
+from bs4 import BeautifulSoup
+from datetime import datetime, timedelta
+from aprsdotfi_modules import parse_aprsfi_response
+from geopy_modules import get_geolocator
+from geocoder_modules import PlaceIndex, get_unit_vectors
+from track_modules import TrackStore, track_store_defaults
+from record_modules import RadiosondySnapshot
+from prediction_modules import (
+    get_ensemble_landing_prediction,
+    get_local_landing_prediction,
+    prediction_config_defaults,
+)
+from radiosonde_modules import (
+    get_ascent_descent_burst,
+    get_clmb_from_comment,
+    get_empty_radiosondy_response,
+    get_landing_description_from_kml,
+    parse_radiosondy_archive_page,
+    parse_radiosondy_dynamic_page,
+    parse_radiosondy_html_content,
+    radiosondy_archive_aprs_columns,
+    radiosondy_dynamic_aprs_columns,
+    radiosondy_status_change_columns,
+    radiosondy_units_of_measure,
+    remove_trailing_content,
+)
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Directory with the recorded upstream responses, one subdirectory per source
+fixtures_directory = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures"
+)
+
+# Stored benchmark results which the current results are checked against
+benchmark_baseline_file_name = os.path.join(
+    fixtures_directory, "benchmark_baseline.json"
+)
+
+# Default regression tolerances: a benchmark fails if its throughput drops
+# by more than 'throughput' or its peak memory grows by more than
+# 'memory' (relative) plus 'memory_kib' (absolute, for tiny allocations)
+benchmark_tolerance_defaults = {"throughput": 0.5, "memory": 0.25, "memory_kib": 4.0}
+
+
+def load_fixtures(fixture_type: str, file_pattern: str = "*"):
+    """
+    Load the recorded responses of a given type
+
+    Parameters
+    ==========
+    fixture_type: 'str'
+        fixture subdirectory, e.g. 'habhub'
+    file_pattern: 'str'
+        file name pattern
+
+    Returns
+    =======
+    fixtures: 'dict'
+        file content as 'bytes', keyed by file name
+    """
+
+    fixtures = {}
+    for file_name in sorted(
+        glob.glob(os.path.join(fixtures_directory, fixture_type, file_pattern))
+    ):
+        with open(file_name, "rb") as f:
+            fixtures[os.path.basename(file_name)] = f.read()
+    return fixtures
+
+
+def split_into_chunks(content: bytes, chunk_size: int = 16384):
+    """
+    Splits content into chunks, similar to requests' iter_content()
+
+    Parameters
+    ==========
+    content: 'bytes'
+        content that we want to split
+    chunk_size: 'int'
+        chunk size in bytes
+
+    Returns
+    =======
+    chunks: 'list'
+        list of 'bytes' chunks
+    """
+
+    return [content[i : i + chunk_size] for i in range(0, len(content), chunk_size)]
+
+
+def measure(function, arguments: list, repetitions: int = 100, rounds: int = 5):
+    """
+    Measures throughput and peak memory of a function. The function
+    gets called once for each argument per repetition. The throughput
+    is the best of several rounds in order to reduce timing noise.
+
+    Parameters
+    ==========
+    function: 'callable'
+        function which takes a single argument
+    arguments: 'list'
+        function arguments, e.g. the fixtures' content
+    repetitions: 'int'
+        number of repetitions per round
+    rounds: 'int'
+        number of timed rounds
+
+    Returns
+    =======
+    calls_per_second: 'float'
+        throughput
+    peak_memory_kib: 'float'
+        peak memory allocated during a single pass over all arguments
+    results: 'list'
+        function results of the last repetition
+    """
+
+    # Memory first; tracemalloc slows down the function calls
+    tracemalloc.start()
+    for argument in arguments:
+        function(argument)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    calls_per_second = 0.0
+    for _ in range(max(1, rounds)):
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            results = [function(argument) for argument in arguments]
+        duration = time.perf_counter() - start
+        if duration:
+            calls_per_second = max(
+                calls_per_second, repetitions * len(arguments) / duration
+            )
+    return calls_per_second, peak_memory / 1024, results
+
+
+def get_measurement(calls_per_second: float, peak_memory_kib: float, results: list):
+    """
+    Builds a benchmark measurement record. Apart from the figures, it
+    contains a fingerprint of the results so that the baseline check
+    also catches changes in the parsers' output
+
+    Parameters
+    ==========
+    calls_per_second: 'float'
+        throughput
+    peak_memory_kib: 'float'
+        peak memory in KiB
+    results: 'list'
+        function results
+
+    Returns
+    =======
+    measurement: 'dict'
+        measurement record as stored in the baseline file
+    """
+
+    return {
+        "calls_per_second": round(calls_per_second, 1),
+        "peak_memory_kib": round(peak_memory_kib, 1),
+        "result_digest": hashlib.sha256(repr(results).encode("utf-8")).hexdigest(),
+    }
+
+
+def calibration_workload(size: int):
+    """
+    Fixed, pure Python workload (string scanning, float parsing and
+    dict updates, much like the parsers) which is used to normalize
+    the throughput figures of different machines
+    """
+
+    values = {}
+    for i in range(size):
+        text = f"Clb={i % 97 - 48}.{i % 10}m/s t=-{i % 60}.5C"
+        position = text.find("=")
+        values[i % 64] = float(text[position + 1 : text.index("m", position)])
+    return values
+
+
+def get_calibration_rate():
+    """
+    Measures the speed of this machine
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    calls_per_second: 'float'
+        calibration workload throughput
+    """
+
+    calls_per_second, _, _ = measure(
+        function=calibration_workload, arguments=[1000], repetitions=200, rounds=5
+    )
+    return calls_per_second
+
+
+def get_landing_description_from_kml_xmltodict(kml_content: bytes):
+    """
+    Reference implementation: extracts the landing placemark's
+    description by converting the whole KML document to a dict
+    (the approach that get_kml_data_from_habhub used to take)
+
+    Parameters
+    ==========
+    kml_content: 'bytes'
+        KML document
+
+    Returns
+    =======
+    description: 'str'
+        description of the landing placemark (or None)
+    """
+
+    try:
+        kml_dict = xmltodict.parse(kml_content)
+    except:
+        kml_dict = {}
+    placemarks = kml_dict.get("kml", {}).get("Document", {}).get("Placemark", [])
+    for placemark in placemarks:
+        if placemark.get("name") == "Predicted Balloon Landing":
+            return placemark.get("description")
+    return None
+
+
+def parse_radiosondy_html_content_reference(html_raw_content: str):
+    """
+    Reference implementation: extracts the radiosondy.info information
+    blocks with one case-insensitive regex search per block
+    (the approach that parse_radiosondy_html_content used to take)
+
+    Parameters
+    ==========
+    html_raw_content: 'str'
+        radiosondy.info page content
+
+    Returns
+    =======
+    response_dict: 'dict'
+        extracted values (None if not present)
+    """
+
+    _sonde_number = _launch_site = _probe_type = None
+    _probe_aux = _probe_freq = _probe_status = None
+    _max_speed = _max_speed_height = _avg_speed_kmh = None
+    _max_altitude = _avg_ascent_speed = _avg_descent_speed = None
+
+    # With the exception of the APRS data, the data that we want / need is stored as regular
+    # text. We use the text's icons in order to identify the content
+    regex_string = r"images\/balloon.png\"\> Number: ([\w\s]+)\<\/h4\>"
+    matches = re.search(
+        pattern=regex_string,
+        string=html_raw_content,
+        flags=re.IGNORECASE,
+    )
+    if matches:
+        _sonde_number = matches[1]
+
+    regex_string = r"images\/house.png\"\> Launch Site: (.*)\<\/h4\>"
+    matches = re.search(
+        pattern=regex_string,
+        string=html_raw_content,
+        flags=re.IGNORECASE,
+    )
+    if matches:
+        _launch_site = matches[1]
+
+    regex_string = r"images\/type.png\"\> Type: (.*)\<\/h4\>"
+    matches = re.search(
+        pattern=regex_string,
+        string=html_raw_content,
+        flags=re.IGNORECASE,
+    )
+    if matches:
+        _probe_type = matches[1]
+
+    regex_string = r"images\/aux.png\"\> AUX: (.*)\<\/h4\>"
+    matches = re.search(
+        pattern=regex_string,
+        string=html_raw_content,
+        flags=re.IGNORECASE,
+    )
+    if matches:
+        _probe_aux = matches[1]
+
+    regex_string = r"images\/freq.png\"\> Frequency: (.*) MHz\<\/h4\>"
+    matches = re.search(
+        pattern=regex_string,
+        string=html_raw_content,
+        flags=re.IGNORECASE,
+    )
+    if matches:
+        _probe_freq = matches[1]
+
+    regex_string = r"images\/found.png\"\> Status: (.*)\<\/h4\>"
+    matches = re.search(
+        pattern=regex_string,
+        string=html_raw_content,
+        flags=re.IGNORECASE,
+    )
+    if matches:
+        _probe_status = matches[1]
+
+    regex_string = r"images\/speed.png\"\> Max Speed: (.*) km\/h at (.*) m\<\/h4\>"
+    matches = re.search(
+        pattern=regex_string,
+        string=html_raw_content,
+        flags=re.IGNORECASE,
+    )
+    if matches:
+        _max_speed = matches[1]
+        _max_speed_height = matches[2]
+
+    regex_string = r"images\/speed.png\"\> Average Speed: (.*) km\/h\<\/h4\>"
+    matches = re.search(
+        pattern=regex_string,
+        string=html_raw_content,
+        flags=re.IGNORECASE,
+    )
+    if matches:
+        _avg_speed_kmh = matches[1]
+
+    regex_string = r"images\/altitude.png\"\> Max Altitude: (.*) m\<\/h4\>"
+    matches = re.search(
+        pattern=regex_string,
+        string=html_raw_content,
+        flags=re.IGNORECASE,
+    )
+    if matches:
+        _max_altitude = matches[1]
+
+    regex_string = r"images\/up.png\"\> Average Ascent Speed: (.*) m\/s\<\/h4\>"
+    matches = re.search(
+        pattern=regex_string,
+        string=html_raw_content,
+        flags=re.IGNORECASE,
+    )
+    if matches:
+        _avg_ascent_speed = matches[1]
+
+    regex_string = r"images\/down.png\"\> Average Descent Speed: (.*) m\/s\<\/h4\>"
+    matches = re.search(
+        pattern=regex_string,
+        string=html_raw_content,
+        flags=re.IGNORECASE,
+    )
+    if matches:
+        _avg_descent_speed = matches[1]
+
+    response_dict = {
+        "sonde_number": _sonde_number,
+        "launch_site": _launch_site,
+        "probe_type": _probe_type,
+        "probe_aux": _probe_aux,
+        "probe_freq": _probe_freq,
+        "probe_status": _probe_status,
+        "max_speed": _max_speed,
+        "max_speed_height": _max_speed_height,
+        "avg_speed_kmh": _avg_speed_kmh,
+        "max_altitude": _max_altitude,
+        "avg_ascent_speed": _avg_ascent_speed,
+        "avg_descent_speed": _avg_descent_speed,
+    }
+    return response_dict
+
+
+def benchmark_kml_parsers(repetitions: int = 200):
+    """
+    Compares the streaming KML parser against the xmltodict
+    reference implementation on the recorded habhub KML files
+
+    Parameters
+    ==========
+    repetitions: 'int'
+        number of repetitions
+
+    Returns
+    =======
+    success: 'bool'
+        True if both implementations returned the same results
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    """
+
+    fixtures = load_fixtures(fixture_type="habhub", file_pattern="*.kml")
+    if not fixtures:
+        logger.info("No habhub KML fixtures found")
+        return False, {}
+    contents = list(fixtures.values())
+
+    xmltodict_rate, xmltodict_memory, xmltodict_results = measure(
+        function=get_landing_description_from_kml_xmltodict,
+        arguments=contents,
+        repetitions=repetitions,
+    )
+    streaming_rate, streaming_memory, streaming_results = measure(
+        function=lambda chunks: get_landing_description_from_kml(kml_chunks=chunks),
+        arguments=[split_into_chunks(content) for content in contents],
+        repetitions=repetitions,
+    )
+
+    logger.info(f"KML fixtures: {len(contents)} files, {sum(map(len, contents))} bytes")
+    logger.info(
+        f"xmltodict: {xmltodict_rate:10.1f} documents/s, peak memory {xmltodict_memory:8.1f} KiB"
+    )
+    logger.info(
+        f"streaming: {streaming_rate:10.1f} documents/s, peak memory {streaming_memory:8.1f} KiB"
+    )
+    measurements = {
+        "kml_landing_description": get_measurement(
+            streaming_rate, streaming_memory, streaming_results
+        )
+    }
+    if streaming_results != xmltodict_results:
+        logger.info("Streaming and xmltodict parsers returned different results!")
+        return False, measurements
+    return True, measurements
+
+
+def benchmark_radiosondy_html_parsers(repetitions: int = 50):
+    """
+    Compares the single-pass radiosondy.info information block parser
+    against the reference implementation on the recorded radiosondy pages
+
+    Parameters
+    ==========
+    repetitions: 'int'
+        number of repetitions
+
+    Returns
+    =======
+    success: 'bool'
+        True if both implementations returned the same results
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    """
+
+    fixtures = load_fixtures(fixture_type="radiosondy", file_pattern="*.html")
+    if not fixtures:
+        logger.info("No radiosondy.info fixtures found")
+        return False, {}
+    contents = [content.decode("utf-8") for content in fixtures.values()]
+
+    reference_rate, reference_memory, reference_results = measure(
+        function=parse_radiosondy_html_content_reference,
+        arguments=contents,
+        repetitions=repetitions,
+    )
+    single_pass_rate, single_pass_memory, single_pass_results = measure(
+        function=parse_radiosondy_html_content,
+        arguments=contents,
+        repetitions=repetitions,
+    )
+
+    logger.info(
+        f"radiosondy.info fixtures: {len(contents)} pages, {sum(map(len, contents))} characters"
+    )
+    logger.info(
+        f"reference:   {reference_rate:10.1f} pages/s, peak memory {reference_memory:8.1f} KiB"
+    )
+    logger.info(
+        f"single pass: {single_pass_rate:10.1f} pages/s, peak memory {single_pass_memory:8.1f} KiB"
+    )
+    measurements = {
+        "radiosondy_html_content": get_measurement(
+            single_pass_rate, single_pass_memory, single_pass_results
+        )
+    }
+    if single_pass_results != reference_results:
+        logger.info("Single pass and reference parsers returned different results!")
+        return False, measurements
+    return True, measurements
+
+
+def parse_radiosondy_page_reference(html_raw_content: str, archived: bool):
+    """
+    Reference implementation: parses a radiosondy.info page by building
+    the complete BeautifulSoup tree (the approach that get_radiosondy_data
+    used to take)
+
+    Parameters
+    ==========
+    html_raw_content: 'str'
+        radiosondy.info page content
+    archived: 'bool'
+        True for 'sonde_archive.php' pages, False for 'dyn/get_sondeinfo.php'
+
+    Returns
+    =======
+    radiosondy_response: 'RadiosondySnapshot'
+        parsed page (value 'None' if not present)
+    """
+
+    radiosondy_response = get_empty_radiosondy_response()
+    if not archived:
+        radiosondy_response.update(
+            parse_radiosondy_html_content_reference(html_raw_content)
+        )
+    soup = BeautifulSoup(html_raw_content, "html.parser")
+
+    if archived:
+        table = soup.find("table", attrs={"id": "Table2"})
+        if table:
+            rows = table.find("tr", attrs={"class": "bg_1"})
+            if rows:
+                cols = rows.find_all("td")
+                if cols and len(cols) == 9:
+                    radiosondy_response.update(
+                        zip(
+                            radiosondy_status_change_columns,
+                            [col.string for col in cols],
+                        )
+                    )
+                    matches = re.search(
+                        pattern=r"^(-?\d*[.]\d*),\s*(-?\d*[.]\d*)$",
+                        string=radiosondy_response["landing_point"] or "",
+                        flags=re.IGNORECASE,
+                    )
+                    if matches:
+                        radiosondy_response["landing_point_latitude"] = float(
+                            matches[1]
+                        )
+                        radiosondy_response["landing_point_longitude"] = float(
+                            matches[2]
+                        )
+            else:
+                radiosondy_response.update(
+                    parse_radiosondy_html_content_reference(html_raw_content)
+                )
+
+    table = soup.find("table", attrs={"id": "Table1"})
+    if table:
+        rows = table.find("tr", attrs={"class": "bg_1"})
+        if rows:
+            cols = [col.string for col in rows.find_all("td")]
+            if archived and len(cols) == 9:
+                radiosondy_response.update(zip(radiosondy_archive_aprs_columns, cols))
+            elif not archived and len(cols) == 13:
+                radiosondy_response.update(zip(radiosondy_dynamic_aprs_columns, cols))
+                for field, trailing_content in radiosondy_units_of_measure.items():
+                    radiosondy_response[field] = remove_trailing_content(
+                        source_string=radiosondy_response[field],
+                        trailing_content=trailing_content,
+                    )
+    return RadiosondySnapshot.from_fields(radiosondy_response)
+
+
+def benchmark_radiosondy_page_parsers(repetitions: int = 20):
+    """
+    Compares the targeted table extraction of the radiosondy.info pages
+    against the full BeautifulSoup reference implementation
+
+    Parameters
+    ==========
+    repetitions: 'int'
+        number of repetitions
+
+    Returns
+    =======
+    success: 'bool'
+        True if both implementations returned the same results
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    """
+
+    success = True
+    measurements = {}
+    for benchmark_name, file_pattern, archived, parser in [
+        (
+            "radiosondy_archive_page",
+            "sonde_archive*.html",
+            True,
+            parse_radiosondy_archive_page,
+        ),
+        (
+            "radiosondy_dynamic_page",
+            "get_sondeinfo*.html",
+            False,
+            parse_radiosondy_dynamic_page,
+        ),
+    ]:
+        fixtures = load_fixtures(fixture_type="radiosondy", file_pattern=file_pattern)
+        if not fixtures:
+            logger.info(f"No radiosondy.info fixtures found for {file_pattern}")
+            success = False
+            continue
+        contents = [content.decode("utf-8") for content in fixtures.values()]
+
+        # the BeautifulSoup reference is slow; a single pass is sufficient
+        reference_rate, reference_memory, reference_results = measure(
+            function=lambda content: parse_radiosondy_page_reference(
+                html_raw_content=content, archived=archived
+            ),
+            arguments=contents,
+            repetitions=1,
+            rounds=1,
+        )
+        targeted_rate, targeted_memory, targeted_results = measure(
+            function=parser, arguments=contents, repetitions=repetitions
+        )
+
+        logger.info(
+            f"radiosondy.info {file_pattern}: {len(contents)} pages, {sum(map(len, contents))} characters"
+        )
+        logger.info(
+            f"BeautifulSoup: {reference_rate:10.1f} pages/s, peak memory {reference_memory:8.1f} KiB"
+        )
+        logger.info(
+            f"targeted:      {targeted_rate:10.1f} pages/s, peak memory {targeted_memory:8.1f} KiB"
+        )
+        measurements[benchmark_name] = get_measurement(
+            targeted_rate, targeted_memory, targeted_results
+        )
+        if targeted_results != reference_results:
+            logger.info(
+                "Targeted and BeautifulSoup parsers returned different results!"
+            )
+            success = False
+    return success, measurements
+
+
+def benchmark_clmb_parser(repetitions: int = 2000):
+    """
+    Benchmarks the climb rate extraction on the comments of the
+    recorded aprs.fi position reports
+
+    Parameters
+    ==========
+    repetitions: 'int'
+        number of repetitions
+
+    Returns
+    =======
+    success: 'bool'
+        True if the benchmark could be run
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    """
+
+    fixtures = load_fixtures(fixture_type="aprsdotfi", file_pattern="*.json")
+    comments = [
+        entry["comment"]
+        for content in fixtures.values()
+        for entry in json.loads(content).get("entries", [])
+        if "comment" in entry
+    ]
+    if not comments:
+        logger.info("No aprs.fi comments found")
+        return False, {}
+
+    rate, memory, results = measure(
+        function=get_clmb_from_comment, arguments=comments, repetitions=repetitions
+    )
+
+    logger.info(f"aprs.fi comments: {len(comments)} comments")
+    logger.info(f"clmb:      {rate:10.1f} comments/s, peak memory {memory:8.1f} KiB")
+    return True, {"clmb_from_comment": get_measurement(rate, memory, results)}
+
+
+def benchmark_aprsfi_parser(repetitions: int = 2000):
+    """
+    Benchmarks the aprs.fi JSON response handling (decoding and
+    position extraction) on the recorded aprs.fi responses
+
+    Parameters
+    ==========
+    repetitions: 'int'
+        number of repetitions
+
+    Returns
+    =======
+    success: 'bool'
+        True if the benchmark could be run
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    """
+
+    fixtures = load_fixtures(fixture_type="aprsdotfi", file_pattern="*.json")
+    if not fixtures:
+        logger.info("No aprs.fi fixtures found")
+        return False, {}
+    contents = list(fixtures.values())
+
+    rate, memory, results = measure(
+        function=lambda content: parse_aprsfi_response(
+            json_content=json.loads(content)
+        ),
+        arguments=contents,
+        repetitions=repetitions,
+    )
+
+    logger.info(f"aprs.fi fixtures: {len(contents)} responses")
+    logger.info(f"aprs.fi:   {rate:10.1f} responses/s, peak memory {memory:8.1f} KiB")
+    return True, {"aprsfi_response": get_measurement(rate, memory, results)}
+
+
+def benchmark_nominatim_parser(repetitions: int = 2000):
+    """
+    Benchmarks the Nominatim reverse geocoding response handling
+    (decoding and conversion to a geopy location) on the recorded
+    Nominatim responses
+
+    Parameters
+    ==========
+    repetitions: 'int'
+        number of repetitions
+
+    Returns
+    =======
+    success: 'bool'
+        True if the benchmark could be run
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    """
+
+    fixtures = load_fixtures(fixture_type="nominatim", file_pattern="*.json")
+    if not fixtures:
+        logger.info("No Nominatim fixtures found")
+        return False, {}
+    contents = list(fixtures.values())
+    geolocator = get_geolocator()
+
+    def parse_nominatim_response(content: bytes):
+        location = geolocator._parse_json(json.loads(content), exactly_one=True)
+        if not location:
+            return None
+        return location.address, location.latitude, location.longitude
+
+    rate, memory, results = measure(
+        function=parse_nominatim_response, arguments=contents, repetitions=repetitions
+    )
+
+    logger.info(f"Nominatim fixtures: {len(contents)} responses")
+    logger.info(f"Nominatim: {rate:10.1f} responses/s, peak memory {memory:8.1f} KiB")
+    return True, {"nominatim_response": get_measurement(rate, memory, results)}
+
+
+def benchmark_local_prediction(repetitions: int = 500, ensemble_repetitions: int = 20):
+    """
+    Benchmarks the local landing prediction model (single trajectory
+    and Monte Carlo ensemble) on the flight states of the recorded
+    aprs.fi responses
+
+    Parameters
+    ==========
+    repetitions: 'int'
+        number of repetitions of the single trajectory model
+    ensemble_repetitions: 'int'
+        number of repetitions of the ensemble model
+
+    Returns
+    =======
+    success: 'bool'
+        True if the benchmark could be run
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    """
+
+    fixtures = load_fixtures(fixture_type="aprsdotfi", file_pattern="*.json")
+    flight_states = []
+    for content in fixtures.values():
+        position = parse_aprsfi_response(json_content=json.loads(content))
+        clmb = (
+            get_clmb_from_comment(probe_comment=position.comment)
+            if position.comment
+            else None
+        )
+        if position.success and clmb:
+            flight_states.append(
+                (
+                    position.latitude,
+                    position.longitude,
+                    position.altitude,
+                    position.lasttime,
+                    position.course,
+                    position.speed,
+                    clmb,
+                )
+            )
+    if not flight_states:
+        logger.info("No aprs.fi fixtures with flight states found")
+        return False, {}
+
+    def predict_landing(flight_state: tuple, prediction_function):
+        latitude, longitude, altitude, timestamp, course, speed, clmb = flight_state
+        ascent_rate, descent_rate, burst_altitude = get_ascent_descent_burst(
+            clmb=clmb, altitude=altitude
+        )
+        return prediction_function(
+            latitude=latitude,
+            longitude=longitude,
+            altitude=altitude,
+            course=course,
+            speed=speed,
+            ascent_rate=ascent_rate,
+            descent_rate=descent_rate,
+            burst_altitude=burst_altitude,
+            descending=clmb < 0,
+            position_timestamp=timestamp,
+            prediction_config=prediction_config_defaults,
+        )
+
+    measurements = {}
+    logger.info(f"aprs.fi flight states: {len(flight_states)}")
+    for name, prediction_function, function_repetitions in [
+        ("local_landing_prediction", get_local_landing_prediction, repetitions),
+        (
+            "ensemble_landing_prediction",
+            get_ensemble_landing_prediction,
+            ensemble_repetitions,
+        ),
+    ]:
+        rate, memory, results = measure(
+            function=lambda flight_state: predict_landing(
+                flight_state, prediction_function
+            ),
+            arguments=flight_states,
+            repetitions=function_repetitions,
+        )
+        logger.info(
+            f"{name}: {rate:10.1f} predictions/s, peak memory {memory:8.1f} KiB"
+        )
+        measurements[name] = get_measurement(rate, memory, results)
+    return True, measurements
+
+
+def get_deep_size(value):
+    """
+    Memory footprint of a result record or dictionary, including its
+    values (but not the dictionary keys and None, which are shared)
+
+    Parameters
+    ==========
+    value: 'tuple' or 'dict'
+        result record or dictionary
+
+    Returns
+    =======
+    size: 'int'
+        size in bytes
+    """
+
+    elements = value.values() if isinstance(value, dict) else value
+    return sys.getsizeof(value) + sum(
+        sys.getsizeof(element) for element in elements if element is not None
+    )
+
+
+def benchmark_result_records(repetitions: int = 2000):
+    """
+    Compares the radiosondy.info snapshot records with the response
+    dictionaries that get_radiosondy_data used to return (raw string
+    values): memory footprint, pickled size and pickling throughput
+
+    Parameters
+    ==========
+    repetitions: 'int'
+        number of repetitions
+
+    Returns
+    =======
+    success: 'bool'
+        True if the benchmark could be run
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    """
+
+    fixtures = load_fixtures(fixture_type="radiosondy", file_pattern="*.html")
+    if not fixtures:
+        logger.info("No radiosondy.info fixtures found")
+        return False, {}
+    snapshots = []
+    response_dicts = []
+    for file_name, content in fixtures.items():
+        archived = file_name.startswith("sonde_archive")
+        parser = (
+            parse_radiosondy_archive_page if archived else parse_radiosondy_dynamic_page
+        )
+        snapshot = parser(html_raw_content=content.decode("utf-8"))
+        snapshots.append(snapshot)
+        response_dicts.append(
+            {
+                field: value if value is None or isinstance(value, str) else str(value)
+                for field, value in snapshot._asdict().items()
+            }
+        )
+
+    rate, memory, results = measure(
+        function=pickle.dumps, arguments=snapshots, repetitions=repetitions
+    )
+    dict_rate, _, dict_results = measure(
+        function=pickle.dumps, arguments=response_dicts, repetitions=repetitions
+    )
+    record_size = sum(map(get_deep_size, snapshots)) / len(snapshots)
+    dict_size = sum(map(get_deep_size, response_dicts)) / len(response_dicts)
+    logger.info(
+        f"radiosondy.info records: {record_size:8.1f} bytes in memory, {sum(map(len, results)) / len(results):6.1f} bytes pickled, {rate:10.1f} pickles/s"
+    )
+    logger.info(
+        f"response dicts:          {dict_size:8.1f} bytes in memory, {sum(map(len, dict_results)) / len(dict_results):6.1f} bytes pickled, {dict_rate:10.1f} pickles/s"
+    )
+    return True, {"radiosondy_record_pickle": get_measurement(rate, memory, results)}
+
+
+def benchmark_offline_geocoder(
+    places: int = 150000, queries: int = 2000, build_repetitions: int = 3
+):
+    """
+    Benchmarks the offline reverse geocoder's k-d tree (index build
+    and nearest place queries) on synthetic places, about as many as
+    in GeoNames' cities1000.txt, and checks its results against a
+    brute force search
+
+    Parameters
+    ==========
+    places: 'int'
+        number of places
+    queries: 'int'
+        number of query positions
+    build_repetitions: 'int'
+        number of timed index builds
+
+    Returns
+    =======
+    success: 'bool'
+        True if the k-d tree found the same places as the brute force search
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    """
+
+    # places all over the globe (uniform on the sphere), a quarter of
+    # them clustered in central Europe like the launch sites' surroundings
+    rng = np.random.default_rng(2020)
+    clustered = places // 4
+    latitudes = np.concatenate(
+        (
+            np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, places - clustered))),
+            rng.uniform(45.0, 56.0, clustered),
+        )
+    )
+    longitudes = np.concatenate(
+        (
+            rng.uniform(-180.0, 180.0, places - clustered),
+            rng.uniform(2.0, 20.0, clustered),
+        )
+    )
+    positions = list(
+        zip(
+            rng.uniform(45.0, 56.0, queries).tolist(),
+            rng.uniform(2.0, 20.0, queries).tolist(),
+        )
+    )
+
+    build_rate, build_memory, _ = measure(
+        function=lambda _: PlaceIndex(latitudes=latitudes, longitudes=longitudes),
+        arguments=[None],
+        repetitions=1,
+        rounds=build_repetitions,
+    )
+    index = PlaceIndex(latitudes=latitudes, longitudes=longitudes)
+    query_rate, query_memory, results = measure(
+        function=lambda position: index.query(*position)[0],
+        arguments=positions,
+        repetitions=5,
+    )
+
+    points = get_unit_vectors(latitudes, longitudes)
+    query_points = get_unit_vectors(*np.array(positions[:200]).T)
+    expected = [
+        int(np.argmin(((points - query_point) ** 2).sum(axis=1)))
+        for query_point in query_points
+    ]
+
+    logger.info(
+        f"offline geocoder: {places} places, index build {1000 / build_rate:8.1f} ms, peak memory {build_memory:8.1f} KiB"
+    )
+    logger.info(
+        f"offline geocoder: {query_rate:10.1f} queries/s ({1e6 / query_rate:.1f} µs per query)"
+    )
+    measurements = {
+        "offline_geocoder_build": get_measurement(build_rate, build_memory, []),
+        "offline_geocoder_query": get_measurement(query_rate, query_memory, results),
+    }
+    if results[: len(expected)] != expected:
+        logger.info("k-d tree and brute force search returned different places!")
+        return False, measurements
+    return True, measurements
+
+
+def benchmark_track_store(points: int = 4096, repetitions: int = 200):
+    """
+    Benchmarks the track store's range queries and climb rate
+    derivation on a synthetic, full-size radiosonde track
+
+    Parameters
+    ==========
+    points: 'int'
+        number of track points (one per 5 seconds)
+    repetitions: 'int'
+        number of repetitions
+
+    Returns
+    =======
+    success: 'bool'
+        True if the benchmark could be run
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    """
+
+    launch_time = datetime(2021, 6, 1, 11, 0)
+    measurements = {}
+    with tempfile.TemporaryDirectory() as directory:
+        store = TrackStore(
+            track_config=dict(
+                track_store_defaults, directory=directory, capacity=points
+            )
+        )
+        for index in range(points):
+            store.add_point(
+                "BENCHMARK",
+                launch_time + timedelta(seconds=5 * index),
+                latitude=51.5 + index * 1e-4,
+                longitude=12.0 + index * 2e-4,
+                altitude=100.0 + 25.0 * index,
+                temperature=15.0 - 0.15 * index,
+            )
+
+        # 10 minute windows and fixes across the whole flight
+        query_times = [
+            launch_time + timedelta(seconds=5 * index)
+            for index in range(0, points, points // 16)
+        ]
+
+        def query_track(start: datetime):
+            track = store.get_track(
+                "BENCHMARK", start=start, end=start + timedelta(minutes=10)
+            )
+            return len(track["timestamp"]), round(float(track["altitude"].sum()), 1)
+
+        for name, function in [
+            ("track_store_range_query", query_track),
+            (
+                "track_store_derived_clmb",
+                lambda timestamp: store.get_derived_clmb("BENCHMARK", timestamp),
+            ),
+        ]:
+            rate, memory, results = measure(
+                function=function, arguments=query_times, repetitions=repetitions
+            )
+            logger.info(
+                f"{name}: {rate:10.1f} queries/s, peak memory {memory:8.1f} KiB"
+            )
+            measurements[name] = get_measurement(rate, memory, results)
+        store.flush()
+        del store
+    return True, measurements
+
+
+def run_benchmarks():
+    """
+    Runs all benchmarks
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    success: 'bool'
+        True if all benchmarks could be run and all
+        implementations returned the same results
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    """
+
+    success = True
+    measurements = {}
+    for benchmark in [
+        benchmark_kml_parsers,
+        benchmark_radiosondy_html_parsers,
+        benchmark_radiosondy_page_parsers,
+        benchmark_clmb_parser,
+        benchmark_aprsfi_parser,
+        benchmark_nominatim_parser,
+        benchmark_local_prediction,
+        benchmark_result_records,
+        benchmark_offline_geocoder,
+        benchmark_track_store,
+    ]:
+        benchmark_success, benchmark_measurements = benchmark()
+        success = success and benchmark_success
+        measurements.update(benchmark_measurements)
+    return success, measurements
+
+
+def load_benchmark_baseline(file_name: str = benchmark_baseline_file_name):
+    """
+    Loads the stored benchmark baseline
+
+    Parameters
+    ==========
+    file_name: 'str'
+        baseline file name
+
+    Returns
+    =======
+    baseline: 'dict'
+        stored baseline (or None if not present)
+    """
+
+    try:
+        with open(file_name, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_benchmark_baseline(
+    calibration_rate: float,
+    measurements: dict,
+    file_name: str = benchmark_baseline_file_name,
+):
+    """
+    Stores the current results as the new benchmark baseline
+
+    Parameters
+    ==========
+    calibration_rate: 'float'
+        calibration workload throughput of this machine
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    file_name: 'str'
+        baseline file name
+
+    Returns
+    =======
+    """
+
+    baseline = {
+        "calibration_rate": round(calibration_rate, 1),
+        "benchmarks": measurements,
+    }
+    with open(file_name, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def check_benchmark_baseline(
+    calibration_rate: float,
+    measurements: dict,
+    baseline: dict,
+    tolerances: dict = benchmark_tolerance_defaults,
+):
+    """
+    Checks the current results against the stored baseline. The
+    throughput figures are normalized with the calibration rates of
+    both machines before they are compared
+
+    Parameters
+    ==========
+    calibration_rate: 'float'
+        calibration workload throughput of this machine
+    measurements: 'dict'
+        measurement records, keyed by benchmark name
+    baseline: 'dict'
+        stored baseline
+    tolerances: 'dict'
+        regression tolerances, see benchmark_tolerance_defaults
+
+    Returns
+    =======
+    regressions: 'list'
+        human-readable descriptions of all regressions
+    """
+
+    regressions = []
+    speed_factor = calibration_rate / baseline["calibration_rate"]
+
+    for benchmark_name, stored in baseline["benchmarks"].items():
+        current = measurements.get(benchmark_name)
+        if not current:
+            regressions.append(f"{benchmark_name}: benchmark did not run")
+            continue
+
+        expected_rate = stored["calls_per_second"] * speed_factor
+        if current["calls_per_second"] < expected_rate * (1 - tolerances["throughput"]):
+            regressions.append(
+                f"{benchmark_name}: {current['calls_per_second']:.1f} calls/s, expected at least {expected_rate * (1 - tolerances['throughput']):.1f} calls/s"
+            )
+
+        memory_limit = (
+            stored["peak_memory_kib"] * (1 + tolerances["memory"])
+            + tolerances["memory_kib"]
+        )
+        if current["peak_memory_kib"] > memory_limit:
+            regressions.append(
+                f"{benchmark_name}: peak memory {current['peak_memory_kib']:.1f} KiB, expected at most {memory_limit:.1f} KiB"
+            )
+
+        if stored.get("result_digest") != current.get("result_digest"):
+            regressions.append(f"{benchmark_name}: results differ from the baseline")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks for the web site scraping hot paths"
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="store the current results as the new baseline",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=benchmark_baseline_file_name,
+        help="baseline file name",
+    )
+    parser.add_argument(
+        "--throughput-tolerance",
+        type=float,
+        default=benchmark_tolerance_defaults["throughput"],
+        help="max. relative throughput drop before a benchmark fails",
+    )
+    args = parser.parse_args()
+
+    # Calibrate before and after the benchmarks; the faster figure
+    # is less affected by other processes on this machine
+    calibration_rate = get_calibration_rate()
+    success, measurements = run_benchmarks()
+    calibration_rate = max(calibration_rate, get_calibration_rate())
+    logger.info(f"calibration: {calibration_rate:10.1f} calls/s")
+    if not success:
+        logger.info("Benchmarks failed")
+        sys.exit(1)
+
+    if args.update_baseline:
+        save_benchmark_baseline(
+            calibration_rate=calibration_rate,
+            measurements=measurements,
+            file_name=args.baseline,
+        )
+        logger.info(f"Baseline written to {args.baseline}")
+        sys.exit(0)
+
+    baseline = load_benchmark_baseline(file_name=args.baseline)
+    if not baseline:
+        logger.info(f"No baseline found at {args.baseline}")
+        sys.exit(1)
+
+    regressions = check_benchmark_baseline(
+        calibration_rate=calibration_rate,
+        measurements=measurements,
+        baseline=baseline,
+        tolerances=dict(
+            benchmark_tolerance_defaults, throughput=args.throughput_tolerance
+        ),
+    )
+    for regression in regressions:
+        logger.info(f"Regression: {regression}")
+    if regressions:
+        sys.exit(1)
+    logger.info("No regressions against the baseline")
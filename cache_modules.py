@@ -0,0 +1,385 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: thread-safe in-memory cache with per-entry expiry,
+# size-based (LRU) eviction and hit/miss statistics
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# All caches that have been created so far; used for the statistics
+cache_registry = []
+cache_registry_lock = threading.Lock()
+
+# All single-flight groups that have been created so far
+single_flight_registry = []
+single_flight_registry_lock = threading.Lock()
+
+
+class ExpiringCache:
+    """
+    Thread-safe key/value cache. Each entry expires after its own
+    time-to-live; once the cache is full, the least recently used
+    entry gets evicted.
+    """
+
+    def __init__(self, name: str, max_entries: int, default_ttl: float):
+        """
+        Parameters
+        ==========
+        name: 'str'
+            Cache name, used for the statistics
+        max_entries: 'int'
+            Max number of entries before LRU eviction kicks in
+        default_ttl: 'float'
+            Default time-to-live in seconds
+        """
+        self.name = name
+        self.max_entries = max(1, max_entries)
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.expirations = self.evictions = 0
+
+        with cache_registry_lock:
+            cache_registry.append(self)
+
+    def get(self, key):
+        """
+        Get a cache entry
+
+        Parameters
+        ==========
+        key: 'hashable'
+            Cache key
+
+        Returns
+        =======
+        found: 'bool'
+            True if the key was present and has not expired yet
+        value: 'object'
+            Cached value (or None)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            value, expires = entry
+            if expires <= time.time():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def get_remaining_ttl(self, key):
+        """
+        Get the remaining lifetime of a cache entry without
+        counting it as a hit or miss
+
+        Parameters
+        ==========
+        key: 'hashable'
+            Cache key
+
+        Returns
+        =======
+        ttl: 'float'
+            Seconds until the entry expires; None if the
+            key is not present or has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            ttl = entry[1] - time.time()
+            return ttl if ttl > 0 else None
+
+    def set(self, key, value, ttl: float = None):
+        """
+        Add or replace a cache entry
+
+        Parameters
+        ==========
+        key: 'hashable'
+            Cache key
+        value: 'object'
+            Value that we want to cache
+        ttl: 'float'
+            Time-to-live in seconds. Uses the cache's default
+            time-to-live if not specified
+
+        Returns
+        =======
+        """
+        if ttl is None:
+            ttl = self.default_ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def delete(self, key):
+        """
+        Remove an entry from the cache (if present)
+
+        Parameters
+        ==========
+        key: 'hashable'
+            Cache key
+
+        Returns
+        =======
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        # Caller must hold the lock. Drop the expired entries first
+        # and the least recently used ones if we are still too big
+        if len(self._entries) <= self.max_entries:
+            return
+        now = time.time()
+        for key in [k for k, (_, expires) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+            self.expirations += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def export_entries(self):
+        """
+        Export all non-expired entries, e.g. for persisting them
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        entries: 'list'
+            List of (key, value, expiry timestamp) tuples,
+            least recently used entry first
+        """
+        now = time.time()
+        with self._lock:
+            return [
+                (key, value, expires)
+                for key, (value, expires) in self._entries.items()
+                if expires > now
+            ]
+
+    def import_entries(self, entries: list):
+        """
+        Import entries which were previously exported through
+        export_entries(). Expired entries are skipped.
+
+        Parameters
+        ==========
+        entries: 'list'
+            List of (key, value, expiry timestamp) tuples
+
+        Returns
+        =======
+        """
+        now = time.time()
+        with self._lock:
+            for key, value, expires in entries:
+                if expires > now:
+                    self._entries[key] = (value, expires)
+                    self._entries.move_to_end(key)
+            self._evict()
+
+    def get_statistics(self):
+        """
+        Get the cache's statistics
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        statistics: 'dict'
+            name, entries, hits, misses, hit_ratio,
+            expirations and evictions
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller
+    executes the function, all callers that arrive while it is still
+    running wait for it and get the same result (or exception).
+    Results are not kept once the call has finished; combine this
+    class with an ExpiringCache for that.
+    """
+
+    def __init__(self, name: str):
+        """
+        Parameters
+        ==========
+        name: 'str'
+            Name of the group, used for the statistics
+        """
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = self.coalesced = 0
+
+        with single_flight_registry_lock:
+            single_flight_registry.append(self)
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Executes a function unless a call with the same key is
+        already running; in that case, waits for its result
+
+        Parameters
+        ==========
+        key: 'hashable'
+            Call key, e.g. the radiosonde ID
+        function: 'callable'
+            function that gets executed by the first caller
+        args / kwargs:
+            function arguments
+
+        Returns
+        =======
+        result: 'object'
+            the function's result. Callers share the same result
+            object, so they must not change it
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as exception:
+            future.set_exception(exception)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def get_statistics(self):
+        """
+        Get the group's statistics
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        statistics: 'dict'
+            name, in_flight, calls (executed), coalesced (callers
+            which have waited for another caller's result)
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "in_flight": len(self._calls),
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+            }
+
+
+def get_single_flight_statistics():
+    """
+    Get the statistics of all single-flight groups
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    statistics: 'list'
+        List of statistics dictionaries, one per group
+    """
+    with single_flight_registry_lock:
+        groups = list(single_flight_registry)
+    return [group.get_statistics() for group in groups]
+
+
+def get_cache_statistics():
+    """
+    Get the statistics of all caches
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    statistics: 'list'
+        List of statistics dictionaries, one per cache
+    """
+    with cache_registry_lock:
+        caches = list(cache_registry)
+    return [cache.get_statistics() for cache in caches]
+
+
+if __name__ == "__main__":
+    cache = ExpiringCache(name="demo", max_entries=2, default_ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    logger.info(cache.get("b"))
+    logger.info(get_cache_statistics())
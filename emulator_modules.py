@@ -0,0 +1,788 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: local stand-in for aprs.fi, predict.habhub.org, radiosondy.info
+# and Nominatim, plus an end-to-end latency benchmark which drives the
+# bot's /sonde command against it
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qs
+from utility_modules import read_config_section
+from http_modules import (
+    PooledHTTPAdapter,
+    get_http_session,
+    get_upstream_statistics,
+    http_config_defaults,
+)
+from cache_modules import (
+    ExpiringCache,
+    cache_registry,
+    cache_registry_lock,
+    get_single_flight_statistics,
+)
+from scheduler_modules import FairScheduler, get_scheduler_statistics
+import geopy_modules
+import radiobot
+import track_modules
+import tracing_modules
+from profiler_modules import get_command_profiler
+from outbox_modules import Outbox, outbox_config_defaults
+from metrics_modules import telegram_delivery_seconds
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Directory with the recorded upstream responses that the emulator serves
+fixtures_directory = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures"
+)
+
+# Upstream web sites and the URL prefixes that get routed to the emulator
+emulated_upstreams = {
+    "aprsdotfi": ["https://api.aprs.fi"],
+    "habhub": ["http://predict.habhub.org", "https://predict.habhub.org"],
+    "radiosondy": ["https://radiosondy.info"],
+    "nominatim": ["https://nominatim.openstreetmap.org"],
+}
+
+# Default settings for the optional 'upstream_emulator' config file section
+# <upstream>_latency / <upstream>_jitter: mean response time and its
+# standard deviation in seconds
+# <upstream>_error_rate: share of requests (0..1) which fail with
+# HTTP status 'error_status'
+# aprsdotfi_fixture, habhub_kml_fixture, radiosondy_archive_fixture,
+# radiosondy_dynamic_fixture, nominatim_fixture: payloads from the
+# 'fixtures' directory
+# radiosondy_archived_sondes: comma-separated sonde IDs for which
+# radiosondy.info redirects to the archive page; all other sondes are
+# reported as flying
+# radiosondy_validators: send ETag / Last-Modified headers for the
+# radiosondy.info pages and honor conditional requests (HTTP 304)
+# nominatim_min_delay: min delay between two Nominatim requests during
+# the benchmark (the bot's 'min_delay_seconds')
+emulator_config_defaults = {
+    "host": "127.0.0.1",
+    "port": 0,
+    "aprsdotfi_latency": 0.15,
+    "aprsdotfi_jitter": 0.05,
+    "aprsdotfi_error_rate": 0.0,
+    "habhub_latency": 0.8,
+    "habhub_jitter": 0.3,
+    "habhub_error_rate": 0.0,
+    "radiosondy_latency": 1.5,
+    "radiosondy_jitter": 0.5,
+    "radiosondy_error_rate": 0.0,
+    "nominatim_latency": 0.3,
+    "nominatim_jitter": 0.1,
+    "nominatim_error_rate": 0.0,
+    "error_status": 503,
+    "aprsdotfi_fixture": "descent.json",
+    "habhub_kml_fixture": "descent.kml",
+    "radiosondy_archive_fixture": "sonde_archive_found.html",
+    "radiosondy_dynamic_fixture": "get_sondeinfo_flying.html",
+    "nominatim_fixture": "rural_germany.json",
+    "radiosondy_archived_sondes": "N4120412",
+    "radiosondy_validators": True,
+    "nominatim_min_delay": 1.0,
+}
+
+
+def load_fixture(fixture_type: str, file_name: str):
+    """
+    Load a recorded upstream response
+
+    Parameters
+    ==========
+    fixture_type: 'str'
+        fixture subdirectory, e.g. 'habhub'
+    file_name: 'str'
+        file name
+
+    Returns
+    =======
+    content: 'bytes'
+        file content
+    """
+
+    with open(os.path.join(fixtures_directory, fixture_type, file_name), "rb") as f:
+        return f.read()
+
+
+class UpstreamEmulator(ThreadingHTTPServer):
+    """
+    HTTP server which mimics the upstream endpoints that the bot uses.
+    Requests are dispatched on the original host name (Host header)
+    and path; each request gets delayed and, depending on the error
+    rate, failed as configured for its upstream
+    """
+
+    daemon_threads = True
+
+    def __init__(self, emulator_config: dict):
+        self.emulator_config = emulator_config
+        self.archived_sondes = {
+            sonde_id.strip().upper()
+            for sonde_id in emulator_config["radiosondy_archived_sondes"].split(",")
+            if sonde_id.strip()
+        }
+        self.aprsdotfi_response = json.loads(
+            load_fixture("aprsdotfi", emulator_config["aprsdotfi_fixture"])
+        )
+        self.habhub_kml = load_fixture("habhub", emulator_config["habhub_kml_fixture"])
+        self.radiosondy_archive_page = load_fixture(
+            "radiosondy", emulator_config["radiosondy_archive_fixture"]
+        )
+        self.radiosondy_dynamic_page = load_fixture(
+            "radiosondy", emulator_config["radiosondy_dynamic_fixture"]
+        )
+        self.nominatim_response = load_fixture(
+            "nominatim", emulator_config["nominatim_fixture"]
+        )
+
+        self.last_modified = formatdate(time.time(), usegmt=True)
+        self.call_counter = Counter()
+        self.call_counter_lock = threading.Lock()
+        self.random = random.Random()
+        super().__init__(
+            (emulator_config["host"], emulator_config["port"]), UpstreamRequestHandler
+        )
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count_call(self, endpoint: str):
+        with self.call_counter_lock:
+            self.call_counter[endpoint] += 1
+
+    def get_call_counts(self):
+        """
+        Returns the number of requests per endpoint so far
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        call_counts: 'Counter'
+            number of requests, keyed by endpoint
+        """
+
+        with self.call_counter_lock:
+            return Counter(self.call_counter)
+
+    def get_delay(self, upstream: str):
+        latency = self.emulator_config[f"{upstream}_latency"]
+        jitter = self.emulator_config[f"{upstream}_jitter"]
+        return max(0.0, self.random.gauss(latency, jitter) if jitter else latency)
+
+    def is_failing(self, upstream: str):
+        return self.random.random() < self.emulator_config[f"{upstream}_error_rate"]
+
+    def start(self):
+        thread = threading.Thread(
+            target=self.serve_forever, name="upstream-emulator", daemon=True
+        )
+        thread.start()
+        logger.info(f"Upstream emulator listening on {self.url}")
+        return thread
+
+
+class UpstreamRequestHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the upstream emulator
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # keep the benchmark output readable
+        pass
+
+    def do_GET(self):
+        self.handle_upstream_request()
+
+    def do_POST(self):
+        # consume the form data so that the connection can be reused
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        self.handle_upstream_request()
+
+    def send_validated_content(self, content: bytes, content_type: str):
+        # Static page with validators; conditional requests for an
+        # unchanged page get answered with HTTP 304
+        if not self.server.emulator_config["radiosondy_validators"]:
+            self.send_content(200, content, content_type)
+            return
+        headers = {
+            "ETag": f'"{hashlib.sha1(content).hexdigest()}"',
+            "Last-Modified": self.server.last_modified,
+        }
+        if self.headers.get("If-None-Match") == headers["ETag"] or (
+            "If-None-Match" not in self.headers
+            and self.headers.get("If-Modified-Since") == headers["Last-Modified"]
+        ):
+            self.server.count_call("not_modified")
+            self.send_content(304, b"", content_type, headers=headers)
+            return
+        self.send_content(200, content, content_type, headers=headers)
+
+    def send_content(
+        self, status: int, content: bytes, content_type: str, headers: dict = None
+    ):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if status != 304:
+            self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    def handle_upstream_request(self):
+        emulator = self.server
+        host = self.headers.get("Host", "").split(":")[0].lower()
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        routes = {
+            ("api.aprs.fi", "/api/get"): ("aprsdotfi", self.get_aprsdotfi),
+            ("predict.habhub.org", "/ajax.php"): ("habhub", self.get_habhub_form),
+            ("predict.habhub.org", "/kml.php"): ("habhub", self.get_habhub_kml),
+            ("radiosondy.info", "/sonde.php"): ("radiosondy", self.get_sonde_page),
+            ("radiosondy.info", "/sonde_archive.php"): (
+                "radiosondy",
+                self.get_sonde_archive_page,
+            ),
+            ("radiosondy.info", "/dyn/get_sondeinfo.php"): (
+                "radiosondy",
+                self.get_sondeinfo_page,
+            ),
+            ("nominatim.openstreetmap.org", "/reverse"): (
+                "nominatim",
+                self.get_nominatim_reverse,
+            ),
+        }
+        route = routes.get((host, url.path))
+        if not route:
+            emulator.count_call("unknown")
+            self.send_content(404, b"Not found", "text/plain")
+            return
+
+        upstream, handler = route
+        emulator.count_call(f"{host}{url.path}")
+        time.sleep(emulator.get_delay(upstream))
+        if emulator.is_failing(upstream):
+            self.send_content(
+                emulator.emulator_config["error_status"],
+                b"Emulated upstream error",
+                "text/plain",
+            )
+            return
+        handler(query)
+
+    def get_aprsdotfi(self, query: dict):
+        # Report the requested call sign at the fixture's position, 'now'
+        response = json.loads(json.dumps(self.server.aprsdotfi_response))
+        now = int(time.time())
+        for entry in response.get("entries", []):
+            entry["name"] = query.get("name", entry.get("name"))
+            entry["time"] = entry["lasttime"] = str(now)
+        self.send_content(200, json.dumps(response).encode("utf-8"), "application/json")
+
+    def get_habhub_form(self, query: dict):
+        if self.command != "POST" or query.get("action") != "submitForm":
+            self.send_content(200, b'{"valid":"false"}', "application/json")
+            return
+        response = {"valid": "true", "uuid": uuid.uuid4().hex}
+        self.send_content(200, json.dumps(response).encode("utf-8"), "text/html")
+
+    def get_habhub_kml(self, query: dict):
+        self.send_content(
+            200, self.server.habhub_kml, "application/vnd.google-earth.kml+xml"
+        )
+
+    def get_sonde_page(self, query: dict):
+        sonde_id = query.get("sondenumber", "").upper()
+        if sonde_id in self.server.archived_sondes:
+            self.send_content(
+                302,
+                b"",
+                "text/html",
+                headers={
+                    "Location": f"https://radiosondy.info/sonde_archive.php?sondenumber={sonde_id}"
+                },
+            )
+            return
+        # Flying sondes: the page itself loads its data dynamically
+        content = f"<html><body><h2>Sonde {sonde_id}</h2><div id='sondeinfo'></div></body></html>"
+        self.send_content(200, content.encode("utf-8"), "text/html; charset=UTF-8")
+
+    def get_sonde_archive_page(self, query: dict):
+        self.send_validated_content(
+            self.server.radiosondy_archive_page, "text/html; charset=UTF-8"
+        )
+
+    def get_sondeinfo_page(self, query: dict):
+        self.send_validated_content(
+            self.server.radiosondy_dynamic_page, "text/html; charset=UTF-8"
+        )
+
+    def get_nominatim_reverse(self, query: dict):
+        self.send_content(
+            200, self.server.nominatim_response, "application/json; charset=utf-8"
+        )
+
+
+class EmulatorHTTPAdapter(PooledHTTPAdapter):
+    """
+    HTTPAdapter which sends all requests to the upstream emulator.
+    The original host name is kept in the Host header and in the
+    response URL, so redirects and URL checks work as usual
+    """
+
+    def __init__(self, emulator_url: str, **kwargs):
+        self.emulator_url = emulator_url
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        original_url = request.url
+        url = urlsplit(original_url)
+        request.url = self.emulator_url + url.path
+        if url.query:
+            request.url += "?" + url.query
+        request.headers["Host"] = url.netloc
+        try:
+            response = super().send(request, **kwargs)
+        finally:
+            request.url = original_url
+            del request.headers["Host"]
+        response.url = original_url
+        return response
+
+
+def route_upstreams_to_emulator(emulator_url: str):
+    """
+    Mounts the emulator adapter for all upstream web sites
+    on the bot's shared HTTP session
+
+    Parameters
+    ==========
+    emulator_url: 'str'
+        base URL of the upstream emulator
+
+    Returns
+    =======
+    """
+
+    http_config = read_config_section(
+        section_name="http_config", defaults=http_config_defaults
+    )
+    adapter = EmulatorHTTPAdapter(
+        emulator_url=emulator_url,
+        timeout=(http_config["connect_timeout"], http_config["read_timeout"]),
+        pool_connections=http_config["pool_connections"],
+        pool_maxsize=http_config["pool_maxsize"],
+        max_retries=http_config["max_retries"],
+    )
+    session = get_http_session()
+    for prefixes in emulated_upstreams.values():
+        for prefix in prefixes:
+            session.mount(prefix, adapter)
+
+
+def use_in_memory_geopy_cache(min_delay_seconds: float):
+    """
+    Keeps the benchmark from reading and writing the bot's reverse
+    geocoding cache file and applies the benchmark's Nominatim rate limit
+
+    Parameters
+    ==========
+    min_delay_seconds: 'float'
+        min delay between two Nominatim requests
+
+    Returns
+    =======
+    """
+
+    with geopy_modules.geopy_cache_lock:
+        geopy_config = read_config_section(
+            section_name="geopy_config", defaults=geopy_modules.geopy_config_defaults
+        )
+        geopy_config["cache_file"] = ""
+        geopy_config["min_delay_seconds"] = min_delay_seconds
+        geopy_modules.geopy_config = geopy_config
+        geopy_modules.geopy_cache = ExpiringCache(
+            name="geopy",
+            max_entries=geopy_config["cache_max_entries"],
+            default_ttl=geopy_config["cache_ttl"],
+        )
+
+
+def use_temporary_track_store(directory: str):
+    """
+    Keeps the benchmark from writing to the bot's track store
+
+    Parameters
+    ==========
+    directory: 'str'
+        temporary directory for the benchmark's tracks
+
+    Returns
+    =======
+    """
+
+    with track_modules.track_store_lock:
+        track_config = read_config_section(
+            section_name="track_store", defaults=track_modules.track_store_defaults
+        )
+        track_config["directory"] = directory
+        track_modules.track_store = (
+            track_modules.TrackStore(track_config=track_config)
+            if track_config["enabled"]
+            else None
+        )
+
+
+def use_trace_directory(directory: str):
+    """
+    Writes the traces of the benchmark's commands to another
+    directory; without a directory, tracing gets disabled
+
+    Parameters
+    ==========
+    directory: 'str'
+        trace directory (None = no traces)
+
+    Returns
+    =======
+    """
+
+    with tracing_modules.tracing_config_lock:
+        tracing_config = read_config_section(
+            section_name="tracing_config",
+            defaults=tracing_modules.tracing_config_defaults,
+        )
+        tracing_config["enabled"] = bool(directory)
+        tracing_config["directory"] = directory or ""
+        tracing_modules.tracing_config = tracing_config
+
+
+def clear_caches():
+    with cache_registry_lock:
+        caches = list(cache_registry)
+    for cache in caches:
+        cache.clear()
+
+
+class BenchmarkBot:
+    """
+    Stand-in for the Telegram bot: accepts all messages and edits
+    immediately and counts them
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_message_id = 0
+        self.call_counter = Counter()
+
+    def send_message(self, chat_id, text, **kwargs):
+        return radiobot.observe_telegram_call(
+            "send_message", self.count_message, chat_id=chat_id
+        )
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return radiobot.observe_telegram_call("edit_message_text", self.count_edit)
+
+    def count_message(self, chat_id):
+        with self.lock:
+            self.next_message_id += 1
+            self.call_counter["send_message"] += 1
+            return SimpleNamespace(message_id=self.next_message_id, chat_id=chat_id)
+
+    def count_edit(self):
+        with self.lock:
+            self.call_counter["edit_message_text"] += 1
+        return True
+
+
+def get_percentile(values: list, percentile: float):
+    """
+    Nearest-rank percentile
+
+    Parameters
+    ==========
+    values: 'list'
+        sorted list of values
+    percentile: 'float'
+        percentile (0..100)
+
+    Returns
+    =======
+    value: 'float'
+        percentile value (or 0.0 for an empty list)
+    """
+
+    if not values:
+        return 0.0
+    rank = max(1, int(-(-percentile * len(values) // 100)))
+    return values[min(rank, len(values)) - 1]
+
+
+def run_sonde_benchmark(
+    emulator: UpstreamEmulator,
+    sonde_ids: list,
+    commands: int,
+    concurrency: int,
+    cold_caches: bool,
+):
+    """
+    Runs the bot's /sonde command against the upstream emulator
+
+    Parameters
+    ==========
+    emulator: 'UpstreamEmulator'
+        running upstream emulator
+    sonde_ids: 'list'
+        radiosonde IDs for each /sonde command
+    commands: 'int'
+        number of /sonde commands
+    concurrency: 'int'
+        number of chats that send commands in parallel
+    cold_caches: 'bool'
+        clear all caches before each command (only
+        meaningful for sequential commands)
+
+    Returns
+    =======
+    latencies: 'list'
+        sorted command latencies in seconds
+    call_counts: 'Counter'
+        number of upstream requests per endpoint
+    bot: 'BenchmarkBot'
+        Telegram stand-in with its message counters
+    """
+
+    bot = radiobot.outbox.bot
+
+    def run_command(command_number: int):
+        if cold_caches:
+            clear_caches()
+        update = SimpleNamespace(
+            effective_chat=SimpleNamespace(id=command_number % concurrency)
+        )
+        context = SimpleNamespace(bot=bot, args=list(sonde_ids))
+        start = time.perf_counter()
+        status, future = radiobot.command_scheduler.submit(
+            update.effective_chat.id,
+            radiobot.run_timed_command,
+            radiobot.sonde,
+            time.monotonic(),
+            update,
+            context,
+        )
+        if future:
+            future.result()
+        else:
+            bot.call_counter[f"rejected_{status}"] += 1
+        return time.perf_counter() - start
+
+    calls_before = emulator.get_call_counts()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        latencies = sorted(executor.map(run_command, range(commands)))
+    call_counts = emulator.get_call_counts()
+    call_counts.subtract(calls_before)
+    return latencies, +call_counts, bot
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="End-to-end /sonde latency benchmark against a local upstream emulator"
+    )
+    parser.add_argument(
+        "--sondes",
+        default="S1250118,N4120412",
+        help="comma-separated radiosonde IDs for each /sonde command",
+    )
+    parser.add_argument(
+        "--commands", type=int, default=20, help="number of /sonde commands"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="number of chats that send commands in parallel",
+    )
+    parser.add_argument(
+        "--cold-caches",
+        action="store_true",
+        help="clear all caches before each command",
+    )
+    parser.add_argument(
+        "--config",
+        default="radiosonde.cfg",
+        help="config file with the 'upstream_emulator' and bot settings",
+    )
+    parser.add_argument(
+        "--traces",
+        help="directory for the traces of the commands (default: no traces)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile all commands and log the hot spots",
+    )
+    parser.add_argument(
+        "--serve-only",
+        action="store_true",
+        help="only run the emulator, e.g. for manual tests",
+    )
+    args = parser.parse_args()
+
+    emulator_config = read_config_section(
+        section_name="upstream_emulator",
+        defaults=emulator_config_defaults,
+        config_file_name=args.config,
+    )
+    emulator = UpstreamEmulator(emulator_config=emulator_config)
+
+    if args.serve_only:
+        logger.info(f"Upstream emulator listening on {emulator.url}")
+        try:
+            emulator.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        exit(0)
+
+    emulator.start()
+    route_upstreams_to_emulator(emulator_url=emulator.url)
+    use_in_memory_geopy_cache(min_delay_seconds=emulator_config["nominatim_min_delay"])
+    track_directory = tempfile.TemporaryDirectory()
+    use_temporary_track_store(directory=track_directory.name)
+    use_trace_directory(directory=args.traces)
+
+    radiobot_config = read_config_section(
+        section_name="radiobot_config",
+        defaults=radiobot.radiobot_config_defaults,
+        config_file_name=args.config,
+    )
+    radiobot.aprsdotfi_api_key = "emulator"
+    radiobot.live_message_editing = radiobot_config["live_message_editing"]
+    radiobot.pipeline_scheduler = FairScheduler(
+        name="pipelines", worker_threads=radiobot_config["sonde_worker_threads"]
+    )
+    radiobot.command_scheduler = FairScheduler(
+        name="commands",
+        worker_threads=radiobot_config["command_worker_threads"],
+        max_queued=radiobot_config["max_queued_commands"],
+        max_queued_per_key=radiobot_config["max_queued_commands_per_chat"],
+        max_running_per_key=radiobot_config["max_running_commands_per_chat"],
+    )
+    radiobot.rendered_message_cache = ExpiringCache(
+        name="rendered_messages",
+        max_entries=1000,
+        default_ttl=radiobot_config["rendered_messages_ttl"],
+    )
+
+    profile_done = threading.Event()
+    if args.profile:
+        get_command_profiler().start(
+            commands=args.commands, report_callback=lambda report: profile_done.set()
+        )
+
+    sonde_ids = [sonde_id for sonde_id in args.sondes.split(",") if sonde_id]
+    # Telegram's flood limits don't apply to the stand-in bot unless
+    # the config file has an 'outbox_config' section
+    radiobot.outbox = Outbox(
+        bot=BenchmarkBot(),
+        outbox_config=read_config_section(
+            section_name="outbox_config",
+            defaults=outbox_config_defaults
+            | {"global_rate": 0.0, "chat_rate": 0.0, "group_chat_rate": 0.0},
+            config_file_name=args.config,
+        ),
+    )
+
+    latencies, call_counts, bot = run_sonde_benchmark(
+        emulator=emulator,
+        sonde_ids=sonde_ids,
+        commands=args.commands,
+        concurrency=args.concurrency,
+        cold_caches=args.cold_caches,
+    )
+    if args.profile:
+        profile_done.wait()
+    radiobot.outbox.flush(timeout=60)
+    radiobot.command_scheduler.shutdown(wait=False)
+    radiobot.pipeline_scheduler.shutdown(wait=False)
+    emulator.shutdown()
+    track_directory.cleanup()
+
+    logger.info(
+        f"{args.commands} /sonde commands for {len(sonde_ids)} sonde(s), concurrency {args.concurrency}"
+    )
+    logger.info(
+        f"command latency: p50 {get_percentile(latencies, 50):.3f}s, p95 {get_percentile(latencies, 95):.3f}s, p99 {get_percentile(latencies, 99):.3f}s, max {latencies[-1] if latencies else 0.0:.3f}s"
+    )
+    logger.info(
+        f"upstream calls per command: {sum(call_counts.values()) / max(1, args.commands):.2f}"
+    )
+    for endpoint, count in sorted(call_counts.items()):
+        logger.info(
+            f"  {endpoint}: {count / max(1, args.commands):.2f} per command ({count} total)"
+        )
+    logger.info(f"Telegram calls: {dict(bot.call_counter)}")
+    statistics = radiobot.outbox.get_statistics()
+    logger.info(
+        f"outbox: {statistics['sent']} sent, {statistics['merged']} merged, {statistics['superseded']} superseded, {statistics['retried']} retried, {statistics['failed']} failed"
+    )
+    for labels, count, average, p95 in telegram_delivery_seconds.get_summaries():
+        logger.info(
+            f"  {labels['lane']} delivery: {count} messages, avg {average:.3f}s, p95 ≤{p95:g}s"
+        )
+    for statistics in get_single_flight_statistics():
+        logger.info(
+            f"single flight '{statistics['name']}': {statistics['calls']} calls, {statistics['coalesced']} coalesced"
+        )
+    for statistics in get_scheduler_statistics():
+        logger.info(
+            f"scheduler '{statistics['name']}': max queue depth {statistics['max_queue_depth']}, wait time avg {statistics['wait_time_avg']:.3f}s, p95 {statistics['wait_time_p95']:.3f}s, max {statistics['wait_time_max']:.3f}s, rejected {statistics['rejected']}"
+        )
+    for statistics in get_upstream_statistics():
+        logger.info(
+            f"upstream '{statistics['name']}': {statistics['state']}, {statistics['requests']} requests, {statistics['failures']} failures, {statistics['rejected']} rejected, {statistics['hedged']} hedged ({statistics['hedge_wins']} won), read timeout {statistics['read_timeout']:.2f}s, latency p50 {statistics['latency_p50']:.3f}s, p95 {statistics['latency_p95']:.3f}s"
+        )
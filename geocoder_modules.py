@@ -0,0 +1,479 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: offline reverse geocoder. Loads a GeoNames places dump
+# into a k-d tree and answers "nearest locality, region, country"
+# for a lat/lon position without any network request
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+import math
+import threading
+import time
+import numpy as np
+from record_modules import NearestPlace
+from utility_modules import read_config_section, check_if_file_exists
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Default settings for the optional 'geocoder_config' config file section
+# places_file: GeoNames places dump, e.g. cities1000.txt from
+# https://download.geonames.org/export/dump/ (tab-separated; only
+# populated places, feature class 'P', are used). If the file does not
+# exist, the bot uses Nominatim for all reverse lookups
+# admin1_file / country_file: GeoNames admin1CodesASCII.txt and
+# countryInfo.txt; they provide the region and country names
+# min_population: ignore smaller places
+# max_distance_km: positions that are farther away from the nearest
+# place are not answered offline
+# nominatim: 'off' (offline results only), 'fallback' (Nominatim only
+# for positions that the offline geocoder cannot answer) or 'enrich'
+# (Nominatim's full address if it is already cached, otherwise the
+# offline result while Nominatim gets queried in the background)
+geocoder_config_defaults = {
+    "places_file": "cities1000.txt",
+    "admin1_file": "admin1CodesASCII.txt",
+    "country_file": "countryInfo.txt",
+    "min_population": 0,
+    "max_distance_km": 50.0,
+    "nominatim": "fallback",
+}
+
+# Mean earth radius in km
+earth_radius_km = 6371.0088
+
+# Max. number of places in a k-d tree leaf
+kd_tree_leaf_size = 16
+
+compass_points = ["N", "NE", "E", "SE", "S", "SW", "W", "NW"]
+
+offline_geocoder = None
+geocoder_config = None
+offline_geocoder_lock = threading.Lock()
+
+
+class PlaceIndex:
+    """
+    Static k-d tree over the places' positions as unit vectors. The
+    Euclidean (chord) distance between unit vectors grows with the
+    great circle distance, so the nearest neighbor in 3D is the
+    nearest place on the globe - without special cases at the poles
+    or at the date line
+    """
+
+    def __init__(self, latitudes, longitudes, leaf_size: int = kd_tree_leaf_size):
+        """
+        Parameters
+        ==========
+        latitudes / longitudes: 'numpy.ndarray'
+            positions of the places in degrees
+        leaf_size: 'int'
+            max. number of places per leaf
+        """
+        points = get_unit_vectors(
+            np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float)
+        )
+        order = np.arange(len(points))
+        self.leaf_size = max(1, leaf_size)
+        self._nodes = []
+        if len(points):
+            self._build(points, order, 0, len(points))
+        # the query runs in plain Python; lists are faster to index there
+        self._points = points[order].tolist()
+        self._order = order.tolist()
+
+    def __len__(self):
+        return len(self._order)
+
+    def _build(self, points, order, lo: int, hi: int):
+        node = len(self._nodes)
+        if hi - lo <= self.leaf_size:
+            self._nodes.append((lo, hi, -1, 0.0, -1, -1))
+            return node
+        self._nodes.append(None)
+        segment = points[order[lo:hi]]
+        axis = int(np.argmax(np.ptp(segment, axis=0)))
+        mid = (lo + hi) // 2
+        order[lo:hi] = order[lo:hi][
+            np.argpartition(segment[:, axis], mid - lo, kind="introselect")
+        ]
+        split = float(points[order[mid], axis])
+        left = self._build(points, order, lo, mid)
+        right = self._build(points, order, mid, hi)
+        self._nodes[node] = (lo, hi, axis, split, left, right)
+        return node
+
+    def query(self, latitude: float, longitude: float):
+        """
+        Finds the nearest place
+
+        Parameters
+        ==========
+        latitude / longitude: 'float'
+            position in degrees
+
+        Returns
+        =======
+        index: 'int'
+            index of the nearest place (-1 if the index is empty)
+        distance_km: 'float'
+            great circle distance to the nearest place
+        """
+
+        if not self._nodes:
+            return -1, math.inf
+        lat = math.radians(latitude)
+        lon = math.radians(longitude)
+        query = (
+            math.cos(lat) * math.cos(lon),
+            math.cos(lat) * math.sin(lon),
+            math.sin(lat),
+        )
+        qx, qy, qz = query
+        nodes = self._nodes
+        points = self._points
+        best_distance = math.inf
+        best_position = -1
+        stack = [(0, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if bound >= best_distance:
+                continue
+            lo, hi, axis, split, left, right = nodes[node]
+            if axis < 0:
+                for position in range(lo, hi):
+                    x, y, z = points[position]
+                    distance = (x - qx) ** 2 + (y - qy) ** 2 + (z - qz) ** 2
+                    if distance < best_distance:
+                        best_distance = distance
+                        best_position = position
+                continue
+            difference = query[axis] - split
+            near, far = (left, right) if difference < 0 else (right, left)
+            stack.append((far, difference * difference))
+            stack.append((near, bound))
+        chord = math.sqrt(best_distance)
+        return (
+            self._order[best_position],
+            2.0 * math.asin(min(1.0, chord / 2.0)) * earth_radius_km,
+        )
+
+
+class OfflineGeocoder:
+    """
+    Nearest populated place, region and country of a position
+    """
+
+    def __init__(
+        self,
+        names: list,
+        regions: list,
+        countries: list,
+        latitudes: list,
+        longitudes: list,
+        max_distance_km: float,
+    ):
+        """
+        Parameters
+        ==========
+        names / regions / countries: 'list'
+            place, region and country names (region and country may be None)
+        latitudes / longitudes: 'list'
+            positions of the places in degrees
+        max_distance_km: 'float'
+            positions that are farther away from the nearest place
+            are not answered
+        """
+        self.names = names
+        self.regions = regions
+        self.countries = countries
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.max_distance_km = max_distance_km
+        self.index = PlaceIndex(latitudes=latitudes, longitudes=longitudes)
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_nearest_place(self, latitude: float, longitude: float):
+        """
+        Finds the nearest populated place
+
+        Parameters
+        ==========
+        latitude / longitude: 'float'
+            position in degrees
+
+        Returns
+        =======
+        place: 'NearestPlace'
+            nearest place plus distance and bearing (from the place to
+            the position); None if there is no place within max_distance_km
+        """
+
+        index, distance_km = self.index.query(latitude, longitude)
+        if index < 0 or distance_km > self.max_distance_km:
+            return None
+        return NearestPlace(
+            name=self.names[index],
+            region=self.regions[index],
+            country=self.countries[index],
+            latitude=self.latitudes[index],
+            longitude=self.longitudes[index],
+            distance_km=distance_km,
+            bearing=get_bearing(
+                self.latitudes[index], self.longitudes[index], latitude, longitude
+            ),
+        )
+
+
+def get_unit_vectors(latitudes, longitudes):
+    """
+    Converts positions to unit vectors
+
+    Parameters
+    ==========
+    latitudes / longitudes: 'numpy.ndarray'
+        positions in degrees
+
+    Returns
+    =======
+    points: 'numpy.ndarray'
+        (n, 3) array of unit vectors
+    """
+
+    lat = np.radians(latitudes)
+    lon = np.radians(longitudes)
+    return np.column_stack(
+        (np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat))
+    )
+
+
+def get_bearing(
+    from_latitude: float, from_longitude: float, to_latitude: float, to_longitude: float
+):
+    """
+    Initial great circle bearing between two positions
+
+    Parameters
+    ==========
+    from_latitude / from_longitude: 'float'
+        start position in degrees
+    to_latitude / to_longitude: 'float'
+        end position in degrees
+
+    Returns
+    =======
+    bearing: 'float'
+        bearing in degrees (0 = north, 90 = east)
+    """
+
+    lat1 = math.radians(from_latitude)
+    lat2 = math.radians(to_latitude)
+    delta = math.radians(to_longitude - from_longitude)
+    x = math.sin(delta) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(
+        delta
+    )
+    return (math.degrees(math.atan2(x, y)) + 360.0) % 360.0
+
+
+def get_place_description(place: NearestPlace):
+    """
+    Renders a nearest place, e.g. '4.2 km NE of Halle (Saale),
+    Saxony-Anhalt, Germany'
+
+    Parameters
+    ==========
+    place: 'NearestPlace'
+        see OfflineGeocoder.get_nearest_place()
+
+    Returns
+    =======
+    description: 'str'
+        human-readable description
+    """
+
+    name = ", ".join(part for part in place if isinstance(part, str) and part)
+    if place.distance_km < 1.0:
+        return name
+    compass_point = compass_points[round(place.bearing / 45.0) % 8]
+    distance = (
+        f"{place.distance_km:.1f}"
+        if place.distance_km < 10.0
+        else f"{place.distance_km:.0f}"
+    )
+    return f"{distance} km {compass_point} of {name}"
+
+
+def load_geonames_names(file_name: str, key_column: int, name_column: int):
+    """
+    Loads a GeoNames code list, e.g. admin1CodesASCII.txt or
+    countryInfo.txt
+
+    Parameters
+    ==========
+    file_name: 'str'
+        tab-separated GeoNames file; lines starting with '#' are comments
+    key_column / name_column: 'int'
+        columns of the code and of the name
+
+    Returns
+    =======
+    names: 'dict'
+        names, keyed by code (empty if the file cannot be read)
+    """
+
+    names = {}
+    if not file_name or not check_if_file_exists(file_name):
+        return names
+    try:
+        with open(file_name, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                columns = line.rstrip("\n").split("\t")
+                if len(columns) > max(key_column, name_column):
+                    names[columns[key_column]] = columns[name_column]
+    except OSError:
+        logger.info(f"Cannot read GeoNames file {file_name}")
+    return names
+
+
+def load_offline_geocoder(config: dict):
+    """
+    Loads the GeoNames places dump and builds the offline geocoder
+
+    Parameters
+    ==========
+    config: 'dict'
+        'geocoder_config' settings
+
+    Returns
+    =======
+    offline_geocoder: 'OfflineGeocoder'
+        offline geocoder; None if the places file cannot be read
+    """
+
+    places_file = config["places_file"]
+    if not places_file or not check_if_file_exists(places_file):
+        logger.info(
+            f"No GeoNames places file {places_file}; using Nominatim for all reverse lookups"
+        )
+        return None
+
+    start = time.monotonic()
+    region_names = load_geonames_names(
+        file_name=config["admin1_file"], key_column=0, name_column=1
+    )
+    country_names = load_geonames_names(
+        file_name=config["country_file"], key_column=0, name_column=4
+    )
+    min_population = config["min_population"]
+
+    names, regions, countries, latitudes, longitudes = [], [], [], [], []
+    try:
+        with open(places_file, "r", encoding="utf-8") as f:
+            for line in f:
+                columns = line.split("\t")
+                if len(columns) < 15 or columns[6] != "P":
+                    continue
+                try:
+                    latitude = float(columns[4])
+                    longitude = float(columns[5])
+                    population = int(columns[14] or 0)
+                except ValueError:
+                    continue
+                if population < min_population:
+                    continue
+                country_code = columns[8]
+                names.append(columns[1])
+                regions.append(region_names.get(f"{country_code}.{columns[10]}"))
+                countries.append(country_names.get(country_code, country_code or None))
+                latitudes.append(latitude)
+                longitudes.append(longitude)
+    except OSError:
+        logger.info(f"Cannot read GeoNames places file {places_file}")
+        return None
+
+    geocoder = OfflineGeocoder(
+        names=names,
+        regions=regions,
+        countries=countries,
+        latitudes=latitudes,
+        longitudes=longitudes,
+        max_distance_km=config["max_distance_km"],
+    )
+    logger.info(
+        f"Loaded {len(geocoder)} places for offline reverse geocoding in {time.monotonic() - start:.1f}s"
+    )
+    return geocoder
+
+
+def get_geocoder_config():
+    """
+    Returns the 'geocoder_config' settings; they get read on first use
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    geocoder_config: 'dict'
+        see geocoder_config_defaults
+    """
+
+    global geocoder_config
+
+    with offline_geocoder_lock:
+        if geocoder_config is None:
+            geocoder_config = read_config_section(
+                section_name="geocoder_config", defaults=geocoder_config_defaults
+            )
+    return geocoder_config
+
+
+def get_offline_geocoder():
+    """
+    Returns the offline geocoder; it gets loaded on first use
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    offline_geocoder: 'OfflineGeocoder'
+        offline geocoder; None if no places file is available
+    """
+
+    global offline_geocoder
+
+    config = get_geocoder_config()
+    with offline_geocoder_lock:
+        if offline_geocoder is None:
+            offline_geocoder = load_offline_geocoder(config) or False
+    return offline_geocoder or None
+
+
+if __name__ == "__main__":
+    geocoder = get_offline_geocoder()
+    if geocoder:
+        place = geocoder.get_nearest_place(latitude=51.4821, longitude=11.9841)
+        logger.info(get_place_description(place) if place else "No place nearby")
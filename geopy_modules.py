@@ -20,14 +20,300 @@
 #
 
 from geopy.geocoders import Nominatim
+from geopy.adapters import RequestsAdapter
+from concurrent.futures import Future
+import atexit
+import json
 import logging
-import requests
+import os
+import queue
+import threading
+import time
+from http_modules import get_http_session, upstream_request_counter
+from cache_modules import ExpiringCache
+from tracing_modules import trace_span
+from geocoder_modules import (
+    get_geocoder_config,
+    get_offline_geocoder,
+    get_place_description,
+)
+from utility_modules import read_config_section, check_if_file_exists
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
 )
 logger = logging.getLogger(__name__)
 
+#
+# Default user agent for accessing aprs.fi, openstreetmap et al
+default_user_agent = f"radiosonde-telegram-bot (+https://github.com/joergschultzelutter/radiosonde-telegram-bot/)"
+
+# Default settings for the optional 'geopy_config' config file section
+# cache_precision: number of decimal places that lat/lon get rounded to
+# before the lookup; all positions within the same grid cell share one
+# address (4 decimal places = approx. 11 meters)
+# cache_max_entries / cache_ttl: size and entry lifetime (seconds) of
+# the reverse geocoding cache
+# cache_file: file that the cache gets persisted to; empty = in-memory only
+# cache_save_interval: persist the cache after this many new entries
+# min_delay_seconds: min delay between two requests to Nominatim (the
+# public Nominatim service permits max. 1 request per second)
+geopy_config_defaults = {
+    "cache_precision": 4,
+    "cache_max_entries": 10000,
+    "cache_ttl": 2592000.0,
+    "cache_file": "geopy_cache.json",
+    "cache_save_interval": 25,
+    "min_delay_seconds": 1.0,
+}
+
+geolocator = None
+geolocator_lock = threading.Lock()
+
+geopy_config = None
+geopy_cache = None
+geopy_cache_lock = threading.Lock()
+geopy_cache_unsaved_entries = 0
+
+# Outbound Nominatim requests. All lookups get serialized through one
+# worker thread which honors Nominatim's rate limit; identical lookups
+# that are already queued share the same pending request
+geocoder_queue = queue.Queue()
+geocoder_pending_lookups = {}
+geocoder_thread = None
+
+
+class SharedSessionRequestsAdapter(RequestsAdapter):
+    """
+    Geopy adapter which routes all Nominatim requests through
+    our shared, pooled HTTP session
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.session.close()
+        self.session = get_http_session()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # the shared session outlives this adapter; don't close it
+        pass
+
+    def __del__(self):
+        # the shared session outlives this adapter; don't close it
+        pass
+
+
+def get_geolocator():
+    """
+    Returns the shared Nominatim geolocator
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    geolocator: 'Nominatim'
+        Geopy Nominatim geolocator
+    """
+
+    global geolocator
+
+    with geolocator_lock:
+        if not geolocator:
+            geolocator = Nominatim(
+                user_agent=default_user_agent,
+                adapter_factory=SharedSessionRequestsAdapter,
+            )
+    return geolocator
+
+
+def get_geopy_cache():
+    """
+    Returns the reverse geocoding cache. The cache gets created on first
+    use, based on the 'geopy_config' config file section, and is
+    populated with the entries of its cache file
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    geopy_cache: 'ExpiringCache'
+        reverse geocoding cache
+    """
+
+    global geopy_cache, geopy_config
+
+    with geopy_cache_lock:
+        if geopy_cache is None:
+            geopy_config = read_config_section(
+                section_name="geopy_config", defaults=geopy_config_defaults
+            )
+            geopy_cache = ExpiringCache(
+                name="geopy",
+                max_entries=geopy_config["cache_max_entries"],
+                default_ttl=geopy_config["cache_ttl"],
+            )
+            load_geopy_cache(
+                cache=geopy_cache, cache_file_name=geopy_config["cache_file"]
+            )
+            atexit.register(save_geopy_cache)
+    return geopy_cache
+
+
+def load_geopy_cache(cache: ExpiringCache, cache_file_name: str):
+    """
+    Load the persisted reverse geocoding cache entries from disk
+
+    Parameters
+    ==========
+    cache: 'ExpiringCache'
+        Cache that we want to populate
+    cache_file_name: 'str'
+        cache file name
+
+    Returns
+    =======
+    """
+
+    if not cache_file_name or not check_if_file_exists(cache_file_name):
+        return
+    try:
+        with open(cache_file_name, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        cache.import_entries(
+            [(tuple(key), address, expires) for key, address, expires in entries]
+        )
+        logger.info(f"Loaded {len(cache)} reverse geocoding cache entries")
+    except (OSError, ValueError, TypeError):
+        logger.info(f"Cannot read reverse geocoding cache file {cache_file_name}")
+
+
+def save_geopy_cache():
+    """
+    Persist the reverse geocoding cache to disk. The file gets replaced
+    atomically so that an interrupted write won't corrupt it
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    """
+
+    global geopy_cache_unsaved_entries
+
+    if geopy_cache is None or not geopy_config["cache_file"]:
+        return
+    cache_file_name = geopy_config["cache_file"]
+    temp_file_name = cache_file_name + ".tmp"
+    with geopy_cache_lock:
+        geopy_cache_unsaved_entries = 0
+        try:
+            with open(temp_file_name, "w", encoding="utf-8") as f:
+                json.dump([list(entry) for entry in geopy_cache.export_entries()], f)
+            os.replace(temp_file_name, cache_file_name)
+        except OSError:
+            logger.info(f"Cannot write reverse geocoding cache file {cache_file_name}")
+
+
+def get_geopy_cache_key(latitude: float, longitude: float, language: str):
+    """
+    Snaps lat/lon to the cache grid
+
+    Parameters
+    ==========
+    latitude: 'float'
+        Latitude
+    longitude: 'float'
+        Longitude
+    language: 'str'
+        iso3166-2 language code
+
+    Returns
+    =======
+    cache_key: 'tuple'
+        rounded latitude, rounded longitude, language
+    """
+
+    get_geopy_cache()
+    precision = geopy_config["cache_precision"]
+    return (
+        round(float(latitude), precision),
+        round(float(longitude), precision),
+        language.lower(),
+    )
+
+
+def get_geopy_cache_statistics():
+    """
+    Returns the hit/miss statistics of the reverse geocoding cache
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    statistics: 'dict'
+        see ExpiringCache.get_statistics()
+    """
+
+    return get_geopy_cache().get_statistics()
+
+
+def run_geocoder_queue():
+    """
+    Worker thread: processes the queued Nominatim lookups one at a
+    time while honoring Nominatim's rate limit
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    """
+
+    global geopy_cache_unsaved_entries
+
+    last_request = 0.0
+    while True:
+        cache_key, future = geocoder_queue.get()
+        latitude, longitude, language = cache_key
+
+        delay = last_request + geopy_config["min_delay_seconds"] - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        success = False
+        address = None
+        try:
+            # Lookup with zoom level 18 (building)
+            location = get_geolocator().reverse(
+                query=f"{latitude} {longitude}",
+                language=language,
+                zoom=18,
+                addressdetails=True,
+                exactly_one=True,
+            )
+            success = True
+            if location:
+                address = location.address
+
+            get_geopy_cache().set(cache_key, address)
+            geopy_cache_unsaved_entries += 1
+            if geopy_cache_unsaved_entries >= geopy_config["cache_save_interval"]:
+                save_geopy_cache()
+        except:
+            if not success:
+                logger.info(
+                    f"Cannot get reverse geocoding data for {latitude} {longitude}"
+                )
+        finally:
+            last_request = time.monotonic()
+            with geopy_cache_lock:
+                geocoder_pending_lookups.pop(cache_key, None)
+        future.set_result((success, address))
+
 
 def get_reverse_geopy_data(
     latitude: float,
@@ -35,7 +321,12 @@ def get_reverse_geopy_data(
     language: str = "en",
 ):
     """
-    Get human-readable address data for a lat/lon combination
+    Get human-readable address data for a lat/lon combination. The
+    offline geocoder answers with the nearest place, region and
+    country; Nominatim provides the full address, depending on the
+    'nominatim' setting of the 'geocoder_config' config file section
+
+    Parameters
     ==========
     latitude: 'float'
         Latitude
@@ -49,35 +340,82 @@ def get_reverse_geopy_data(
     success: 'bool'
         True if query was successful
     address: 'str'
-        full-blown address information from OSM
+        full-blown address information from OSM or the
+        nearest place from the offline geocoder
     """
 
-    address = None
+    nominatim = get_geocoder_config()["nominatim"]
+    place = None
+    offline_geocoder = get_offline_geocoder()
+    if offline_geocoder:
+        with trace_span("offline_geocode"):
+            place = offline_geocoder.get_nearest_place(
+                latitude=float(latitude), longitude=float(longitude)
+            )
+        if place and nominatim != "enrich":
+            return True, get_place_description(place)
+        if nominatim == "off":
+            return place is not None, place and get_place_description(place)
 
-    #
-    # Default user agent for accessing aprs.fi, openstreetmap et al
-    default_user_agent = f"radiosonde-telegram-bot (+https://github.com/joergschultzelutter/radiosonde-telegram-bot/)"
+    # lat/lon get snapped to the cache grid; the lookup itself is
+    # executed for the snapped grid position
+    cache_key = get_geopy_cache_key(
+        latitude=latitude, longitude=longitude, language=language
+    )
+    found_in_cache, address = get_geopy_cache().get(cache_key)
+    if found_in_cache:
+        return True, address
 
-    # Geopy Nominatim user agent
-    geolocator = Nominatim(user_agent=default_user_agent)
-
-    success = True
-    try:
-        # Lookup with zoom level 18 (building)
-        location = geolocator.reverse(
-            query=f"{latitude} {longitude}",
-            language=language,
-            zoom=18,
-            addressdetails=True,
-            exactly_one=True,
-        )
-    except:
-        location = None
-        success = False
-    if location:
-        address = location.address
+    future = queue_nominatim_lookup(cache_key=cache_key)
+    if place:
+        # Nominatim's address will be in the cache next time
+        return True, get_place_description(place)
 
+    # the span includes the wait for Nominatim's rate limit
+    with trace_span("nominatim_lookup"):
+        success, address = future.result()
     return success, address
 
+
+def queue_nominatim_lookup(cache_key: tuple):
+    """
+    Queues a Nominatim lookup for our rate-limited worker - unless
+    the very same lookup has already been queued
+
+    Parameters
+    ==========
+    cache_key: 'tuple'
+        see get_geopy_cache_key()
+
+    Returns
+    =======
+    future: 'Future'
+        future of the (success, address) lookup result
+    """
+
+    global geocoder_thread
+
+    # Queue the lookup for our rate-limited worker - unless
+    # the very same lookup has already been queued
+    with geopy_cache_lock:
+        future = geocoder_pending_lookups.get(cache_key)
+        if not future:
+            future = Future()
+            geocoder_pending_lookups[cache_key] = future
+            geocoder_queue.put((cache_key, future))
+            # The request is sent from the worker thread, outside of the
+            # caller's context; count it for the caller right away (also
+            # if the caller does not wait for the result)
+            request_counter = upstream_request_counter.get()
+            if request_counter is not None:
+                request_counter["nominatim"] += 1
+        if not geocoder_thread:
+            geocoder_thread = threading.Thread(
+                target=run_geocoder_queue, name="geocoder", daemon=True
+            )
+            geocoder_thread.start()
+    return future
+
+
 if __name__ == "__main__":
     logger.info(get_reverse_geopy_data(latitude=37.7790262, longitude=-122.4199061))
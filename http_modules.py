@@ -0,0 +1,731 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: shared, pooled HTTP session for all upstream web sites
+# (aprs.fi, predict.habhub.org, radiosondy.info, openstreetmap) with
+# per-upstream timeouts, circuit breakers and hedged requests
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from utility_modules import read_config_section
+from metrics_modules import (
+    register_collector,
+    upstream_errors_total,
+    upstream_request_seconds,
+)
+from tracing_modules import trace_span
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Default settings for the optional 'http_config' config file section
+# pool_connections: number of per-host connection pools that we keep
+# pool_maxsize: max number of keep-alive connections per host
+# connect_timeout / read_timeout: default timeouts in seconds; used
+# for every request that does not specify its own timeout
+# max_retries: number of retries on connection errors
+http_config_defaults = {
+    "pool_connections": 10,
+    "pool_maxsize": 10,
+    "connect_timeout": 5.0,
+    "read_timeout": 30.0,
+    "max_retries": 0,
+}
+
+http_session = None
+http_session_lock = threading.Lock()
+
+# Upstream web sites, keyed by host name
+upstream_hosts = {
+    "api.aprs.fi": "aprsdotfi",
+    "predict.habhub.org": "habhub",
+    "radiosondy.info": "radiosondy",
+    "nominatim.openstreetmap.org": "nominatim",
+}
+
+# Default settings for the optional 'upstream_policy' config file section
+# <upstream>_min_timeout / <upstream>_max_timeout: limits for the read
+# timeout of an upstream. Within these limits, the timeout is
+# timeout_factor times the 95th percentile of the recent response times
+# (max_timeout until min_latency_samples responses have been measured)
+# <upstream>_failure_threshold: consecutive failures (errors, timeouts,
+# HTTP 5xx) after which the circuit breaker opens and all requests to
+# the upstream fail immediately (0 disables the circuit breaker)
+# <upstream>_open_seconds: min time that the circuit breaker stays open;
+# afterwards, a canary request to <upstream>_canary_url is sent every
+# canary_interval seconds until the upstream responds again
+# <upstream>_hedge_delay: send a second, identical GET request if the
+# first one has not been answered after this many seconds; the first
+# response wins (0 disables hedging)
+upstream_policy_defaults = {
+    "timeout_factor": 4.0,
+    "latency_samples": 100,
+    "min_latency_samples": 10,
+    "canary_interval": 15.0,
+    "aprsdotfi_min_timeout": 2.0,
+    "aprsdotfi_max_timeout": 10.0,
+    "aprsdotfi_failure_threshold": 5,
+    "aprsdotfi_open_seconds": 30.0,
+    "aprsdotfi_canary_url": "https://api.aprs.fi/api/get?what=loc&format=json",
+    "aprsdotfi_hedge_delay": 0.0,
+    "habhub_min_timeout": 5.0,
+    "habhub_max_timeout": 30.0,
+    "habhub_failure_threshold": 5,
+    "habhub_open_seconds": 60.0,
+    "habhub_canary_url": "http://predict.habhub.org/",
+    "habhub_hedge_delay": 0.0,
+    "radiosondy_min_timeout": 5.0,
+    "radiosondy_max_timeout": 30.0,
+    "radiosondy_failure_threshold": 5,
+    "radiosondy_open_seconds": 60.0,
+    "radiosondy_canary_url": "https://radiosondy.info/",
+    "radiosondy_hedge_delay": 0.0,
+    "nominatim_min_timeout": 2.0,
+    "nominatim_max_timeout": 10.0,
+    "nominatim_failure_threshold": 5,
+    "nominatim_open_seconds": 60.0,
+    "nominatim_canary_url": "https://nominatim.openstreetmap.org/status.php",
+    "nominatim_hedge_delay": 0.0,
+}
+
+# Endpoints of the upstream web sites, for the metrics: (upstream name,
+# URL path fragment, endpoint name); the first match wins. Requests
+# that do not match any of them are reported under the upstream name
+upstream_endpoints = [
+    ("habhub", "ajax.php", "habhub_submit"),
+    ("habhub", "kml.php", "habhub_kml"),
+    ("radiosondy", "/dyn/", "radiosondy_dyn"),
+    ("radiosondy", "sonde_archive.php", "radiosondy_archive"),
+    ("radiosondy", "sonde.php", "radiosondy_main"),
+]
+
+upstream_policies = None
+upstream_policies_lock = threading.Lock()
+
+# Threads for hedged requests
+hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+# Requests from the canary thread bypass the circuit breakers
+canary_context = threading.local()
+
+# Callers can count the upstream requests that are sent on their
+# behalf by setting this to a Counter (keyed by upstream name)
+upstream_request_counter = contextvars.ContextVar(
+    "upstream_request_counter", default=None
+)
+
+
+class UpstreamUnavailableError(requests.exceptions.ConnectionError):
+    """
+    Raised instead of sending a request to an upstream
+    whose circuit breaker is open
+    """
+
+
+class UpstreamPolicy:
+    """
+    Timeout, circuit breaker and hedging settings of an upstream web
+    site, plus the response time and failure bookkeeping they need
+    """
+
+    def __init__(self, name: str, policy_config: dict):
+        """
+        Parameters
+        ==========
+        name: 'str'
+            upstream name, e.g. 'radiosondy'
+        policy_config: 'dict'
+            'upstream_policy' settings
+        """
+        self.name = name
+        self.min_timeout = policy_config[f"{name}_min_timeout"]
+        self.max_timeout = max(self.min_timeout, policy_config[f"{name}_max_timeout"])
+        self.failure_threshold = policy_config[f"{name}_failure_threshold"]
+        self.open_seconds = policy_config[f"{name}_open_seconds"]
+        self.canary_url = policy_config[f"{name}_canary_url"]
+        self.hedge_delay = policy_config[f"{name}_hedge_delay"]
+        self.timeout_factor = policy_config["timeout_factor"]
+        self.min_latency_samples = policy_config["min_latency_samples"]
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=max(1, policy_config["latency_samples"]))
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.requests = self.failures = self.rejected = 0
+        self.hedged = self.hedge_wins = 0
+
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None
+
+    def allow_request(self):
+        """
+        Checks the circuit breaker
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        allowed: 'bool'
+            False if the request must fail immediately
+        """
+        if getattr(canary_context, "active", False):
+            return True
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            self.rejected += 1
+            return False
+
+    def get_read_timeout(self):
+        """
+        Read timeout based on the recent response times
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        timeout: 'float'
+            read timeout in seconds
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_latency_samples:
+                return self.max_timeout
+            latencies = sorted(self._latencies)
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        return min(self.max_timeout, max(self.min_timeout, p95 * self.timeout_factor))
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(latency)
+            self.consecutive_failures = 0
+            if self.opened_at is not None:
+                logger.info(f"Upstream '{self.name}' has recovered")
+                self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.requests += 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            if (
+                self.failure_threshold
+                and self.opened_at is None
+                and self.consecutive_failures >= self.failure_threshold
+            ):
+                logger.info(
+                    f"Upstream '{self.name}' has failed {self.consecutive_failures} times in a row; opening its circuit breaker"
+                )
+                self.opened_at = time.monotonic()
+
+    def record_hedge(self):
+        with self._lock:
+            self.hedged += 1
+
+    def record_hedge_win(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def is_canary_due(self, now: float, last_canary: float, canary_interval: float):
+        with self._lock:
+            return (
+                self.opened_at is not None
+                and now - self.opened_at >= self.open_seconds
+                and now - last_canary >= canary_interval
+            )
+
+    def get_statistics(self):
+        """
+        Get the upstream's statistics
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        statistics: 'dict'
+            name, state ('closed' / 'open'), requests, failures,
+            rejected, consecutive_failures, hedged (number of hedged
+            requests), hedge_wins (hedges that answered first),
+            read_timeout and the response time percentiles p50 / p95
+        """
+        read_timeout = self.get_read_timeout()
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                "name": self.name,
+                "state": "closed" if self.opened_at is None else "open",
+                "requests": self.requests,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "consecutive_failures": self.consecutive_failures,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "read_timeout": read_timeout,
+                "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+                "latency_p95": (
+                    latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+                    if latencies
+                    else 0.0
+                ),
+            }
+
+
+def get_upstream_policies():
+    """
+    Returns the policies of all upstream web sites. They get created
+    on first use, based on the 'upstream_policy' config file section;
+    this also starts the canary thread
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    upstream_policies: 'dict'
+        UpstreamPolicy objects, keyed by upstream name
+    """
+
+    global upstream_policies
+
+    with upstream_policies_lock:
+        if upstream_policies is None:
+            policy_config = read_config_section(
+                section_name="upstream_policy", defaults=upstream_policy_defaults
+            )
+            upstream_policies = {
+                name: UpstreamPolicy(name=name, policy_config=policy_config)
+                for name in upstream_hosts.values()
+            }
+            threading.Thread(
+                target=run_canaries,
+                kwargs={
+                    "policies": upstream_policies,
+                    "canary_interval": policy_config["canary_interval"],
+                },
+                name="canary",
+                daemon=True,
+            ).start()
+    return upstream_policies
+
+
+def get_upstream_policy(request):
+    """
+    Returns the policy of the upstream web site that a request is for
+
+    Parameters
+    ==========
+    request: 'requests.PreparedRequest'
+        HTTP request
+
+    Returns
+    =======
+    policy: 'UpstreamPolicy'
+        policy of the upstream (or None if the request
+        is not for one of our upstream web sites)
+    """
+
+    host = request.headers.get("Host") or urlsplit(request.url).netloc
+    name = upstream_hosts.get(host.split(":")[0].lower())
+    if not name:
+        return None
+    return get_upstream_policies()[name]
+
+
+def get_upstream_endpoint(name: str, url: str):
+    """
+    Returns the endpoint name of an upstream request for the metrics
+
+    Parameters
+    ==========
+    name: 'str'
+        upstream name, e.g. 'habhub'
+    url: 'str'
+        request URL
+
+    Returns
+    =======
+    endpoint: 'str'
+        endpoint name, e.g. 'habhub_kml'
+    """
+
+    path = urlsplit(url).path
+    for upstream, path_fragment, endpoint in upstream_endpoints:
+        if upstream == name and path_fragment in path:
+            return endpoint
+    return name
+
+
+def run_canaries(policies: dict, canary_interval: float):
+    """
+    Canary thread: probes the upstreams with an open circuit breaker;
+    a successful probe closes the circuit breaker again
+
+    Parameters
+    ==========
+    policies: 'dict'
+        UpstreamPolicy objects, keyed by upstream name
+    canary_interval: 'float'
+        seconds between two probes of the same upstream
+
+    Returns
+    =======
+    """
+
+    canary_context.active = True
+    last_canaries = dict.fromkeys(policies, 0.0)
+    while True:
+        time.sleep(1.0)
+        for name, policy in policies.items():
+            now = time.monotonic()
+            if not policy.is_canary_due(now, last_canaries[name], canary_interval):
+                continue
+            last_canaries[name] = now
+            logger.info(f"Sending canary request to upstream '{name}'")
+            try:
+                get_http_session().get(policy.canary_url).close()
+            except Exception:
+                logger.info(f"Upstream '{name}' is still unavailable")
+
+
+# Counters of connection pools which have been discarded by the pool
+# manager; their numbers still need to be part of our statistics
+discarded_pool_statistics = {"connections_opened": 0, "requests": 0}
+discarded_pool_statistics_lock = threading.Lock()
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter with a default (connect, read) timeout and
+    connection pool accounting
+    """
+
+    def __init__(self, timeout: tuple, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+
+        # Keep the counters of a host pool before the pool manager
+        # closes it, e.g. because it ran out of pool slots
+        pools = self.poolmanager.pools
+        dispose_func = pools.dispose_func
+
+        def dispose_pool(pool):
+            with discarded_pool_statistics_lock:
+                discarded_pool_statistics["connections_opened"] += getattr(
+                    pool, "num_connections", 0
+                )
+                discarded_pool_statistics["requests"] += getattr(
+                    pool, "num_requests", 0
+                )
+            if dispose_func:
+                dispose_func(pool)
+
+        pools.dispose_func = dispose_pool
+
+    def send(self, request, **kwargs):
+        policy = get_upstream_policy(request)
+        if policy is None:
+            if kwargs.get("timeout") is None:
+                kwargs["timeout"] = self.timeout
+            return super().send(request, **kwargs)
+
+        endpoint = get_upstream_endpoint(policy.name, request.url)
+        with trace_span(endpoint, method=request.method) as span:
+            if not policy.allow_request():
+                upstream_errors_total.inc(
+                    upstream=policy.name, endpoint=endpoint, reason="unavailable"
+                )
+                raise UpstreamUnavailableError(
+                    f"Upstream '{policy.name}' is unavailable", request=request
+                )
+            if kwargs.get("timeout") is None:
+                kwargs["timeout"] = (self.timeout[0], policy.get_read_timeout())
+            if request.method == "GET" and policy.hedge_delay > 0:
+                response = self.send_hedged(policy, request, **kwargs)
+            else:
+                count_upstream_request(policy)
+                response = self.send_measured(policy, request, **kwargs)
+            span.set_attribute("status_code", response.status_code)
+            return response
+
+    def send_measured(self, policy: UpstreamPolicy, request, **kwargs):
+        # Sends a request and updates the upstream's bookkeeping
+        endpoint = get_upstream_endpoint(policy.name, request.url)
+        start = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.exceptions.Timeout:
+            policy.record_failure()
+            upstream_errors_total.inc(
+                upstream=policy.name, endpoint=endpoint, reason="timeout"
+            )
+            raise
+        except Exception:
+            policy.record_failure()
+            upstream_errors_total.inc(
+                upstream=policy.name, endpoint=endpoint, reason="connection"
+            )
+            raise
+        latency = time.monotonic() - start
+        upstream_request_seconds.observe(
+            latency, upstream=policy.name, endpoint=endpoint
+        )
+        if response.status_code >= 500:
+            policy.record_failure()
+            upstream_errors_total.inc(
+                upstream=policy.name, endpoint=endpoint, reason="http_5xx"
+            )
+        else:
+            policy.record_success(latency)
+        return response
+
+    def send_hedged(self, policy: UpstreamPolicy, request, **kwargs):
+        # Sends a second request if the first one is slow; the
+        # first successful response wins, the other one gets closed.
+        # Both requests are counted here, in the caller's context
+        count_upstream_request(policy)
+        attempts = [
+            hedge_executor.submit(self.send_measured, policy, request, **kwargs)
+        ]
+        done, _ = wait(attempts, timeout=policy.hedge_delay)
+        if not done and policy.allow_request():
+            policy.record_hedge()
+            count_upstream_request(policy)
+            attempts.append(
+                hedge_executor.submit(
+                    self.send_measured, policy, request.copy(), **kwargs
+                )
+            )
+
+        error = None
+        pending = set(attempts)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            responses = []
+            for attempt in done:
+                try:
+                    responses.append((attempt, attempt.result()))
+                except Exception as exception:
+                    error = exception
+            if not responses:
+                continue
+            winner, response = responses[0]
+            for _, other_response in responses[1:]:
+                other_response.close()
+            for attempt in pending:
+                attempt.add_done_callback(close_hedged_response)
+            if winner is not attempts[0]:
+                policy.record_hedge_win()
+            return response
+        raise error
+
+
+def count_upstream_request(policy: UpstreamPolicy):
+    # Adds a request to the caller's upstream_request_counter (if any)
+    request_counter = upstream_request_counter.get()
+    if request_counter is not None:
+        request_counter[policy.name] += 1
+
+
+def close_hedged_response(attempt):
+    # Done callback for the losing request of a hedged pair
+    if not attempt.cancelled() and attempt.exception() is None:
+        attempt.result().close()
+
+
+def get_upstream_statistics():
+    """
+    Get the statistics of all upstream web sites
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    statistics: 'list'
+        List of statistics dictionaries, one per upstream
+        (see UpstreamPolicy.get_statistics())
+    """
+    return [policy.get_statistics() for policy in get_upstream_policies().values()]
+
+
+def collect_upstream_metrics():
+    """
+    Metrics collector for the circuit breakers, the adaptive
+    timeouts and the connection pool of the shared HTTP session
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    families: 'list'
+        see metrics_modules.register_collector()
+    """
+
+    upstreams = get_upstream_statistics()
+    http_statistics = get_http_statistics()
+    return [
+        (
+            "radiobot_upstream_circuit_open",
+            "gauge",
+            "1 if the upstream's circuit breaker is open",
+            [
+                ({"upstream": upstream["name"]}, int(upstream["state"] == "open"))
+                for upstream in upstreams
+            ],
+        ),
+        (
+            "radiobot_upstream_read_timeout_seconds",
+            "gauge",
+            "Current read timeout of the upstream",
+            [
+                ({"upstream": upstream["name"]}, upstream["read_timeout"])
+                for upstream in upstreams
+            ],
+        ),
+        (
+            "radiobot_upstream_hedged_total",
+            "counter",
+            "Hedged requests to the upstream",
+            [
+                ({"upstream": upstream["name"]}, upstream["hedged"])
+                for upstream in upstreams
+            ],
+        ),
+        (
+            "radiobot_http_connections_opened_total",
+            "counter",
+            "Connections opened by the shared HTTP session",
+            [({}, http_statistics["connections_opened"])],
+        ),
+        (
+            "radiobot_http_connections_reused_total",
+            "counter",
+            "Requests served through a keep-alive connection",
+            [({}, http_statistics["connections_reused"])],
+        ),
+    ]
+
+
+def get_http_session():
+    """
+    Returns the shared HTTP session. The session keeps a pool of
+    keep-alive connections per host and applies the configured
+    connect and read timeouts to each request. It gets created on
+    first use, based on the 'http_config' config file section.
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    http_session: 'requests.Session'
+        shared HTTP session
+    """
+
+    global http_session
+
+    with http_session_lock:
+        if not http_session:
+            http_config = read_config_section(
+                section_name="http_config", defaults=http_config_defaults
+            )
+            session = requests.Session()
+            for prefix in ("http://", "https://"):
+                session.mount(
+                    prefix,
+                    PooledHTTPAdapter(
+                        timeout=(
+                            http_config["connect_timeout"],
+                            http_config["read_timeout"],
+                        ),
+                        pool_connections=http_config["pool_connections"],
+                        pool_maxsize=http_config["pool_maxsize"],
+                        max_retries=http_config["max_retries"],
+                    ),
+                )
+            http_session = session
+    return http_session
+
+
+def get_http_statistics():
+    """
+    Returns the connection statistics of the shared HTTP session
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    http_statistics: 'dict'
+        requests: total number of HTTP requests
+        connections_opened: number of newly established connections
+        connections_reused: number of requests which were served
+        through an already established keep-alive connection
+        hosts: number of hosts with an active connection pool
+    """
+
+    session = get_http_session()
+
+    with discarded_pool_statistics_lock:
+        connections_opened = discarded_pool_statistics["connections_opened"]
+        num_requests = discarded_pool_statistics["requests"]
+
+    hosts = 0
+    for adapter in session.adapters.values():
+        poolmanager = getattr(adapter, "poolmanager", None)
+        if not poolmanager:
+            continue
+        for key in poolmanager.pools.keys():
+            pool = poolmanager.pools.get(key)
+            if pool:
+                hosts += 1
+                connections_opened += getattr(pool, "num_connections", 0)
+                num_requests += getattr(pool, "num_requests", 0)
+
+    return {
+        "requests": num_requests,
+        "connections_opened": connections_opened,
+        "connections_reused": max(0, num_requests - connections_opened),
+        "hosts": hosts,
+    }
+
+
+register_collector(collect_upstream_metrics)
+
+
+if __name__ == "__main__":
+    for _ in range(3):
+        get_http_session().get("https://radiosondy.info/")
+    logger.info(get_http_statistics())
@@ -0,0 +1,504 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: counters and latency histograms for the bot's upstream
+# requests, commands and Telegram calls, plus a local HTTP endpoint
+# which serves them in the Prometheus text format
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cache_modules import get_cache_statistics, get_single_flight_statistics
+from scheduler_modules import get_scheduler_statistics
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Default settings for the optional 'metrics_config' config file section
+# http_port: port of the Prometheus scrape endpoint (0 = disabled)
+# http_address: address that the scrape endpoint listens on
+metrics_config_defaults = {
+    "http_port": 0,
+    "http_address": "127.0.0.1",
+}
+
+# Upper bounds (seconds) of the latency histogram buckets
+default_latency_buckets = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+# All counters and histograms, keyed by metric name
+metric_registry = {}
+metric_registry_lock = threading.Lock()
+
+# Functions which return the current values of gauges and counters
+# that other modules keep anyway (cache, scheduler statistics etc.)
+metric_collectors = []
+
+metrics_server = None
+
+
+class Metric:
+    """
+    Base class for counters and histograms; keeps one series per
+    combination of label values
+    """
+
+    metric_type = None
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        """
+        Parameters
+        ==========
+        name: 'str'
+            metric name, e.g. 'radiobot_upstream_errors_total'
+        documentation: 'str'
+            help text
+        label_names: 'tuple'
+            label names, e.g. ('upstream', 'endpoint')
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+
+        with metric_registry_lock:
+            metric_registry[name] = self
+
+    def _get_label_values(self, labels: dict):
+        return tuple(str(labels.get(label_name, "")) for label_name in self.label_names)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing counter
+    """
+
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def get_samples(self):
+        with self._lock:
+            return [
+                (dict(zip(self.label_names, label_values)), value)
+                for label_values, value in self._series.items()
+            ]
+
+
+class Histogram(Metric):
+    """
+    Histogram with fixed bucket bounds, e.g. for latencies
+    """
+
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple = (),
+        buckets: tuple = default_latency_buckets,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names)
+
+    def observe(self, value: float, **labels):
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # per-bucket (not cumulative) counts; the last one is +Inf
+                series = self._series[label_values] = [
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                ]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def get_samples(self):
+        samples = []
+        with self._lock:
+            for label_values, (bucket_counts, total) in self._series.items():
+                labels = dict(zip(self.label_names, label_values))
+                cumulative_count = 0
+                for bound, bucket_count in zip(
+                    self.buckets + (float("inf"),), bucket_counts
+                ):
+                    cumulative_count += bucket_count
+                    samples.append(
+                        (
+                            "_bucket",
+                            {**labels, "le": format_value(bound)},
+                            cumulative_count,
+                        )
+                    )
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, cumulative_count))
+        return samples
+
+    def get_summaries(self):
+        """
+        Summarizes each series of the histogram
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        summaries: 'list'
+            List of (labels, count, average, p95) tuples; the 95th
+            percentile is the upper bound of its bucket
+        """
+        summaries = []
+        with self._lock:
+            for label_values, (bucket_counts, total) in self._series.items():
+                count = sum(bucket_counts)
+                if not count:
+                    continue
+                p95 = float("inf")
+                cumulative_count = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative_count += bucket_count
+                    if cumulative_count >= 0.95 * count:
+                        p95 = bound
+                        break
+                summaries.append(
+                    (
+                        dict(zip(self.label_names, label_values)),
+                        count,
+                        total / count,
+                        p95,
+                    )
+                )
+        return summaries
+
+
+class MetricTimer:
+    """
+    Context manager which observes its duration in a histogram
+    """
+
+    def __init__(self, histogram: Histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+        return False
+
+
+# Metrics that are recorded by several modules
+upstream_request_seconds = Histogram(
+    "radiobot_upstream_request_seconds",
+    "Response times of the upstream web sites",
+    ("upstream", "endpoint"),
+)
+upstream_errors_total = Counter(
+    "radiobot_upstream_errors_total",
+    "Failed upstream requests (reason: timeout, connection, http_5xx, unavailable)",
+    ("upstream", "endpoint", "reason"),
+)
+command_seconds = Histogram(
+    "radiobot_command_seconds",
+    "End-to-end latency of the bot commands, including their queue wait time",
+    ("command",),
+)
+telegram_request_seconds = Histogram(
+    "radiobot_telegram_request_seconds",
+    "Response times of the Telegram API",
+    ("method",),
+)
+telegram_errors_total = Counter(
+    "radiobot_telegram_errors_total",
+    "Failed Telegram API calls (reason: retry_after for HTTP 429, error)",
+    ("method", "reason"),
+)
+telegram_delivery_seconds = Histogram(
+    "radiobot_telegram_delivery_seconds",
+    "Time from queueing an outbound message until Telegram has accepted it",
+    ("lane",),
+)
+
+
+def register_collector(collector):
+    """
+    Registers a function which returns metric families on demand
+
+    Parameters
+    ==========
+    collector: 'callable'
+        function without parameters which returns a list of
+        (name, type, documentation, samples) tuples; samples is
+        a list of (labels, value) tuples
+
+    Returns
+    =======
+    """
+    with metric_registry_lock:
+        metric_collectors.append(collector)
+
+
+def collect_statistics():
+    """
+    Collector for the statistics of the caches, single flight
+    groups and schedulers
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    families: 'list'
+        see register_collector()
+    """
+
+    caches = get_cache_statistics()
+    groups = get_single_flight_statistics()
+    schedulers = get_scheduler_statistics()
+    return [
+        (
+            "radiobot_cache_hits_total",
+            "counter",
+            "Cache hits",
+            [({"cache": cache["name"]}, cache["hits"]) for cache in caches],
+        ),
+        (
+            "radiobot_cache_misses_total",
+            "counter",
+            "Cache misses",
+            [({"cache": cache["name"]}, cache["misses"]) for cache in caches],
+        ),
+        (
+            "radiobot_cache_hit_ratio",
+            "gauge",
+            "Share of cache lookups that were hits",
+            [({"cache": cache["name"]}, cache["hit_ratio"]) for cache in caches],
+        ),
+        (
+            "radiobot_cache_entries",
+            "gauge",
+            "Number of cache entries",
+            [({"cache": cache["name"]}, cache["entries"]) for cache in caches],
+        ),
+        (
+            "radiobot_single_flight_calls_total",
+            "counter",
+            "Calls which were executed by a single flight group",
+            [({"group": group["name"]}, group["calls"]) for group in groups],
+        ),
+        (
+            "radiobot_single_flight_coalesced_total",
+            "counter",
+            "Calls which shared the result of a concurrent call",
+            [({"group": group["name"]}, group["coalesced"]) for group in groups],
+        ),
+        (
+            "radiobot_scheduler_queued",
+            "gauge",
+            "Number of queued scheduler tasks",
+            [
+                ({"scheduler": scheduler["name"]}, scheduler["queued"])
+                for scheduler in schedulers
+            ],
+        ),
+        (
+            "radiobot_scheduler_running",
+            "gauge",
+            "Number of running scheduler tasks",
+            [
+                ({"scheduler": scheduler["name"]}, scheduler["running"])
+                for scheduler in schedulers
+            ],
+        ),
+        (
+            "radiobot_scheduler_rejected_total",
+            "counter",
+            "Scheduler tasks which were rejected",
+            [
+                ({"scheduler": scheduler["name"], "reason": reason}, count)
+                for scheduler in schedulers
+                for reason, count in scheduler["rejected"].items()
+            ],
+        ),
+    ]
+
+
+def format_value(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels: dict):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\""))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def get_metrics_text():
+    """
+    Renders all metrics in the Prometheus text format
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    text: 'str'
+        metrics in the Prometheus text exposition format (0.0.4)
+    """
+
+    with metric_registry_lock:
+        metrics = list(metric_registry.values())
+        collectors = list(metric_collectors)
+
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+        if metric.metric_type == "histogram":
+            for suffix, labels, value in metric.get_samples():
+                lines.append(
+                    f"{metric.name}{suffix}{format_labels(labels)} {format_value(value)}"
+                )
+        else:
+            for labels, value in metric.get_samples():
+                lines.append(
+                    f"{metric.name}{format_labels(labels)} {format_value(value)}"
+                )
+
+    for collector in collectors:
+        try:
+            families = collector()
+        except Exception:
+            logger.exception(msg="Metrics collector has failed")
+            continue
+        for name, metric_type, documentation, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics on /metrics
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        content = get_metrics_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def start_metrics_server(metrics_config: dict):
+    """
+    Starts the Prometheus scrape endpoint in a background thread
+
+    Parameters
+    ==========
+    metrics_config: 'dict'
+        'metrics_config' settings
+
+    Returns
+    =======
+    server: 'ThreadingHTTPServer'
+        the metrics server (or None if it is disabled or
+        cannot be started)
+    """
+
+    global metrics_server
+
+    if not metrics_config["http_port"]:
+        return None
+    try:
+        metrics_server = ThreadingHTTPServer(
+            (metrics_config["http_address"], metrics_config["http_port"]),
+            MetricsRequestHandler,
+        )
+    except OSError:
+        logger.exception(msg="Cannot start the metrics endpoint")
+        return None
+    metrics_server.daemon_threads = True
+    threading.Thread(
+        target=metrics_server.serve_forever, name="metrics", daemon=True
+    ).start()
+    logger.info(
+        f"Serving metrics on http://{metrics_config['http_address']}:{metrics_server.server_port}/metrics"
+    )
+    return metrics_server
+
+
+register_collector(collect_statistics)
+
+
+if __name__ == "__main__":
+    for latency in (0.02, 0.2, 1.5):
+        upstream_request_seconds.observe(
+            latency, upstream="habhub", endpoint="habhub_kml"
+        )
+    upstream_errors_total.inc(
+        upstream="habhub", endpoint="habhub_kml", reason="timeout"
+    )
+    logger.info(get_metrics_text())
@@ -0,0 +1,735 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: outbound Telegram message delivery. Command handlers hand
+# their messages over to the outbox and return right away; the outbox
+# delivers them within Telegram's flood limits (token buckets per chat
+# and for the whole bot), interactive replies ahead of watch
+# notifications, and retries after HTTP 429 'retry after' responses.
+# Queued messages to the same chat get merged where possible
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextvars
+import itertools
+import logging
+import math
+import threading
+import time
+from collections import deque
+from html import escape
+from telegram import ParseMode
+from telegram.error import (
+    BadRequest,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+    TimedOut,
+)
+from metrics_modules import register_collector, telegram_delivery_seconds
+from tracing_modules import hold_trace, release_trace
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Default settings for the optional 'outbox_config' config file section
+# sender_threads: number of Telegram API calls that run in parallel
+# (the messages of a single chat are always sent one after another)
+# global_rate / global_burst: messages per second (and burst size)
+# across all chats; Telegram permits approx. 30 messages per second
+# chat_rate / chat_burst: messages per second (and burst size) per
+# private chat; Telegram permits approx. 1 message per second
+# group_chat_rate / group_chat_burst: the same for group chats (negative
+# chat IDs); Telegram permits 20 messages per minute
+# max_attempts: a message gets dropped after this many failed attempts
+# (HTTP 429 and network errors). A new message which runs into a timeout
+# is not sent again, as Telegram may have delivered it anyway
+# network_error_delay: seconds to wait after a network error
+# Edits of live messages count as messages, too. A rate of 0 disables
+# the respective limit
+outbox_config_defaults = {
+    "sender_threads": 4,
+    "global_rate": 25.0,
+    "global_burst": 30,
+    "chat_rate": 1.0,
+    "chat_burst": 3,
+    "group_chat_rate": 0.33,
+    "group_chat_burst": 3,
+    "max_attempts": 5,
+    "network_error_delay": 1.0,
+}
+
+# Priority lanes; queued interactive replies always go out before
+# the watch notifications of the same chat and of other chats
+interactive_lane = 0
+watch_lane = 1
+lane_names = ("interactive", "watch")
+
+# Telegram's max. message length
+max_message_length = 4096
+
+# Message arguments that still permit merging two messages
+mergeable_arguments = {"parse_mode", "disable_web_page_preview"}
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter; the caller has to serialize the calls
+    """
+
+    def __init__(self, rate: float, burst: float):
+        """
+        Parameters
+        ==========
+        rate: 'float'
+            tokens per second (0 = unlimited)
+        burst: 'float'
+            bucket size
+        """
+        self.rate = max(0.0, rate)
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if self.rate:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+        self.updated = now
+
+    def get_delay(self, now: float):
+        """
+        Returns the number of seconds until a token is available
+        """
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+
+    def take(self, now: float, tokens: float = 1.0):
+        # The bucket may go into debt; get_delay() then waits until
+        # the debt has been paid off
+        if self.rate:
+            self._refill(now)
+            self.tokens -= tokens
+
+    def drain(self, now: float):
+        if self.rate:
+            self._refill(now)
+            self.tokens = min(self.tokens, 0.0)
+
+    def is_full(self, now: float):
+        if not self.rate:
+            return True
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class OutboundMessage:
+    """
+    Handle of a message that has been handed over to the outbox
+    """
+
+    def __init__(
+        self,
+        chat_id: int,
+        text: str,
+        kwargs: dict,
+        lane: int,
+        editable: bool,
+        replace_key,
+    ):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.lane = lane
+        self.editable = editable
+        self.replace_key = replace_key
+        self.state = "queued"
+        self.attempts = 0
+        self.queued_since = time.monotonic()
+        # Telegram message once it has been sent
+        self.message = None
+        # (text, kwargs) of the queued edit
+        self.pending_edit = None
+        self.delivered = threading.Event()
+
+    def wait(self, timeout: float = None):
+        """
+        Waits until the message has been sent (or has been dropped)
+
+        Parameters
+        ==========
+        timeout: 'float'
+            max. number of seconds to wait
+
+        Returns
+        =======
+        message: 'telegram.Message'
+            the sent message; None if it has not been sent (yet)
+        """
+        self.delivered.wait(timeout)
+        return self.message
+
+
+class ChatQueue:
+    """
+    Queued messages and rate limit of a single chat
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.lanes = tuple(deque() for _ in lane_names)
+        self.bucket = TokenBucket(rate=rate, burst=burst)
+        self.busy = False
+        self.blocked_until = 0.0
+
+    def get_first_lane(self):
+        for lane, entries in enumerate(self.lanes):
+            if entries:
+                return lane
+        return None
+
+
+class Outbox:
+    """
+    Rate-limited, prioritized delivery of outbound Telegram messages
+    """
+
+    def __init__(self, bot, outbox_config: dict):
+        """
+        Parameters
+        ==========
+        bot: 'telegram.Bot'
+            Telegram bot
+        outbox_config: 'dict'
+            'outbox_config' settings
+        """
+        self.bot = bot
+        self.outbox_config = outbox_config
+        self.global_bucket = TokenBucket(
+            rate=outbox_config["global_rate"], burst=outbox_config["global_burst"]
+        )
+        self._chats = {}
+        self._sequence = itertools.count()
+        self._queued = 0
+        self._sending = 0
+        self._condition = threading.Condition()
+
+        self.sent = self.merged = self.superseded = 0
+        self.retried = self.failed = 0
+
+        self._senders = [
+            threading.Thread(target=self._send, name=f"outbox_{number}", daemon=True)
+            for number in range(max(1, outbox_config["sender_threads"]))
+        ]
+        for sender in self._senders:
+            sender.start()
+        outboxes.append(self)
+
+    def _get_chat(self, chat_id: int):
+        # Caller must hold the lock
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            group = isinstance(chat_id, int) and chat_id < 0
+            prefix = "group_chat" if group else "chat"
+            chat = ChatQueue(
+                rate=self.outbox_config[f"{prefix}_rate"],
+                burst=self.outbox_config[f"{prefix}_burst"],
+            )
+            self._chats[chat_id] = chat
+        return chat
+
+    def _enqueue(
+        self,
+        chat: ChatQueue,
+        lane: int,
+        kind: str,
+        handle,
+        first=False,
+        context: contextvars.Context = None,
+    ):
+        # Caller must hold the lock. New entries are delivered in the
+        # caller's context, so that the Telegram calls end up in the
+        # caller's trace; the trace waits until they have finished
+        if context is None:
+            context = contextvars.copy_context()
+            hold_trace(context)
+        entry = (next(self._sequence), kind, handle, context)
+        if first:
+            chat.lanes[lane].appendleft(entry)
+        else:
+            chat.lanes[lane].append(entry)
+        self._queued += 1
+        self._condition.notify()
+
+    def send_message(
+        self,
+        chat_id: int,
+        text: str,
+        lane: int = interactive_lane,
+        editable: bool = False,
+        replace_key=None,
+        **kwargs,
+    ):
+        """
+        Queues a message
+
+        Parameters
+        ==========
+        chat_id: 'int'
+            Telegram chat ID
+        text: 'str'
+            message text
+        lane: 'int'
+            interactive_lane or watch_lane
+        editable: 'bool'
+            the message will be edited later on (see edit_message_text());
+            editable messages don't get merged with other messages
+        replace_key: 'hashable'
+            if a message to the same chat with the same key is still
+            queued, its text gets replaced instead, e.g. for superseded
+            watch notifications
+        kwargs:
+            further send_message arguments, e.g. parse_mode
+
+        Returns
+        =======
+        message: 'OutboundMessage'
+            message handle
+        """
+
+        with self._condition:
+            chat = self._get_chat(chat_id)
+            if replace_key is not None:
+                for _, kind, handle, _ in chat.lanes[lane]:
+                    if kind == "send" and handle.replace_key == replace_key:
+                        handle.text = text
+                        handle.kwargs = kwargs
+                        self.superseded += 1
+                        return handle
+            handle = OutboundMessage(
+                chat_id=chat_id,
+                text=text,
+                kwargs=kwargs,
+                lane=lane,
+                editable=editable,
+                replace_key=replace_key,
+            )
+            self._enqueue(chat=chat, lane=lane, kind="send", handle=handle)
+            return handle
+
+    def edit_message_text(self, message: OutboundMessage, text: str, **kwargs):
+        """
+        Queues an edit of a message. If the message itself or an earlier
+        edit is still queued, its text gets replaced instead. If the
+        message cannot be edited, the text gets sent as a new message
+
+        Parameters
+        ==========
+        message: 'OutboundMessage'
+            see send_message()
+        text: 'str'
+            new message text
+        kwargs:
+            further edit_message_text arguments, e.g. parse_mode
+
+        Returns
+        =======
+        """
+
+        with self._condition:
+            if message.state == "queued":
+                message.text = text
+                message.kwargs.update(kwargs)
+                self.superseded += 1
+            elif message.pending_edit is not None:
+                message.pending_edit = (text, kwargs)
+                self.superseded += 1
+            else:
+                message.pending_edit = (text, kwargs)
+                self._enqueue(
+                    chat=self._get_chat(message.chat_id),
+                    lane=message.lane,
+                    kind="edit",
+                    handle=message,
+                )
+
+    def _get_next_chat(self, now: float):
+        # Caller must hold the lock. Returns the chat whose next message
+        # is due (or None) and the delay until the next chat may be due
+        delay = self.global_bucket.get_delay(now) if self._queued else math.inf
+        if delay > 0.0:
+            return None, None, delay
+        best_chat_id = best_key = None
+        for chat_id, chat in list(self._chats.items()):
+            if chat.busy:
+                continue
+            lane = chat.get_first_lane()
+            if lane is None:
+                # nothing to send; forget the chat once it has recovered
+                if chat.blocked_until <= now and chat.bucket.is_full(now):
+                    del self._chats[chat_id]
+                continue
+            if chat.blocked_until > now:
+                delay = min(delay, chat.blocked_until - now)
+                continue
+            chat_delay = chat.bucket.get_delay(now)
+            if chat_delay > 0.0:
+                delay = min(delay, chat_delay)
+                continue
+            key = (lane, chat.lanes[lane][0][0])
+            if best_key is None or key < best_key:
+                best_chat_id, best_key = chat_id, key
+        if best_chat_id is None:
+            return None, None, delay
+        return best_chat_id, best_key[0], 0.0
+
+    def _take_batch(self, chat: ChatQueue, lane: int):
+        # Caller must hold the lock. Pops the next entry plus all
+        # directly following messages that can be merged into it
+        _, kind, handle, context = chat.lanes[lane].popleft()
+        self._queued -= 1
+        if kind == "edit":
+            text, kwargs = handle.pending_edit
+            handle.pending_edit = None
+            return kind, [handle], [context], text, kwargs
+
+        batch = [handle]
+        contexts = [context]
+        text, kwargs = handle.text, dict(handle.kwargs)
+        while not handle.editable and chat.lanes[lane]:
+            _, next_kind, next_handle, next_context = chat.lanes[lane][0]
+            if next_kind != "send" or next_handle.editable:
+                break
+            merged = merge_messages(text, kwargs, next_handle.text, next_handle.kwargs)
+            if not merged:
+                break
+            text, kwargs = merged
+            chat.lanes[lane].popleft()
+            self._queued -= 1
+            batch.append(next_handle)
+            contexts.append(next_context)
+        for batch_handle in batch:
+            batch_handle.state = "sending"
+        return kind, batch, contexts, text, kwargs
+
+    def _send(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    chat_id, lane, delay = self._get_next_chat(now)
+                    if chat_id is not None:
+                        break
+                    self._condition.wait(timeout=None if delay == math.inf else delay)
+                chat = self._chats[chat_id]
+                chat.busy = True
+                chat.bucket.take(now)
+                self.global_bucket.take(now)
+                kind, batch, contexts, text, kwargs = self._take_batch(chat, lane)
+                self._sending += 1
+
+            outcome, retry_delay = contexts[0].run(
+                self._deliver, chat_id, kind, batch, text, kwargs
+            )
+
+            with self._condition:
+                now = time.monotonic()
+                chat.busy = False
+                self._sending -= 1
+                if outcome == "retry":
+                    contexts = self._retry(
+                        chat,
+                        lane,
+                        kind,
+                        batch,
+                        contexts,
+                        text,
+                        kwargs,
+                        retry_delay,
+                        now,
+                    )
+                elif outcome == "failed":
+                    self.failed += 1
+                    for handle in batch:
+                        handle.state = "failed"
+                        handle.delivered.set()
+                else:
+                    self.sent += 1
+                    self.merged += len(batch) - 1
+                    for handle in batch:
+                        telegram_delivery_seconds.observe(
+                            now - handle.queued_since, lane=lane_names[lane]
+                        )
+                        handle.state = "sent"
+                        handle.delivered.set()
+                self._condition.notify_all()
+            for context in contexts:
+                release_trace(context)
+
+    def _retry(self, chat, lane, kind, batch, contexts, text, kwargs, retry_delay, now):
+        # Caller must hold the lock. Returns the contexts of the
+        # entries that are done (i.e. not queued again)
+        chat.blocked_until = max(chat.blocked_until, now + retry_delay)
+        handle = batch[0]
+        handle.attempts += 1
+        if handle.attempts >= self.outbox_config["max_attempts"]:
+            logger.info(
+                f"Dropping message to chat {handle.chat_id} after {handle.attempts} attempts"
+            )
+            self.failed += 1
+            for batch_handle in batch:
+                batch_handle.state = "failed"
+                batch_handle.delivered.set()
+            return contexts
+        self.retried += 1
+        if kind == "edit":
+            # a newer edit supersedes this one
+            if handle.pending_edit is not None:
+                return contexts
+            handle.pending_edit = (text, kwargs)
+        else:
+            for batch_handle in batch:
+                batch_handle.state = "queued"
+        for batch_handle, context in zip(reversed(batch), reversed(contexts)):
+            self._enqueue(
+                chat=chat,
+                lane=lane,
+                kind=kind,
+                handle=batch_handle,
+                first=True,
+                context=context,
+            )
+        return []
+
+    def _deliver(self, chat_id: int, kind: str, batch: list, text: str, kwargs: dict):
+        # Returns the outcome ('sent', 'retry' or 'failed') and the
+        # number of seconds to wait before the retry
+        handle = batch[0]
+        new_message = False
+        try:
+            if kind == "edit" and handle.message is not None:
+                try:
+                    self.bot.edit_message_text(
+                        chat_id=chat_id,
+                        message_id=handle.message.message_id,
+                        text=text,
+                        **kwargs,
+                    )
+                    return "sent", 0.0
+                except BadRequest as exception:
+                    if "not modified" in str(exception).lower():
+                        return "sent", 0.0
+                    logger.info(
+                        f"Cannot edit message in chat {chat_id} ({exception}); sending it as a new message"
+                    )
+            new_message = True
+            message = self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            for batch_handle in batch:
+                batch_handle.message = message
+            return "sent", 0.0
+        except RetryAfter as exception:
+            logger.info(
+                f"Telegram flood control for chat {chat_id}: retry after {exception.retry_after}s"
+            )
+            with self._condition:
+                self.global_bucket.drain(time.monotonic())
+            return "retry", float(exception.retry_after)
+        except BadRequest:
+            logger.exception(msg=f"Cannot send message to chat {chat_id}")
+            return "failed", 0.0
+        except TimedOut:
+            # Telegram may have received the request anyway: edits can
+            # be repeated safely, new messages could end up twice
+            if not new_message:
+                logger.info(f"Timeout while editing a message in chat {chat_id}")
+                return "retry", self.outbox_config["network_error_delay"]
+            logger.info(
+                f"Timeout while sending a message to chat {chat_id}; it may or may not have been delivered"
+            )
+            return "failed", 0.0
+        except NetworkError:
+            logger.info(f"Network error while sending a message to chat {chat_id}")
+            return "retry", self.outbox_config["network_error_delay"]
+        except TelegramError:
+            logger.exception(msg=f"Cannot send message to chat {chat_id}")
+            return "failed", 0.0
+        except Exception:
+            logger.exception(msg=f"Cannot send message to chat {chat_id}")
+            return "failed", 0.0
+
+    def flush(self, timeout: float = None):
+        """
+        Waits until all queued messages have been delivered
+
+        Parameters
+        ==========
+        timeout: 'float'
+            max. number of seconds to wait
+
+        Returns
+        =======
+        flushed: 'bool'
+            False if there are still messages in the queue
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._queued and not self._sending, timeout=timeout
+            )
+
+    def get_statistics(self):
+        """
+        Get the outbox's statistics
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        statistics: 'dict'
+            queued messages per lane, number of blocked chats, sent
+            messages, merged messages (sent as part of another one),
+            superseded messages and edits (replaced while queued),
+            retries and failed messages
+        """
+        with self._condition:
+            now = time.monotonic()
+            queued = dict.fromkeys(lane_names, 0)
+            for chat in self._chats.values():
+                for lane, entries in enumerate(chat.lanes):
+                    queued[lane_names[lane]] += len(entries)
+            return {
+                "queued": queued,
+                "blocked_chats": sum(
+                    1 for chat in self._chats.values() if chat.blocked_until > now
+                ),
+                "sent": self.sent,
+                "merged": self.merged,
+                "superseded": self.superseded,
+                "retried": self.retried,
+                "failed": self.failed,
+            }
+
+
+def merge_messages(text: str, kwargs: dict, other_text: str, other_kwargs: dict):
+    """
+    Merges two messages into one. Plain text gets escaped if it is
+    merged with an HTML message; link previews are disabled if
+    one of the messages has disabled them
+
+    Parameters
+    ==========
+    text / other_text: 'str'
+        message texts
+    kwargs / other_kwargs: 'dict'
+        send_message arguments
+
+    Returns
+    =======
+    merged: 'tuple'
+        text and arguments of the merged message;
+        None if the messages cannot be merged
+    """
+
+    if not (set(kwargs) | set(other_kwargs)) <= mergeable_arguments:
+        return None
+    parse_modes = {kwargs.get("parse_mode"), other_kwargs.get("parse_mode")}
+    if parse_modes == {None, ParseMode.HTML}:
+        if not kwargs.get("parse_mode"):
+            text = escape(text)
+        else:
+            other_text = escape(other_text)
+    elif len(parse_modes) > 1 or parse_modes - {None, ParseMode.HTML}:
+        return None
+    merged_text = f"{text}\n\n{other_text}"
+    if len(merged_text) > max_message_length:
+        return None
+    merged_kwargs = {}
+    if ParseMode.HTML in parse_modes:
+        merged_kwargs["parse_mode"] = ParseMode.HTML
+    if kwargs.get("disable_web_page_preview") or other_kwargs.get(
+        "disable_web_page_preview"
+    ):
+        merged_kwargs["disable_web_page_preview"] = True
+    return merged_text, merged_kwargs
+
+
+outboxes = []
+
+
+def collect_outbox_metrics():
+    """
+    Collector for the outbox statistics; see register_collector()
+    """
+
+    families = {
+        "queued": [],
+        "sent": [],
+        "merged": [],
+        "superseded": [],
+        "retried": [],
+        "failed": [],
+    }
+    for outbox in list(outboxes):
+        statistics = outbox.get_statistics()
+        for lane, count in statistics["queued"].items():
+            families["queued"].append(({"lane": lane}, count))
+        for name in ("sent", "merged", "superseded", "retried", "failed"):
+            families[name].append(({}, statistics[name]))
+    return [
+        (
+            "radiobot_outbox_queued",
+            "gauge",
+            "Queued outbound Telegram messages",
+            families["queued"],
+        ),
+        (
+            "radiobot_outbox_sent_total",
+            "counter",
+            "Telegram messages and edits that the outbox has sent",
+            families["sent"],
+        ),
+        (
+            "radiobot_outbox_merged_total",
+            "counter",
+            "Queued messages that were sent as part of another message",
+            families["merged"],
+        ),
+        (
+            "radiobot_outbox_superseded_total",
+            "counter",
+            "Queued messages and edits that were replaced by a newer version",
+            families["superseded"],
+        ),
+        (
+            "radiobot_outbox_retried_total",
+            "counter",
+            "Deliveries that were retried after HTTP 429 or a network error",
+            families["retried"],
+        ),
+        (
+            "radiobot_outbox_failed_total",
+            "counter",
+            "Messages that could not be delivered",
+            families["failed"],
+        ),
+    ]
+
+
+register_collector(collect_outbox_metrics)
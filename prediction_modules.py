@@ -0,0 +1,707 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: local radiosonde landing prediction (ascent, burst and
+# parachute descent) as an alternative to predict.habhub.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+import math
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+from record_modules import LandingPrediction
+from utility_modules import read_config_section
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Default settings for the optional 'prediction_config' config file section
+# mode: 'habhub' (predict.habhub.org only), 'local' (local model only),
+# 'fallback' (local model if habhub fails) or 'race' (both run in
+# parallel; habhub's prediction is used if it arrives within
+# race_timeout seconds, otherwise the local prediction)
+# altitude_step: vertical resolution of the local model in meters
+# ground_altitude: altitude of the landing area in meters
+# max_wind_factor: upper limit for the wind profile scaling (see below)
+# ensemble_size: number of perturbed trajectories for the landing
+# ellipse (0 disables the ensemble)
+# ensemble_altitude_step: vertical resolution of the ensemble in meters
+# burst_altitude_sigma: standard deviation of the burst altitude (m)
+# ascent_rate_sigma / descent_rate_sigma / wind_speed_sigma: relative
+# standard deviations of the ascent rate, descent rate and wind speed
+# wind_direction_sigma: standard deviation of the wind direction (deg)
+# ensemble_seed: seed of the perturbations; a fixed seed produces the
+# same ellipse for the same flight state
+prediction_config_defaults = {
+    "mode": "habhub",
+    "race_timeout": 5.0,
+    "altitude_step": 50.0,
+    "ground_altitude": 0.0,
+    "max_wind_factor": 4.0,
+    "ensemble_size": 1000,
+    "ensemble_altitude_step": 200.0,
+    "burst_altitude_sigma": 2500.0,
+    "ascent_rate_sigma": 0.1,
+    "descent_rate_sigma": 0.15,
+    "wind_speed_sigma": 0.25,
+    "wind_direction_sigma": 15.0,
+    "ensemble_seed": 0,
+}
+
+prediction_modes = ["habhub", "local", "fallback", "race"]
+
+prediction_config = None
+prediction_config_lock = threading.Lock()
+
+# The local model has no access to wind forecasts. Instead, it uses the
+# radiosonde's current drift (aprs.fi course and speed) and scales it
+# with a mid-latitude climatological wind profile: relative wind speed
+# (1.0 = jet stream level) for a given altitude in meters
+wind_profile_altitudes = np.array(
+    [
+        0.0,
+        1000.0,
+        3000.0,
+        6000.0,
+        10000.0,
+        12000.0,
+        16000.0,
+        20000.0,
+        25000.0,
+        30000.0,
+        40000.0,
+    ]
+)
+wind_profile_factors = np.array(
+    [0.35, 0.45, 0.6, 0.8, 1.0, 1.0, 0.6, 0.3, 0.25, 0.35, 0.5]
+)
+
+# International Standard Atmosphere: layer base altitudes (m), base
+# temperatures (K) and lapse rates (K/m) up to 71 km
+isa_base_altitudes = np.array([0.0, 11000.0, 20000.0, 32000.0, 47000.0, 51000.0])
+isa_base_temperatures = np.array([288.15, 216.65, 216.65, 228.65, 270.65, 270.65])
+isa_lapse_rates = np.array([-0.0065, 0.0, 0.001, 0.0028, 0.0, -0.0028])
+isa_gravity = 9.80665
+isa_gas_constant = 287.053
+isa_sea_level_pressure = 101325.0
+isa_sea_level_density = isa_sea_level_pressure / (isa_gas_constant * 288.15)
+
+earth_radius = 6371000.0
+
+
+def get_isa_base_pressures():
+    """
+    Air pressure at the base of each ISA layer
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    pressures: 'numpy.ndarray'
+        pressure in Pa
+    """
+
+    pressures = [isa_sea_level_pressure]
+    for layer in range(1, len(isa_base_altitudes)):
+        pressures.append(
+            get_layer_pressure(
+                base_pressure=pressures[-1],
+                base_temperature=isa_base_temperatures[layer - 1],
+                lapse_rate=isa_lapse_rates[layer - 1],
+                height=isa_base_altitudes[layer] - isa_base_altitudes[layer - 1],
+            )
+        )
+    return np.array(pressures)
+
+
+def get_layer_pressure(base_pressure, base_temperature, lapse_rate, height):
+    """
+    Barometric formula within a single ISA layer
+
+    Parameters
+    ==========
+    base_pressure: 'float' or 'numpy.ndarray'
+        pressure at the layer's base in Pa
+    base_temperature: 'float' or 'numpy.ndarray'
+        temperature at the layer's base in K
+    lapse_rate: 'float' or 'numpy.ndarray'
+        temperature lapse rate in K/m
+    height: 'float' or 'numpy.ndarray'
+        height above the layer's base in meters
+
+    Returns
+    =======
+    pressure: 'numpy.ndarray'
+        pressure in Pa
+    """
+
+    lapse_rate = np.asarray(lapse_rate, dtype=float)
+    isothermal = lapse_rate == 0.0
+    safe_lapse_rate = np.where(isothermal, 1.0, lapse_rate)
+    gradient_pressure = base_pressure * (
+        (base_temperature + safe_lapse_rate * height) / base_temperature
+    ) ** (-isa_gravity / (safe_lapse_rate * isa_gas_constant))
+    isothermal_pressure = base_pressure * np.exp(
+        -isa_gravity * height / (isa_gas_constant * base_temperature)
+    )
+    return np.where(isothermal, isothermal_pressure, gradient_pressure)
+
+
+isa_base_pressures = get_isa_base_pressures()
+
+
+def get_air_density(altitude):
+    """
+    Air density according to the International Standard Atmosphere
+
+    Parameters
+    ==========
+    altitude: 'float' or 'numpy.ndarray'
+        geometric altitude in meters
+
+    Returns
+    =======
+    density: 'numpy.ndarray'
+        air density in kg/m^3
+    """
+
+    altitude = np.clip(np.asarray(altitude, dtype=float), 0.0, 71000.0)
+    layer = np.searchsorted(isa_base_altitudes, altitude, side="right") - 1
+    height = altitude - isa_base_altitudes[layer]
+    temperature = isa_base_temperatures[layer] + isa_lapse_rates[layer] * height
+    pressure = get_layer_pressure(
+        base_pressure=isa_base_pressures[layer],
+        base_temperature=isa_base_temperatures[layer],
+        lapse_rate=isa_lapse_rates[layer],
+        height=height,
+    )
+    return pressure / (isa_gas_constant * temperature)
+
+
+def get_descent_rate(sea_level_descent_rate, altitude):
+    """
+    Parachute descent rate at a given altitude. The descent rate is the
+    terminal velocity, which scales with 1 / sqrt(air density)
+
+    Parameters
+    ==========
+    sea_level_descent_rate: 'float' or 'numpy.ndarray'
+        descent rate at sea level in m/s
+    altitude: 'float' or 'numpy.ndarray'
+        altitude in meters
+
+    Returns
+    =======
+    descent_rate: 'numpy.ndarray'
+        descent rate in m/s
+    """
+
+    return sea_level_descent_rate * np.sqrt(
+        isa_sea_level_density / get_air_density(altitude)
+    )
+
+
+def get_wind_factor(altitude, reference_altitude, max_wind_factor: float):
+    """
+    Relative wind speed at a given altitude, compared to the
+    wind speed at the reference altitude
+
+    Parameters
+    ==========
+    altitude: 'float' or 'numpy.ndarray'
+        altitude in meters
+    reference_altitude: 'float' or 'numpy.ndarray'
+        altitude of the observed drift in meters
+    max_wind_factor: 'float'
+        upper limit for the factor
+
+    Returns
+    =======
+    wind_factor: 'numpy.ndarray'
+        relative wind speed
+    """
+
+    return np.clip(
+        np.interp(altitude, wind_profile_altitudes, wind_profile_factors)
+        / np.interp(reference_altitude, wind_profile_altitudes, wind_profile_factors),
+        0.0,
+        max_wind_factor,
+    )
+
+
+def get_flight_profile(
+    altitude: float,
+    ascent_rate: float,
+    sea_level_descent_rate: float,
+    burst_altitude: float,
+    prediction_config: dict,
+):
+    """
+    Splits the remaining flight into altitude slices and determines the
+    time that the radiosonde spends in each slice: constant ascent rate
+    up to the burst altitude, then parachute descent to the ground
+
+    Parameters
+    ==========
+    altitude: 'float'
+        current altitude in meters
+    ascent_rate: 'float'
+        ascent rate in m/s; <= 0 if the radiosonde is descending
+    sea_level_descent_rate: 'float'
+        descent rate at sea level in m/s
+    burst_altitude: 'float'
+        burst altitude in meters
+    prediction_config: 'dict'
+        'prediction_config' settings
+
+    Returns
+    =======
+    slice_altitudes: 'numpy.ndarray'
+        mean altitude of each slice
+    slice_durations: 'numpy.ndarray'
+        seconds spent in each slice
+    """
+
+    step = max(1.0, prediction_config["altitude_step"])
+    ground_altitude = prediction_config["ground_altitude"]
+
+    altitudes = []
+    durations = []
+    top_altitude = altitude
+    if ascent_rate > 0 and burst_altitude > altitude:
+        boundaries = np.append(
+            np.arange(altitude, burst_altitude, step), burst_altitude
+        )
+        heights = np.diff(boundaries)
+        altitudes.append(boundaries[:-1] + heights / 2)
+        durations.append(heights / ascent_rate)
+        top_altitude = burst_altitude
+
+    if top_altitude > ground_altitude:
+        boundaries = np.append(
+            np.arange(top_altitude, ground_altitude, -step), ground_altitude
+        )
+        heights = -np.diff(boundaries)
+        slice_altitudes = boundaries[:-1] - heights / 2
+        altitudes.append(slice_altitudes)
+        durations.append(
+            heights / get_descent_rate(sea_level_descent_rate, slice_altitudes)
+        )
+
+    if not altitudes:
+        return np.zeros(0), np.zeros(0)
+    return np.concatenate(altitudes), np.concatenate(durations)
+
+
+def get_displaced_position(latitude, longitude, east, north):
+    """
+    Moves a position by a (small) distance
+
+    Parameters
+    ==========
+    latitude / longitude: 'float' or 'numpy.ndarray'
+        position
+    east / north: 'float' or 'numpy.ndarray'
+        distance in meters
+
+    Returns
+    =======
+    latitude / longitude: 'float' or 'numpy.ndarray'
+        new position
+    """
+
+    new_latitude = latitude + np.degrees(north / earth_radius)
+    new_longitude = longitude + np.degrees(
+        east / (earth_radius * max(0.01, math.cos(math.radians(latitude))))
+    )
+    return new_latitude, (new_longitude + 180.0) % 360.0 - 180.0
+
+
+def get_local_landing_prediction(
+    latitude: float,
+    longitude: float,
+    altitude: float,
+    course: float,
+    speed: float,
+    ascent_rate: float,
+    descent_rate: float,
+    burst_altitude: float,
+    descending: bool,
+    position_timestamp: datetime = None,
+    prediction_config: dict = None,
+):
+    """
+    Predicts the landing point of a radiosonde with the local model:
+    ascent at constant rate up to the burst altitude, then descent with
+    an altitude-dependent rate (ISA air density). The horizontal drift
+    is the radiosonde's current drift, scaled with a climatological
+    wind profile.
+
+    Parameters
+    ==========
+    latitude / longitude: 'float'
+        current position
+    altitude: 'float'
+        current altitude in meters
+    course: 'float'
+        current course over ground in degrees (or None)
+    speed: 'float'
+        current speed over ground in km/h (or None)
+    ascent_rate / descent_rate / burst_altitude: 'float'
+        see get_ascent_descent_burst()
+    descending: 'bool'
+        True if the radiosonde is already descending. In that case,
+        descent_rate is the rate at the current altitude, otherwise
+        the rate at sea level
+    position_timestamp: 'datetime'
+        time of the position report (UTC); defaults to now
+    prediction_config: 'dict'
+        'prediction_config' settings
+
+    Returns
+    =======
+    prediction: 'LandingPrediction'
+        success, latitude, longitude and timestamp of the predicted
+        probe landing; url and ellipse are always None
+    """
+
+    if not prediction_config:
+        prediction_config = get_prediction_config()
+    if not position_timestamp or position_timestamp == datetime.min:
+        position_timestamp = datetime.utcnow()
+
+    if descent_rate is None or descent_rate <= 0:
+        return LandingPrediction(False, 0.0, 0.0, datetime.min)
+
+    sea_level_descent_rate = descent_rate
+    if descending:
+        sea_level_descent_rate = descent_rate / float(get_descent_rate(1.0, altitude))
+        ascent_rate = 0.0
+
+    slice_altitudes, slice_durations = get_flight_profile(
+        altitude=altitude,
+        ascent_rate=ascent_rate,
+        sea_level_descent_rate=sea_level_descent_rate,
+        burst_altitude=burst_altitude,
+        prediction_config=prediction_config,
+    )
+
+    # Drift per slice: current drift (m/s), scaled with the wind profile
+    east = north = 0.0
+    if course is not None and speed:
+        wind_speed = speed / 3.6
+        wind_factors = get_wind_factor(
+            slice_altitudes, altitude, prediction_config["max_wind_factor"]
+        )
+        distance = float(np.dot(wind_factors, slice_durations)) * wind_speed
+        east = distance * math.sin(math.radians(course))
+        north = distance * math.cos(math.radians(course))
+
+    landing_latitude, landing_longitude = get_displaced_position(
+        latitude=latitude, longitude=longitude, east=east, north=north
+    )
+    landing_timestamp = position_timestamp + timedelta(
+        seconds=float(slice_durations.sum())
+    )
+    return LandingPrediction(
+        success=True,
+        latitude=round(float(landing_latitude), 6),
+        longitude=round(float(landing_longitude), 6),
+        timestamp=landing_timestamp,
+    )
+
+
+def get_ensemble_durations(
+    altitude: float,
+    ascent_rates: np.ndarray,
+    sea_level_descent_rates: np.ndarray,
+    burst_altitudes: np.ndarray,
+    prediction_config: dict,
+):
+    """
+    Batched version of get_flight_profile(): all ensemble members share
+    one altitude grid; each member spends a different amount of time
+    in each slice (zero for slices it never reaches)
+
+    Parameters
+    ==========
+    altitude: 'float'
+        current altitude in meters
+    ascent_rates: 'numpy.ndarray'
+        ascent rate of each member in m/s (0 if descending)
+    sea_level_descent_rates: 'numpy.ndarray'
+        descent rate at sea level of each member in m/s
+    burst_altitudes: 'numpy.ndarray'
+        burst altitude of each member in meters
+    prediction_config: 'dict'
+        'prediction_config' settings
+
+    Returns
+    =======
+    slice_altitudes: 'numpy.ndarray'
+        mean altitude of each slice of the grid
+    slice_durations: 'numpy.ndarray'
+        seconds spent in each slice; one row per member
+    """
+
+    step = max(1.0, prediction_config["ensemble_altitude_step"])
+    ground_altitude = prediction_config["ground_altitude"]
+
+    ascending = ascent_rates > 0
+    top_altitudes = np.where(ascending, np.maximum(burst_altitudes, altitude), altitude)
+    slice_count = max(1, math.ceil((top_altitudes.max() - ground_altitude) / step))
+    boundaries = ground_altitude + step * np.arange(slice_count + 1)
+    slice_altitudes = boundaries[:-1] + step / 2
+
+    # Height of each slice that a member passes during ascent / descent
+    ascent_heights = np.clip(
+        np.minimum(boundaries[1:], top_altitudes[:, None])
+        - np.maximum(boundaries[:-1], altitude),
+        0.0,
+        None,
+    )
+    descent_heights = np.clip(
+        np.minimum(boundaries[1:], top_altitudes[:, None]) - boundaries[:-1],
+        0.0,
+        None,
+    )
+    ascent_heights[~ascending] = 0.0
+
+    safe_ascent_rates = np.where(ascending, ascent_rates, 1.0)
+    descent_rates = np.outer(
+        sea_level_descent_rates, get_descent_rate(1.0, slice_altitudes)
+    )
+    slice_durations = (
+        ascent_heights / safe_ascent_rates[:, None] + descent_heights / descent_rates
+    )
+    return slice_altitudes, slice_durations
+
+
+def get_landing_ellipse(east: np.ndarray, north: np.ndarray):
+    """
+    Standard deviation ellipse of the ensemble's landing points
+
+    Parameters
+    ==========
+    east / north: 'numpy.ndarray'
+        landing points relative to the current position in meters
+
+    Returns
+    =======
+    semi_major_axis / semi_minor_axis: 'float'
+        1 sigma semi-axes in meters
+    azimuth: 'float'
+        direction of the major axis in degrees (0..180, 0 = north)
+    """
+
+    covariance = np.cov(np.vstack((east, north)))
+    variances, axes = np.linalg.eigh(covariance)
+    variances = np.clip(variances, 0.0, None)
+    major_east, major_north = axes[:, 1]
+    azimuth = math.degrees(math.atan2(major_east, major_north)) % 180.0
+    return float(np.sqrt(variances[1])), float(np.sqrt(variances[0])), azimuth
+
+
+def get_ensemble_landing_prediction(
+    latitude: float,
+    longitude: float,
+    altitude: float,
+    course: float,
+    speed: float,
+    ascent_rate: float,
+    descent_rate: float,
+    burst_altitude: float,
+    descending: bool,
+    position_timestamp: datetime = None,
+    prediction_config: dict = None,
+):
+    """
+    Monte Carlo version of get_local_landing_prediction(): runs
+    'ensemble_size' trajectories with perturbed burst altitude, ascent
+    rate, descent rate, wind speed and wind direction as one batched
+    array computation and returns the mean landing point plus the
+    landing ellipse
+
+    Parameters
+    ==========
+    see get_local_landing_prediction()
+
+    Returns
+    =======
+    prediction: 'LandingPrediction'
+        success plus the mean latitude, longitude and timestamp of the
+        predicted probe landing; url is always None. The ellipse is a
+        dict with 'semi_major_axis' and 'semi_minor_axis' (1 sigma, in meters),
+        'azimuth' of the major axis (degrees), 'time_sigma' (seconds)
+        and the number of 'members'. The 2 sigma ellipse has twice
+        the size. None if success = False
+    """
+
+    if not prediction_config:
+        prediction_config = get_prediction_config()
+    if not position_timestamp or position_timestamp == datetime.min:
+        position_timestamp = datetime.utcnow()
+
+    members = int(prediction_config["ensemble_size"])
+    if members < 2 or descent_rate is None or descent_rate <= 0:
+        return LandingPrediction(False, 0.0, 0.0, datetime.min)
+
+    rng = np.random.default_rng(int(prediction_config["ensemble_seed"]))
+    (
+        burst_noise,
+        ascent_noise,
+        descent_noise,
+        wind_speed_noise,
+        wind_direction_noise,
+    ) = rng.standard_normal((5, members))
+
+    sea_level_descent_rate = descent_rate
+    if descending:
+        sea_level_descent_rate = descent_rate / float(get_descent_rate(1.0, altitude))
+        ascent_rate = 0.0
+    sea_level_descent_rates = sea_level_descent_rate * np.clip(
+        1.0 + prediction_config["descent_rate_sigma"] * descent_noise, 0.2, None
+    )
+    ascent_rates = np.zeros(members)
+    burst_altitudes = np.full(members, float(altitude))
+    if ascent_rate > 0:
+        ascent_rates = ascent_rate * np.clip(
+            1.0 + prediction_config["ascent_rate_sigma"] * ascent_noise, 0.2, None
+        )
+        burst_altitudes = np.maximum(
+            burst_altitude + prediction_config["burst_altitude_sigma"] * burst_noise,
+            altitude,
+        )
+
+    slice_altitudes, slice_durations = get_ensemble_durations(
+        altitude=altitude,
+        ascent_rates=ascent_rates,
+        sea_level_descent_rates=sea_level_descent_rates,
+        burst_altitudes=burst_altitudes,
+        prediction_config=prediction_config,
+    )
+    flight_times = slice_durations.sum(axis=1)
+
+    east = north = np.zeros(members)
+    if course is not None and speed:
+        wind_factors = get_wind_factor(
+            slice_altitudes, altitude, prediction_config["max_wind_factor"]
+        )
+        distances = (
+            slice_durations
+            @ wind_factors
+            * (speed / 3.6)
+            * np.clip(
+                1.0 + prediction_config["wind_speed_sigma"] * wind_speed_noise,
+                0.0,
+                None,
+            )
+        )
+        headings = np.radians(
+            course + prediction_config["wind_direction_sigma"] * wind_direction_noise
+        )
+        east = distances * np.sin(headings)
+        north = distances * np.cos(headings)
+
+    landing_latitude, landing_longitude = get_displaced_position(
+        latitude=latitude,
+        longitude=longitude,
+        east=float(east.mean()),
+        north=float(north.mean()),
+    )
+    semi_major_axis, semi_minor_axis, azimuth = get_landing_ellipse(
+        east=east, north=north
+    )
+    landing_ellipse = {
+        "semi_major_axis": round(semi_major_axis, 1),
+        "semi_minor_axis": round(semi_minor_axis, 1),
+        "azimuth": round(azimuth, 1),
+        "time_sigma": round(float(flight_times.std()), 1),
+        "members": members,
+    }
+    landing_timestamp = position_timestamp + timedelta(
+        seconds=float(flight_times.mean())
+    )
+    return LandingPrediction(
+        success=True,
+        latitude=round(float(landing_latitude), 6),
+        longitude=round(float(landing_longitude), 6),
+        timestamp=landing_timestamp,
+        ellipse=landing_ellipse,
+    )
+
+
+def get_prediction_config():
+    """
+    Returns the 'prediction_config' settings
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    prediction_config: 'dict'
+        'prediction_config' settings
+    """
+
+    global prediction_config
+
+    with prediction_config_lock:
+        if prediction_config is None:
+            config = read_config_section(
+                section_name="prediction_config", defaults=prediction_config_defaults
+            )
+            if config["mode"] not in prediction_modes:
+                logger.info(
+                    f"Invalid prediction mode '{config['mode']}'; using 'habhub' instead"
+                )
+                config["mode"] = "habhub"
+            prediction_config = config
+    return prediction_config
+
+
+if __name__ == "__main__":
+    logger.info(
+        get_local_landing_prediction(
+            latitude=51.81425,
+            longitude=9.46132,
+            altitude=12874.0,
+            course=74.0,
+            speed=38.9,
+            ascent_rate=5.2,
+            descent_rate=6.0,
+            burst_altitude=30000.0,
+            descending=False,
+        )
+    )
+    logger.info(
+        get_ensemble_landing_prediction(
+            latitude=51.81425,
+            longitude=9.46132,
+            altitude=12874.0,
+            course=74.0,
+            speed=38.9,
+            ascent_rate=5.2,
+            descent_rate=6.0,
+            burst_altitude=30000.0,
+            descending=False,
+        )
+    )
@@ -0,0 +1,365 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: hot-set prefetcher. Counts the /sonde requests per radiosonde
+# over a sliding window and keeps the results of the most requested
+# radiosondes warm by refreshing them in the background, ahead of the
+# next request - within a request budget per upstream web site and
+# only until radiosondy.info reports the radiosonde as landed
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+import threading
+import time
+from collections import Counter, deque
+from http_modules import (
+    get_upstream_policies,
+    upstream_hosts,
+    upstream_request_counter,
+)
+from metrics_modules import register_collector
+from outbox_modules import TokenBucket
+from watch_modules import get_flight_phase, flight_phase_landed
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Default settings for the optional 'prefetch_config' config file section
+# top_sondes: number of radiosondes that are kept warm (0 disables
+# the prefetcher)
+# window_seconds / min_requests: a radiosonde is a candidate if it has
+# been requested at least min_requests times within the last
+# window_seconds seconds; the most requested candidates are kept warm
+# interval: seconds between two prefetch rounds. Cached results which
+# would expire before the next round get refreshed
+# <upstream>_budget: max. number of prefetch requests per minute to
+# that upstream (0 = no limit); a radiosonde is skipped while one of
+# the budgets is used up. Requests for the users are not limited
+prefetch_config_defaults = {
+    "top_sondes": 5,
+    "window_seconds": 900.0,
+    "min_requests": 3,
+    "interval": 5.0,
+    "aprsdotfi_budget": 20,
+    "habhub_budget": 10,
+    "radiosondy_budget": 40,
+    "nominatim_budget": 20,
+}
+
+prefetchers = []
+
+
+class RequestWindow:
+    """
+    Number of requests per key within a sliding time window
+    """
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, now: float):
+        with self._lock:
+            timestamps = self._requests.get(key)
+            if timestamps is None:
+                timestamps = self._requests[key] = deque()
+            timestamps.append(now)
+
+    def get_counts(self, now: float):
+        """
+        Get the number of requests per key within the window; keys
+        without requests in the window are forgotten
+
+        Parameters
+        ==========
+        now: 'float'
+            current time.monotonic()
+
+        Returns
+        =======
+        counts: 'Counter'
+            number of requests, keyed by key
+        """
+        counts = Counter()
+        oldest = now - self.window_seconds
+        with self._lock:
+            for key in list(self._requests):
+                timestamps = self._requests[key]
+                while timestamps and timestamps[0] < oldest:
+                    timestamps.popleft()
+                if timestamps:
+                    counts[key] = len(timestamps)
+                else:
+                    del self._requests[key]
+        return counts
+
+
+class Prefetcher:
+    """
+    Keeps the results of the most requested radiosondes warm
+    """
+
+    def __init__(
+        self,
+        prefetch_config: dict,
+        refresh_function,
+        scheduler,
+        scheduler_key,
+        landed_statuses: str,
+    ):
+        """
+        Parameters
+        ==========
+        prefetch_config: 'dict'
+            'prefetch_config' settings
+        refresh_function: 'callable'
+            refreshes the cached results of a radiosonde; gets called
+            with the radiosonde ID and the number of seconds for which
+            the results have to stay valid, returns the radiosonde's
+            radiosondy.info probe status (or None if unknown)
+        scheduler: 'FairScheduler'
+            scheduler which executes the refreshes
+        scheduler_key: 'hashable'
+            fairness key of the refreshes on the scheduler
+        landed_statuses: 'str'
+            comma-separated probe states which indicate a landed sonde
+        """
+        self.prefetch_config = prefetch_config
+        self.refresh_function = refresh_function
+        self.scheduler = scheduler
+        self.scheduler_key = scheduler_key
+        self.landed_statuses = landed_statuses
+
+        self._window = RequestWindow(window_seconds=prefetch_config["window_seconds"])
+        self._budgets = {
+            upstream: TokenBucket(
+                rate=prefetch_config[f"{upstream}_budget"] / 60.0,
+                burst=prefetch_config[f"{upstream}_budget"] / 6.0,
+            )
+            for upstream in upstream_hosts.values()
+        }
+        self._lock = threading.Lock()
+        self._running = set()
+        self._landed = set()
+        self._hot_sondes = []
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.refreshes = 0
+        self.skipped = Counter()
+        self.upstream_requests = Counter()
+
+        prefetchers.append(self)
+
+    def start(self):
+        if self.prefetch_config["top_sondes"] <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="prefetcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def record_request(self, sonde_id: str):
+        """
+        Counts a user request for a radiosonde
+
+        Parameters
+        ==========
+        sonde_id: 'str'
+            Radiosonde ID (upper case)
+
+        Returns
+        =======
+        """
+        self._window.add(sonde_id, time.monotonic())
+
+    def get_hot_sondes(self, now: float):
+        """
+        Get the radiosondes that are to be kept warm
+
+        Parameters
+        ==========
+        now: 'float'
+            current time.monotonic()
+
+        Returns
+        =======
+        sonde_ids: 'list'
+            most requested radiosondes first; landed ones are left out
+        """
+        counts = self._window.get_counts(now)
+        with self._lock:
+            # radiosondes which have left the window may fly again
+            self._landed &= set(counts)
+            candidates = [
+                (count, sonde_id)
+                for sonde_id, count in counts.items()
+                if count >= self.prefetch_config["min_requests"]
+                and sonde_id not in self._landed
+            ]
+        candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+        return [
+            sonde_id for _, sonde_id in candidates[: self.prefetch_config["top_sondes"]]
+        ]
+
+    def _run(self):
+        interval = self.prefetch_config["interval"]
+        while not self._stop_event.wait(interval):
+            try:
+                self.run_round()
+            except Exception:
+                logger.exception(msg="Prefetch round failed")
+
+    def run_round(self):
+        """
+        Hands the refreshes of all hot radiosondes over to the scheduler,
+        unless a refresh is still running or an upstream budget is used up
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        """
+        now = time.monotonic()
+        hot_sondes = self.get_hot_sondes(now)
+        policies = get_upstream_policies()
+        with self._lock:
+            self._hot_sondes = hot_sondes
+            for sonde_id in hot_sondes:
+                if sonde_id in self._running:
+                    continue
+                if any(policy.is_open() for policy in policies.values()):
+                    self.skipped["unavailable"] += 1
+                    continue
+                if any(
+                    budget.get_delay(now) > 0.0 for budget in self._budgets.values()
+                ):
+                    self.skipped["budget"] += 1
+                    continue
+                _, future = self.scheduler.submit(
+                    self.scheduler_key, self._refresh, sonde_id
+                )
+                if future is None:
+                    self.skipped["rejected"] += 1
+                    continue
+                self._running.add(sonde_id)
+
+    def _refresh(self, sonde_id: str):
+        request_counter = Counter()
+        upstream_request_counter.set(request_counter)
+        probe_status = None
+        try:
+            probe_status = self.refresh_function(
+                sonde_id, self.prefetch_config["interval"]
+            )
+        except Exception:
+            logger.exception(msg=f"Cannot prefetch radiosonde '{sonde_id}'")
+        finally:
+            now = time.monotonic()
+            with self._lock:
+                self._running.discard(sonde_id)
+                self.refreshes += 1
+                for upstream, count in request_counter.items():
+                    self._budgets[upstream].take(now, tokens=count)
+                self.upstream_requests.update(request_counter)
+                landed = (
+                    get_flight_phase(
+                        probe_status=probe_status,
+                        clmb=None,
+                        landed_statuses=self.landed_statuses,
+                    )
+                    == flight_phase_landed
+                )
+                if landed and sonde_id not in self._landed:
+                    logger.info(
+                        f"Radiosonde '{sonde_id}' has landed; no longer prefetching it"
+                    )
+                    self._landed.add(sonde_id)
+
+    def get_statistics(self):
+        """
+        Get the prefetcher's statistics
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        statistics: 'dict'
+            hot and landed radiosondes, number of refreshes, skipped
+            refreshes per reason and upstream requests per upstream
+        """
+        with self._lock:
+            return {
+                "hot_sondes": list(self._hot_sondes),
+                "landed_sondes": sorted(self._landed),
+                "refreshes": self.refreshes,
+                "skipped": dict(self.skipped),
+                "upstream_requests": dict(self.upstream_requests),
+            }
+
+
+def collect_prefetch_metrics():
+    """
+    Collector for the prefetcher statistics; see register_collector()
+    """
+
+    hot_sondes, refreshes, skipped, upstream_requests = [], [], [], []
+    for prefetcher in list(prefetchers):
+        statistics = prefetcher.get_statistics()
+        hot_sondes.append(({}, len(statistics["hot_sondes"])))
+        refreshes.append(({}, statistics["refreshes"]))
+        for reason, count in sorted(statistics["skipped"].items()):
+            skipped.append(({"reason": reason}, count))
+        for upstream, count in sorted(statistics["upstream_requests"].items()):
+            upstream_requests.append(({"upstream": upstream}, count))
+    return [
+        (
+            "radiobot_prefetch_hot_sondes",
+            "gauge",
+            "Radiosondes that the prefetcher keeps warm",
+            hot_sondes,
+        ),
+        (
+            "radiobot_prefetch_refreshes_total",
+            "counter",
+            "Background refreshes of hot radiosondes",
+            refreshes,
+        ),
+        (
+            "radiobot_prefetch_skipped_total",
+            "counter",
+            "Skipped refreshes (reason: budget, unavailable, rejected)",
+            skipped,
+        ),
+        (
+            "radiobot_prefetch_upstream_requests_total",
+            "counter",
+            "Upstream requests sent by the prefetcher",
+            upstream_requests,
+        ),
+    ]
+
+
+register_collector(collect_prefetch_metrics)
@@ -0,0 +1,356 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: on-demand sampling profiler. Once armed, it samples the
+# stacks of all busy worker threads and traces the memory allocations
+# until the requested number of commands has finished, and then
+# reports the top CPU and allocation hot spots
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from scheduler_modules import get_busy_thread_ids
+from utility_modules import read_config_section
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Default settings for the optional 'profiler_config' config file section
+# sample_interval: seconds between two stack samples
+# max_seconds: the profiler stops after this many seconds, even if
+# fewer commands than requested have finished
+# max_commands: upper limit for the number of profiled commands
+# top_entries: number of hot spots per report section
+# trace_allocations: also report the allocation hot spots (tracemalloc
+# slows down the bot considerably while the profiler is running)
+profiler_config_defaults = {
+    "sample_interval": 0.005,
+    "max_seconds": 600.0,
+    "max_commands": 100,
+    "top_entries": 10,
+    "trace_allocations": True,
+}
+
+# Samples whose innermost frame is in one of these files are
+# threads that wait for the network, a lock or a queue
+waiting_file_names = (
+    "threading.py",
+    "socket.py",
+    "ssl.py",
+    "selectors.py",
+    "queue.py",
+    "_base.py",
+)
+
+# Our own source files, for the cumulative hot spots
+source_directory = os.path.dirname(os.path.abspath(__file__))
+
+command_profiler = None
+command_profiler_lock = threading.Lock()
+
+
+class CommandProfiler:
+    """
+    Sampling CPU and allocation profiler for the next N commands
+    """
+
+    def __init__(self, profiler_config: dict):
+        """
+        Parameters
+        ==========
+        profiler_config: 'dict'
+            'profiler_config' settings
+        """
+        self.profiler_config = profiler_config
+        self._lock = threading.Lock()
+        self._stop_event = None
+        self._sampler = None
+        self._report_callback = None
+        self.remaining_commands = 0
+        self.profiled_commands = 0
+
+    def is_active(self):
+        with self._lock:
+            return self._sampler is not None
+
+    def start(self, commands: int, report_callback):
+        """
+        Starts profiling
+
+        Parameters
+        ==========
+        commands: 'int'
+            number of commands to profile
+        report_callback: 'callable'
+            gets called with the report text once the profiler has stopped
+
+        Returns
+        =======
+        started: 'bool'
+            False if the profiler is already running
+        commands: 'int'
+            number of commands that will be profiled
+        """
+
+        commands = max(1, min(commands, self.profiler_config["max_commands"]))
+        with self._lock:
+            if self._sampler is not None:
+                return False, commands
+            self.remaining_commands = commands
+            self.profiled_commands = 0
+            self._report_callback = report_callback
+            self._stop_event = threading.Event()
+            self._sampler = threading.Thread(
+                target=self._sample,
+                args=(self._stop_event,),
+                name="profiler",
+                daemon=True,
+            )
+            self._sampler.start()
+        logger.info(f"Profiling the next {commands} commands")
+        return True, commands
+
+    def command_finished(self):
+        """
+        Counts a finished command; stops the profiler
+        once the requested number of commands has finished
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        """
+        with self._lock:
+            if self._sampler is None:
+                return
+            self.profiled_commands += 1
+            self.remaining_commands -= 1
+            if self.remaining_commands > 0:
+                return
+            self._stop_event.set()
+
+    def stop(self):
+        """
+        Stops the profiler early; the report gets sent anyway
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        stopped: 'bool'
+            False if the profiler was not running
+        """
+        with self._lock:
+            if self._sampler is None:
+                return False
+            self._stop_event.set()
+            return True
+
+    def _sample(self, stop_event: threading.Event):
+        trace_allocations = self.profiler_config["trace_allocations"]
+        started_tracemalloc = trace_allocations and not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start(1)
+        first_snapshot = tracemalloc.take_snapshot() if trace_allocations else None
+
+        own_thread_id = threading.get_ident()
+        interval = self.profiler_config["sample_interval"]
+        deadline = time.monotonic() + self.profiler_config["max_seconds"]
+        start = time.monotonic()
+        samples = waiting_samples = 0
+        self_samples = Counter()
+        cumulative_samples = Counter()
+        while not stop_event.wait(interval):
+            if time.monotonic() > deadline:
+                break
+            frames = sys._current_frames()
+            for thread_id in get_busy_thread_ids():
+                frame = frames.get(thread_id)
+                if frame is None or thread_id == own_thread_id:
+                    continue
+                samples += 1
+                if os.path.basename(frame.f_code.co_filename) in waiting_file_names:
+                    waiting_samples += 1
+                else:
+                    self_samples[get_code_location(frame.f_code)] += 1
+                seen = set()
+                while frame is not None:
+                    code = frame.f_code
+                    if (
+                        code.co_filename.startswith(source_directory)
+                        and code not in seen
+                    ):
+                        seen.add(code)
+                        cumulative_samples[get_code_location(code)] += 1
+                    frame = frame.f_back
+            del frames
+
+        duration = time.monotonic() - start
+        allocations = []
+        if trace_allocations:
+            allocations = tracemalloc.take_snapshot().compare_to(
+                first_snapshot, "lineno"
+            )
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+        with self._lock:
+            profiled_commands = self.profiled_commands
+            report_callback = self._report_callback
+            self._sampler = None
+            self._report_callback = None
+
+        report = get_profile_report(
+            profiled_commands=profiled_commands,
+            duration=duration,
+            samples=samples,
+            waiting_samples=waiting_samples,
+            self_samples=self_samples,
+            cumulative_samples=cumulative_samples,
+            allocations=allocations,
+            top_entries=self.profiler_config["top_entries"],
+        )
+        logger.info(report)
+        try:
+            report_callback(report)
+        except Exception:
+            logger.exception(msg="Cannot deliver the profiler report")
+
+
+def get_code_location(code):
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+def get_profile_report(
+    profiled_commands: int,
+    duration: float,
+    samples: int,
+    waiting_samples: int,
+    self_samples: Counter,
+    cumulative_samples: Counter,
+    allocations: list,
+    top_entries: int,
+):
+    """
+    Renders the profiler results as plain text
+
+    Parameters
+    ==========
+    profiled_commands: 'int'
+        number of commands which have finished while profiling
+    duration: 'float'
+        profiling duration in seconds
+    samples / waiting_samples: 'int'
+        number of stack samples (of busy threads) and the number
+        of samples in which the thread was waiting
+    self_samples: 'Counter'
+        samples per innermost function (without the waiting samples)
+    cumulative_samples: 'Counter'
+        samples per function of our own modules anywhere on the stack
+    allocations: 'list'
+        tracemalloc StatisticDiff list
+    top_entries: 'int'
+        number of entries per section
+
+    Returns
+    =======
+    report: 'str'
+        profiler report
+    """
+
+    lines = [
+        f"Profile of {profiled_commands} commands: {duration:.1f}s, {samples} samples, "
+        f"{waiting_samples / samples if samples else 0.0:.0%} waiting for I/O or locks"
+    ]
+    lines.append("")
+    lines.append("CPU hot spots (share of samples)")
+    for location, count in self_samples.most_common(top_entries):
+        lines.append(f"{count / samples:6.1%}  {location}")
+    lines.append("")
+    lines.append("Own functions incl. callees and waits")
+    for location, count in cumulative_samples.most_common(top_entries):
+        lines.append(f"{count / samples:6.1%}  {location}")
+    lines.append("")
+    lines.append("Allocation hot spots (net growth)")
+    allocations = sorted(
+        (allocation for allocation in allocations if allocation.size_diff > 0),
+        key=lambda allocation: allocation.size_diff,
+        reverse=True,
+    )
+    for allocation in allocations[:top_entries]:
+        frame = allocation.traceback[0]
+        lines.append(
+            f"{allocation.size_diff / 1024:8.1f} KiB  {os.path.basename(frame.filename)}:{frame.lineno} ({allocation.count_diff} blocks)"
+        )
+    return "\n".join(lines)
+
+
+def get_command_profiler():
+    """
+    Returns the command profiler; it gets created on first use
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    command_profiler: 'CommandProfiler'
+        the command profiler
+    """
+
+    global command_profiler
+
+    with command_profiler_lock:
+        if command_profiler is None:
+            command_profiler = CommandProfiler(
+                profiler_config=read_config_section(
+                    section_name="profiler_config", defaults=profiler_config_defaults
+                )
+            )
+    return command_profiler
+
+
+if __name__ == "__main__":
+    from scheduler_modules import FairScheduler
+
+    def busy_task(number: int):
+        total = 0
+        for value in range(20000):
+            total += value * number
+        get_command_profiler().command_finished()
+        return total
+
+    scheduler = FairScheduler(name="demo", worker_threads=2)
+    report_ready = threading.Event()
+    get_command_profiler().start(
+        commands=20, report_callback=lambda report: report_ready.set()
+    )
+    for number in range(20):
+        scheduler.submit(number % 2, busy_task, number)
+    report_ready.wait(timeout=60)
+    scheduler.shutdown(wait=True)
@@ -28,18 +28,156 @@ import logging
 from telegram.ext import Updater
 from telegram.ext import CommandHandler
 from telegram import ParseMode
+from telegram.error import TelegramError, RetryAfter
+from telegram.ext.extbot import ExtBot
+from telegram.utils.request import Request
 from telegram.ext import MessageHandler, Filters
-from utility_modules import read_program_config
-from radiosonde_modules import get_radiosonde_landing_prediction, get_radiosondy_data
+from utility_modules import read_program_config, read_config_section
+from radiosonde_modules import (
+    get_radiosonde_landing_report,
+    get_radiosondy_data,
+    get_clmb_from_comment,
+)
+from aprsdotfi_modules import get_aprsfi_report
+from record_modules import RadiosondySnapshot
 from geopy_modules import get_reverse_geopy_data
+from geocoder_modules import get_offline_geocoder
+from watch_modules import (
+    WatchRegistry,
+    watch_config_defaults,
+    get_flight_phase,
+    get_watch_fingerprint,
+)
+from scheduler_modules import (
+    FairScheduler,
+    submit_accepted,
+    submit_key_queue_full,
+)
+from cache_modules import ExpiringCache, SingleFlight, get_cache_statistics
+from http_modules import get_upstream_statistics
+from tracing_modules import start_trace, trace_span, add_span
+from profiler_modules import get_command_profiler
+from outbox_modules import (
+    Outbox,
+    outbox_config_defaults,
+    watch_lane,
+)
+from prefetch_modules import Prefetcher, prefetch_config_defaults
+from metrics_modules import (
+    command_seconds,
+    metrics_config_defaults,
+    start_metrics_server,
+    telegram_delivery_seconds,
+    telegram_errors_total,
+    telegram_request_seconds,
+    upstream_errors_total,
+    upstream_request_seconds,
+)
+from concurrent.futures import wait, FIRST_COMPLETED
+from datetime import datetime
+from html import escape
 import sys
 import signal
+import time
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
 )
 logger = logging.getLogger(__name__)
 
+# Default settings for the optional 'radiobot_config' config file section
+# sonde_worker_threads: upper limit for the number of upstream pipelines
+# (habhub / radiosondy) that get executed in parallel across all /sonde
+# commands. A value of 1 runs all queries sequentially.
+# live_message_editing: render the results for each radiosonde into a
+# single message which gets edited in place as each source completes.
+# If disabled, each result line is sent as a separate message
+# command_worker_threads: number of /sonde commands that get executed
+# in parallel; the commands of all chats are served round-robin
+# max_queued_commands / max_queued_commands_per_chat: commands beyond
+# these limits get rejected with a 'busy' message
+# max_running_commands_per_chat: number of commands per chat that get
+# executed in parallel
+# rendered_messages_ttl: seconds for which the rendered results of a
+# radiosonde get reused for other chats (0 = coalesce only requests
+# which arrive while the upstream queries are still running)
+# admin_chat_ids: comma-separated Telegram chat IDs which may use
+# the admin commands (/stats, /profile)
+radiobot_config_defaults = {
+    "sonde_worker_threads": 8,
+    "live_message_editing": True,
+    "command_worker_threads": 4,
+    "max_queued_commands": 50,
+    "max_queued_commands_per_chat": 3,
+    "max_running_commands_per_chat": 1,
+    "rendered_messages_ttl": 10.0,
+    "admin_chat_ids": "",
+}
+
+# Concurrent /sonde commands for the same radiosonde share the upstream
+# queries and the rendered results (see get_coalesced_messages())
+rendered_message_flights = SingleFlight(name="rendered_messages")
+rendered_message_cache = None
+
+# Fairness key of the watch polls on the pipeline scheduler; the polls
+# of all watched radiosondes share their turn with the /sonde commands
+watch_scheduler_key = "watch"
+
+# The prefetcher's refreshes of the most requested radiosondes get
+# their own fairness key, too; prefetcher is None if it is not running
+prefetch_scheduler_key = "prefetch"
+prefetcher = None
+
+
+class InstrumentedBot(ExtBot):
+    """
+    Telegram bot which records the latency and the errors
+    of its send_message and edit_message_text calls
+    """
+
+    def send_message(self, *args, **kwargs):
+        return observe_telegram_call(
+            "send_message", super().send_message, *args, **kwargs
+        )
+
+    def edit_message_text(self, *args, **kwargs):
+        return observe_telegram_call(
+            "edit_message_text", super().edit_message_text, *args, **kwargs
+        )
+
+
+def observe_telegram_call(method: str, function, *args, **kwargs):
+    """
+    Executes a Telegram API call and records its latency and errors
+
+    Parameters
+    ==========
+    method: 'str'
+        Telegram API method name, e.g. 'send_message'
+    function: 'callable'
+        the API call
+    args / kwargs:
+        API call arguments
+
+    Returns
+    =======
+    result:
+        the API call's result
+    """
+
+    start = time.monotonic()
+    try:
+        with trace_span(f"telegram_{method}"):
+            return function(*args, **kwargs)
+    except RetryAfter:
+        telegram_errors_total.inc(method=method, reason="retry_after")
+        raise
+    except TelegramError:
+        telegram_errors_total.inc(method=method, reason="error")
+        raise
+    finally:
+        telegram_request_seconds.observe(time.monotonic() - start, method=method)
+
 
 def signal_term_handler(signal_number, frame):
     """
@@ -63,16 +201,16 @@ def signal_term_handler(signal_number, frame):
 
 
 def start(update, context):
-    context.bot.send_message(
+    outbox.send_message(
         chat_id=update.effective_chat.id,
         text="73 de DF1JSL's/DB4BIN's Telegram radiosonde landing prediction bot",
     )
-    context.bot.send_message(
+    outbox.send_message(
         chat_id=update.effective_chat.id,
-        text="Use command <pre>/sonde [radiosonde-id]</pre> for requesting the landing prediction information",
+        text="Use command <pre>/sonde [radiosonde-id]</pre> for requesting the landing prediction information and <pre>/watch [radiosonde-id]</pre> for getting updates during the flight",
         parse_mode=ParseMode.HTML,
     )
-    context.bot.send_message(
+    outbox.send_message(
         chat_id=update.effective_chat.id,
         text="Source code & further info: https://www.github.com/joergschultzelutter/radiosonde-telegram-bot",
         parse_mode=ParseMode.HTML,
@@ -80,195 +218,972 @@ def start(update, context):
     )
 
 
+def get_habhub_messages(sonde_id: str):
+    """
+    Runs the predict.habhub.org pipeline for a single radiosonde:
+    aprs.fi position, habhub landing prediction and the reverse
+    lookup of the landing point's address
+
+    Parameters
+    ==========
+    sonde_id: 'str'
+        Radiosonde ID (upper case)
+
+    Returns
+    =======
+    success: 'bool'
+        True if habhub provided a landing prediction
+    messages: 'list'
+        HTML-formatted message texts for the user
+    """
+
+    prediction = get_radiosonde_landing_report(
+        aprsfi_callsign=sonde_id, aprsdotfi_api_key=aprsdotfi_api_key
+    )
+    return render_habhub_messages(
+        sonde_id=sonde_id,
+        success=prediction.success,
+        lat=prediction.latitude,
+        lon=prediction.longitude,
+        timestamp=prediction.timestamp,
+        landing_url=prediction.url,
+        landing_ellipse=prediction.ellipse,
+    )
+
+
+def render_habhub_messages(
+    sonde_id: str,
+    success: bool,
+    lat: float,
+    lon: float,
+    timestamp: datetime,
+    landing_url: str = None,
+    landing_ellipse: dict = None,
+):
+    """
+    Renders a habhub landing prediction, including the reverse
+    lookup of the landing point's address
+
+    Parameters
+    ==========
+    sonde_id: 'str'
+        Radiosonde ID (upper case)
+    success: 'bool'
+        True if habhub provided a landing prediction
+    lat / lon: 'float'
+        Predicted landing point
+    timestamp: 'datetime'
+        Predicted landing time
+    landing_url: 'str'
+        habhub.org URL of the prediction; None if the prediction
+        comes from the local prediction model
+    landing_ellipse: 'dict'
+        landing ellipse of the prediction ensemble (or None)
+
+    Returns
+    =======
+    success: 'bool'
+        True if habhub provided a landing prediction
+    messages: 'list'
+        HTML-formatted message texts for the user
+    """
+
+    messages = []
+    if success:
+        if landing_url:
+            messages.append(f"<b><u>Habhub information for <i>{sonde_id}</i></u></b>")
+        else:
+            messages.append(
+                f"<b><u>Local landing prediction for <i>{sonde_id}</i></u></b>"
+            )
+        messages.append(
+            f"<b>Landing prediction:</b> landing time ={timestamp.strftime('%d-%b-%Y %H:%M:%S')} UTC, latitude = {lat}, longitude={lon} <a href=\"https://maps.google.com/?q={lat},{lon}\">(Google Maps link)</a>"
+        )
+        if landing_ellipse:
+            messages.append(get_landing_ellipse_message(landing_ellipse))
+        geopy_success, address = get_reverse_geopy_data(latitude=lat, longitude=lon)
+        if geopy_success and address:
+            messages.append(f"<b>Address:</b> {escape(address)}")
+    else:
+        messages.append(get_source_failure_message(sonde_id=sonde_id, source="habhub"))
+    return success, messages
+
+
+def get_landing_ellipse_message(landing_ellipse: dict):
+    """
+    Renders the landing ellipse of a prediction ensemble
+
+    Parameters
+    ==========
+    landing_ellipse: 'dict'
+        see get_ensemble_landing_prediction()
+
+    Returns
+    =======
+    message: 'str'
+        HTML-formatted message text for the user
+    """
+
+    major_km = landing_ellipse["semi_major_axis"] / 1000
+    minor_km = landing_ellipse["semi_minor_axis"] / 1000
+    time_minutes = landing_ellipse["time_sigma"] / 60
+    return (
+        f"<b>Landing uncertainty:</b> 1σ ellipse {major_km:.1f} x {minor_km:.1f} km, "
+        f"2σ ellipse {2 * major_km:.1f} x {2 * minor_km:.1f} km "
+        f"(major axis {landing_ellipse['azimuth']:.0f}°), "
+        f"landing time ±{time_minutes:.0f} min "
+        f"({landing_ellipse['members']} simulated flights)"
+    )
+
+
+def get_radiosondy_messages(sonde_id: str):
+    """
+    Runs the radiosondy.info pipeline for a single radiosonde:
+    radiosondy.info scrape plus the reverse lookups of the
+    landing point's and last known position's addresses
+
+    Parameters
+    ==========
+    sonde_id: 'str'
+        Radiosonde ID (upper case)
+
+    Returns
+    =======
+    success: 'bool'
+        True if radiosondy.info provided data for this radiosonde
+    messages: 'list'
+        HTML-formatted message texts for the user
+    """
+
+    success, radiosondy_response_data = get_radiosondy_data(sonde_id=sonde_id)
+    return render_radiosondy_messages(
+        sonde_id=sonde_id,
+        success=success,
+        radiosondy_response_data=radiosondy_response_data,
+    )
+
+
+def render_radiosondy_messages(
+    sonde_id: str, success: bool, radiosondy_response_data: RadiosondySnapshot
+):
+    """
+    Renders the radiosondy.info data of a radiosonde, including the
+    reverse lookups of the landing point's and last known position's
+    addresses
+
+    Parameters
+    ==========
+    sonde_id: 'str'
+        Radiosonde ID (upper case)
+    success: 'bool'
+        True if radiosondy.info provided data for this radiosonde
+    radiosondy_response_data: 'RadiosondySnapshot'
+        see get_radiosondy_data()
+
+    Returns
+    =======
+    success: 'bool'
+        True if radiosondy.info provided data for this radiosonde
+    messages: 'list'
+        HTML-formatted message texts for the user
+    """
+
+    messages = []
+    if not success:
+        messages.append(
+            get_source_failure_message(sonde_id=sonde_id, source="radiosondy")
+        )
+        return success, messages
+
+    messages.append(f"<b><u>Radiosondy information for '{sonde_id}'</u></b>")
+    launch_site = radiosondy_response_data.launch_site
+    if launch_site:
+        messages.append(f"<b>Launch Site:</b> {escape(launch_site)}")
+
+    probe_status = radiosondy_response_data.probe_status
+    if probe_status:
+        messages.append(f"<b>Probe Status:</b> {escape(probe_status)}")
+
+    landing_point_latitude = radiosondy_response_data.landing_point_latitude
+    landing_point_longitude = radiosondy_response_data.landing_point_longitude
+    if landing_point_latitude != 0.0 and landing_point_longitude != 0.0:
+        messages.append(
+            f'<b>Landing point:</b> Lat {landing_point_latitude} / Lon {landing_point_longitude} <a href="https://maps.google.com/?q={landing_point_latitude},{landing_point_longitude}">(Google Maps link)</a>'
+        )
+        geopy_success, address = get_reverse_geopy_data(
+            latitude=landing_point_latitude,
+            longitude=landing_point_longitude,
+        )
+        if geopy_success and address:
+            messages.append(f"<b>Landing point address data:</b> {escape(address)}")
+    else:
+        landing_point = radiosondy_response_data.landing_point
+        if landing_point:
+            messages.append(
+                f"<b>Landing Point raw coordinates:</b> {escape(landing_point)}"
+            )
+
+    landing_description = radiosondy_response_data.landing_description
+    if landing_description:
+        messages.append(f"<b>Landing description:</b> {escape(landing_description)}")
+
+    altitude = radiosondy_response_data.altitude_m
+    if altitude is not None:
+        messages.append(f"<b>Current altitude:</b> {altitude:g} m")
+
+    climbing = radiosondy_response_data.climbing_meters_per_second
+    if climbing is not None:
+        messages.append(f"<b>Climbing:</b> {climbing:g} m/s")
+
+    avg_ascent_speed = radiosondy_response_data.avg_ascent_speed
+    if avg_ascent_speed is not None:
+        messages.append(f"<b>Average Ascent Speed:</b> {avg_ascent_speed:g} m/s")
+
+    avg_descent_speed = radiosondy_response_data.avg_descent_speed
+    if avg_descent_speed is not None:
+        messages.append(f"<b>Average Descent Speed:</b> {avg_descent_speed:g} m/s")
+
+    latitude = radiosondy_response_data.latitude
+    longitude = radiosondy_response_data.longitude
+    if latitude is not None and longitude is not None:
+        messages.append(
+            f'<b>Last coordinates on <pre>aprs.fi</pre></b>: Lat {latitude} / Lon {longitude} <a href="https://maps.google.com/?q={latitude},{longitude}">(Google Maps link)</a>'
+        )
+        geopy_success, address = get_reverse_geopy_data(
+            latitude=latitude, longitude=longitude
+        )
+        if geopy_success and address:
+            messages.append(
+                f"<b><pre>aprs.fi</pre> address data:</b> {escape(address)}"
+            )
+    return success, messages
+
+
+def get_source_failure_message(sonde_id: str, source: str):
+    """
+    Returns the message that we send to the user in case
+    a data source did not provide anything for a radiosonde
+
+    Parameters
+    ==========
+    sonde_id: 'str'
+        Radiosonde ID (upper case)
+    source: 'str'
+        data source ('habhub' or 'radiosondy')
+
+    Returns
+    =======
+    message: 'str'
+        HTML-formatted message text
+    """
+
+    if source == "habhub":
+        return f"<i><pre>predict.habhub.org</pre> did not provide any data for '{sonde_id}'. Either the site is down or your probe does not exist</i>"
+    return f"<i><pre>Radiosondy.info</pre> did not provide any data for '{sonde_id}'. Either the site is down or your probe does not exist.</i>"
+
+
+# Source pipelines that get executed for each radiosonde:
+# data source, progress message and pipeline function
+sonde_sources = [
+    (
+        "habhub",
+        "<i>Querying position data for '{sonde_id}' on <pre>predict.habhub.org</pre></i>",
+        get_habhub_messages,
+    ),
+    (
+        "radiosondy",
+        "<i>Querying position data for '{sonde_id}' on <pre>radiosondy.info</pre> - this might take a while</i>",
+        get_radiosondy_messages,
+    ),
+]
+
+
+def get_pipeline_result(future, sonde_id: str, source: str):
+    """
+    Returns the result of a finished source pipeline. Pipelines
+    which have failed with an exception are reported as 'no data'
+
+    Parameters
+    ==========
+    future: 'Future'
+        Future of the source pipeline
+    sonde_id: 'str'
+        Radiosonde ID (upper case)
+    source: 'str'
+        data source ('habhub' or 'radiosondy')
+
+    Returns
+    =======
+    success: 'bool'
+        True if the source provided data for this radiosonde
+    messages: 'list'
+        HTML-formatted message texts for the user
+    """
+
+    try:
+        success, messages = future.result()
+    except Exception:
+        logger.exception(msg=f"Query for '{sonde_id}' on {source} has failed")
+        success = False
+        messages = [get_source_failure_message(sonde_id=sonde_id, source=source)]
+    return success, messages
+
+
+def get_coalesced_messages(source: str, pipeline, sonde_id: str):
+    """
+    Runs a source pipeline for a radiosonde. Concurrent requests for
+    the same radiosonde and source wait for a single pipeline run;
+    its results are also reused for 'rendered_messages_ttl' seconds
+
+    Parameters
+    ==========
+    source: 'str'
+        data source ('habhub' or 'radiosondy')
+    pipeline: 'callable'
+        pipeline function of the data source
+    sonde_id: 'str'
+        Radiosonde ID (upper case)
+
+    Returns
+    =======
+    success: 'bool'
+        True if the source provided data for this radiosonde
+    messages: 'list'
+        HTML-formatted message texts for the user
+    """
+
+    key = (source, sonde_id)
+    found_in_cache = False
+    with trace_span(f"{source}_pipeline", sonde_id=sonde_id) as span:
+        if rendered_message_cache is not None:
+            found_in_cache, result = rendered_message_cache.get(key)
+        span.set_attribute("cached", found_in_cache)
+        if not found_in_cache:
+            result = rendered_message_flights.do(
+                key, run_pipeline, cache_key=key, pipeline=pipeline, sonde_id=sonde_id
+            )
+    success, messages = result
+    return success, list(messages)
+
+
+def run_pipeline(cache_key: tuple, pipeline, sonde_id: str):
+    result = pipeline(sonde_id)
+    if rendered_message_cache is not None:
+        rendered_message_cache.set(cache_key, result)
+    return result
+
+
+def prefetch_sonde(sonde_id: str, min_ttl: float):
+    """
+    Prefetcher callback: runs the source pipelines of a radiosonde
+    whose rendered results expire within the next 'min_ttl' seconds,
+    which also refreshes the aprs.fi, habhub, radiosondy.info and
+    geocoder caches that they use
+
+    Parameters
+    ==========
+    sonde_id: 'str'
+        Radiosonde ID (upper case)
+    min_ttl: 'float'
+        results which stay valid for longer are not refreshed
+
+    Returns
+    =======
+    probe_status: 'str'
+        radiosondy.info probe status; None if the radiosondy.info
+        results have not been refreshed
+    """
+
+    probe_status = None
+
+    def get_radiosondy_messages_and_status(sonde_id: str):
+        nonlocal probe_status
+        success, radiosondy_response_data = get_radiosondy_data(sonde_id=sonde_id)
+        probe_status = radiosondy_response_data.probe_status
+        return render_radiosondy_messages(
+            sonde_id=sonde_id,
+            success=success,
+            radiosondy_response_data=radiosondy_response_data,
+        )
+
+    pipelines = {
+        "habhub": get_habhub_messages,
+        "radiosondy": get_radiosondy_messages_and_status,
+    }
+    with start_trace("prefetch", sonde_id=sonde_id):
+        for source, _, _ in sonde_sources:
+            key = (source, sonde_id)
+            if rendered_message_cache is not None:
+                ttl = rendered_message_cache.get_remaining_ttl(key)
+                if ttl is not None and ttl > min_ttl:
+                    continue
+            with trace_span(f"{source}_pipeline", sonde_id=sonde_id):
+                rendered_message_flights.do(
+                    key,
+                    run_pipeline,
+                    cache_key=key,
+                    pipeline=pipelines[source],
+                    sonde_id=sonde_id,
+                )
+    return probe_status
+
+
+def render_sonde_message(sonde_id: str, sections: dict):
+    """
+    Renders all results for a radiosonde into a single HTML message.
+    Sources which are still running are shown with their progress message
+
+    Parameters
+    ==========
+    sonde_id: 'str'
+        Radiosonde ID (upper case)
+    sections: 'dict'
+        (success, messages) tuples of the completed sources, keyed by source
+
+    Returns
+    =======
+    text: 'str'
+        HTML-formatted message text
+    """
+
+    blocks = []
+    for source, progress_message, _ in sonde_sources:
+        if source in sections:
+            _, messages = sections[source]
+            blocks.append("\n".join(messages))
+        else:
+            blocks.append(progress_message.format(sonde_id=sonde_id))
+    if len(sections) == len(sonde_sources) and not any(
+        success for success, _ in sections.values()
+    ):
+        blocks.append(f"Didn't find anything on radiosonde '{sonde_id}'")
+    return "\n\n".join(blocks)
+
+
 def sonde(update, context):
-    for sonde in context.args:
-        sonde = sonde.upper()
-        if len(sonde) > 0:
-            found_something = False
-            # Run the query on habhub.org
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"<i>Querying position data for '{sonde}' on <pre>predict.habhub.org</pre></i>",
+    chat_id = update.effective_chat.id
+
+    sonde_ids = []
+    for sonde_id in context.args:
+        sonde_id = sonde_id.upper()
+        if len(sonde_id) > 0 and sonde_id not in sonde_ids:
+            sonde_ids.append(sonde_id)
+
+    # Fan out the upstream pipelines for all requested radiosondes
+    # and all data sources to our bounded worker pool. Results get
+    # delivered to the user as soon as their source has finished.
+    futures = {}
+    sections = {}
+    live_messages = {}
+    for sonde_id in sonde_ids:
+        sections[sonde_id] = {}
+        if prefetcher is not None:
+            prefetcher.record_request(sonde_id)
+        for source, progress_message, pipeline in sonde_sources:
+            _, future = pipeline_scheduler.submit(
+                chat_id,
+                get_coalesced_messages,
+                source=source,
+                pipeline=pipeline,
+                sonde_id=sonde_id,
+            )
+            if future:
+                futures[future] = (sonde_id, source)
+        if live_message_editing:
+            live_messages[sonde_id] = outbox.send_message(
+                chat_id=chat_id,
+                text=render_sonde_message(sonde_id=sonde_id, sections={}),
+                editable=True,
                 parse_mode=ParseMode.HTML,
                 disable_web_page_preview=True,
             )
-            (
-                success,
-                lat,
-                lon,
-                timestamp,
-                landing_url,
-            ) = get_radiosonde_landing_prediction(
-                aprsfi_callsign=sonde, aprsdotfi_api_key=aprsdotfi_api_key
-            )
-            if success:
-                found_something = True
-                context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=f"<b><u>Habhub information for <i>{sonde}</i></u></b>",
-                    parse_mode=ParseMode.HTML,
-                )
-                context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=f"<b>Landing prediction:</b> landing time ={timestamp.strftime('%d-%b-%Y %H:%M:%S')} UTC, latitude = {lat}, longitude={lon} <a href=\"https://maps.google.com/?q={lat},{lon}\">(Google Maps link)</a>",
+        else:
+            for source, progress_message, _ in sonde_sources:
+                outbox.send_message(
+                    chat_id=chat_id,
+                    text=progress_message.format(sonde_id=sonde_id),
                     parse_mode=ParseMode.HTML,
                     disable_web_page_preview=True,
                 )
-                success, address = get_reverse_geopy_data(latitude=lat, longitude=lon)
-                if success and address:
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f"<b>Address:</b> {address}",
+
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+        # Several sources may have finished at the same time; in that
+        # case, we only update each radiosonde's message once
+        updated_sonde_ids = []
+        for future in done:
+            sonde_id, source = futures[future]
+            success, messages = get_pipeline_result(
+                future=future, sonde_id=sonde_id, source=source
+            )
+            sections[sonde_id][source] = (success, messages)
+            if sonde_id not in updated_sonde_ids:
+                updated_sonde_ids.append(sonde_id)
+            if not live_message_editing:
+                for message in messages:
+                    outbox.send_message(
+                        chat_id=chat_id,
+                        text=message,
                         parse_mode=ParseMode.HTML,
+                        disable_web_page_preview=True,
                     )
-            else:
-                context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=f"<i><pre>predict.habhub.org</pre> did not provide any data for '{sonde}'. Either the site is down or your probe does not exist</i>",
+
+        for sonde_id in updated_sonde_ids:
+            if live_message_editing:
+                text = render_sonde_message(
+                    sonde_id=sonde_id, sections=sections[sonde_id]
+                )
+                # The outbox folds this into the queued message or edit if
+                # Telegram has not got it yet, and falls back to sending a
+                # new message if the message cannot be edited
+                outbox.edit_message_text(
+                    live_messages[sonde_id],
+                    text=text,
                     parse_mode=ParseMode.HTML,
+                    disable_web_page_preview=True,
                 )
-            # Run the query on radiosondy.info
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"<i>Querying position data for '{sonde}' on <pre>radiosondy.info</pre> - this might take a while</i>",
+            elif len(sections[sonde_id]) == len(sonde_sources) and not any(
+                success for success, _ in sections[sonde_id].values()
+            ):
+                outbox.send_message(
+                    chat_id=chat_id,
+                    text=f"Didn't find anything on radiosonde '{sonde_id}'",
+                )
+
+
+def watch(update, context):
+    chat_id = update.effective_chat.id
+
+    sonde_ids = []
+    for sonde_id in context.args:
+        sonde_id = sonde_id.upper()
+        if len(sonde_id) > 0 and sonde_id not in sonde_ids:
+            sonde_ids.append(sonde_id)
+    if not sonde_ids:
+        outbox.send_message(
+            chat_id=chat_id,
+            text="Use command <pre>/watch [radiosonde-id]</pre> for getting updates whenever the landing prediction or the position of a radiosonde changes",
+            parse_mode=ParseMode.HTML,
+        )
+        return
+
+    for sonde_id in sonde_ids:
+        status, last_text = watch_registry.watch(chat_id=chat_id, sonde_id=sonde_id)
+        if status == "limit_reached":
+            text = f"<i>You are already watching {watch_config['max_watches_per_chat']} radiosondes; use <pre>/unwatch</pre> before watching '{sonde_id}'</i>"
+        elif status == "already_watching":
+            text = f"<i>You are already watching '{sonde_id}'</i>"
+        else:
+            text = f"<i>Watching '{sonde_id}'; you will get an update whenever its landing prediction or position changes</i>"
+        outbox.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
+
+        # Another chat is already watching this radiosonde
+        if last_text:
+            outbox.send_message(
+                chat_id=chat_id,
+                text=last_text,
                 parse_mode=ParseMode.HTML,
                 disable_web_page_preview=True,
             )
-            success, radiosondy_response_data = get_radiosondy_data(sonde_id=sonde)
-            if success:
-                found_something = True
-                context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=f"<b><u>Radiosondy information for '{sonde}'</u></b>",
-                    parse_mode=ParseMode.HTML,
-                )
-                launch_site = radiosondy_response_data["launch_site"]
-                if launch_site:
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f"<b>Launch Site:</b> {launch_site}",
-                        parse_mode=ParseMode.HTML,
-                    )
 
-                probe_status = radiosondy_response_data["probe_status"]
-                if probe_status:
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f"<b>Probe Status:</b> {probe_status}",
-                        parse_mode=ParseMode.HTML,
-                    )
-                landing_point_latitude = radiosondy_response_data[
-                    "landing_point_latitude"
-                ]
-                landing_point_longitude = radiosondy_response_data[
-                    "landing_point_longitude"
-                ]
-                if landing_point_latitude != 0.0 and landing_point_longitude != 0.0:
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f'<b>Landing point:</b> Lat {landing_point_latitude} / Lon {landing_point_longitude} <a href="https://maps.google.com/?q={landing_point_latitude},{landing_point_longitude}">(Google Maps link)</a>',
-                        parse_mode=ParseMode.HTML,
-                        disable_web_page_preview=True,
-                    )
-                    success, address = get_reverse_geopy_data(
-                        latitude=landing_point_latitude,
-                        longitude=landing_point_longitude,
-                    )
-                    if success and address:
-                        context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=f"<b>Landing point address data:</b> {address}",
-                            parse_mode=ParseMode.HTML,
-                        )
-                else:
-                    landing_point = radiosondy_response_data["landing_point"]
-                    if landing_point:
-                        context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=f"<b>Landing Point raw coordinates:</b> {landing_point}",
-                            parse_mode=ParseMode.HTML,
-                        )
-                landing_description = radiosondy_response_data["landing_description"]
-                if landing_description:
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f"<b>Landing description:</b> {landing_description}",
-                        parse_mode=ParseMode.HTML,
-                    )
-                max_speed = radiosondy_response_data["max_speed"]
-                max_speed_height = radiosondy_response_data["max_speed_height"]
-
-                altitude = radiosondy_response_data["altitude_m"]
-                if altitude:
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f"<b>Current altitude:</b> {altitude} m",
-                        parse_mode=ParseMode.HTML,
-                    )
 
-                climbing = radiosondy_response_data["climbing_meters_per_second"]
-                if climbing:
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f"<b>Climbing:</b> {climbing} m/s",
-                        parse_mode=ParseMode.HTML,
-                    )
+def unwatch(update, context):
+    chat_id = update.effective_chat.id
 
-                avg_ascent_speed = radiosondy_response_data["avg_ascent_speed"]
-                if avg_ascent_speed:
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f"<b>Average Ascent Speed:</b> {avg_ascent_speed} m/s",
-                        parse_mode=ParseMode.HTML,
-                    )
+    unwatched_sonde_ids = []
+    if context.args:
+        for sonde_id in context.args:
+            unwatched_sonde_ids.extend(
+                watch_registry.unwatch(chat_id=chat_id, sonde_id=sonde_id.upper())
+            )
+    else:
+        unwatched_sonde_ids = watch_registry.unwatch(chat_id=chat_id)
 
-                avg_descent_speed = radiosondy_response_data["avg_descent_speed"]
-                if avg_descent_speed:
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f"<b>Average Descent Speed:</b> {avg_descent_speed} m/s",
-                        parse_mode=ParseMode.HTML,
-                    )
+    if unwatched_sonde_ids:
+        text = f"<i>No longer watching {', '.join(repr(sonde_id) for sonde_id in unwatched_sonde_ids)}</i>"
+    else:
+        text = "<i>You are not watching any of these radiosondes</i>"
+    outbox.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
 
-                latitude = radiosondy_response_data["latitude"]
-                longitude = radiosondy_response_data["longitude"]
-                if latitude and longitude:
-                    context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=f'<b>Last coordinates on <pre>aprs.fi</pre></b>: Lat {latitude} / Lon {longitude} <a href="https://maps.google.com/?q={latitude},{longitude}">(Google Maps link)</a>',
-                        parse_mode=ParseMode.HTML,
-                        disable_web_page_preview=True,
-                    )
-                    success, address = get_reverse_geopy_data(
-                        latitude=latitude, longitude=longitude
-                    )
-                    if success and address:
-                        context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=f"<b><pre>aprs.fi</pre> address data:</b> {address}",
-                            parse_mode=ParseMode.HTML,
-                        )
-            else:
-                context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=f"<i><pre>Radiosondy.info</pre> did not provide any data for '{sonde}'. Either the site is down or your probe does not exist.</i>",
-                    parse_mode=ParseMode.HTML,
-                )
-            if not found_something:
-                context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=f"Didn't find anything on radiosonde '{sonde}'",
-                )
+
+def send_watch_message(chat_ids: list, text: str, replace_key=None):
+    """
+    Queues a message to all subscribers of a watched radiosonde
+    on the outbox's watch lane
+
+    Parameters
+    ==========
+    chat_ids: 'list'
+        Telegram chat IDs
+    text: 'str'
+        HTML-formatted message text
+    replace_key: 'hashable'
+        a still queued message with the same key gets replaced
+        by this one (see Outbox.send_message())
+
+    Returns
+    =======
+    """
+
+    for chat_id in chat_ids:
+        outbox.send_message(
+            chat_id=chat_id,
+            text=text,
+            lane=watch_lane,
+            replace_key=replace_key,
+            parse_mode=ParseMode.HTML,
+            disable_web_page_preview=True,
+        )
+
+
+def poll_watched_sonde(sonde_id: str):
+    """
+    Polls a watched radiosonde once on behalf of all of its subscribers.
+    They only get a message if the landing prediction or the position
+    has changed; the watch ends once the radiosonde has landed
+
+    Parameters
+    ==========
+    sonde_id: 'str'
+        Radiosonde ID (upper case)
+
+    Returns
+    =======
+    """
+
+    try:
+        # The position report is cached; the landing prediction reuses it
+        position = get_aprsfi_report(
+            aprsfi_callsign=sonde_id, aprsdotfi_api_key=aprsdotfi_api_key
+        )
+        prediction = get_radiosonde_landing_report(
+            aprsfi_callsign=sonde_id, aprsdotfi_api_key=aprsdotfi_api_key
+        )
+        radiosondy_success, radiosondy_response_data = get_radiosondy_data(
+            sonde_id=sonde_id
+        )
+    except Exception:
+        logger.exception(msg=f"Cannot poll watched radiosonde '{sonde_id}'")
+        watch_registry.complete_poll(sonde_id=sonde_id)
+        return
+
+    clmb = (
+        get_clmb_from_comment(probe_comment=position.comment)
+        if position.comment
+        else None
+    )
+    if clmb is None:
+        clmb = radiosondy_response_data.climbing_meters_per_second
+    latitude, longitude = position.latitude, position.longitude
+    if not position.success:
+        latitude = radiosondy_response_data.latitude
+        longitude = radiosondy_response_data.longitude
+        if latitude is None or longitude is None:
+            latitude = longitude = None
+
+    probe_status = radiosondy_response_data.probe_status
+    flight_phase = get_flight_phase(
+        probe_status=probe_status,
+        clmb=clmb,
+        landed_statuses=watch_config["landed_statuses"],
+    )
+    fingerprint = get_watch_fingerprint(
+        watch_config=watch_config,
+        prediction_success=prediction.success,
+        landing_latitude=prediction.latitude,
+        landing_longitude=prediction.longitude,
+        landing_timestamp=prediction.timestamp,
+        latitude=latitude,
+        longitude=longitude,
+        probe_status=probe_status,
+    )
+
+    # Only render (and reverse-geocode) if there is something new to tell
+    text = None
+    if watch_registry.has_changed(sonde_id=sonde_id, fingerprint=fingerprint):
+        sections = {
+            "habhub": render_habhub_messages(
+                sonde_id=sonde_id,
+                success=prediction.success,
+                lat=prediction.latitude,
+                lon=prediction.longitude,
+                timestamp=prediction.timestamp,
+                landing_url=prediction.url,
+                landing_ellipse=prediction.ellipse,
+            ),
+            "radiosondy": render_radiosondy_messages(
+                sonde_id=sonde_id,
+                success=radiosondy_success,
+                radiosondy_response_data=radiosondy_response_data,
+            ),
+        }
+        text = render_sonde_message(sonde_id=sonde_id, sections=sections)
+
+    changed, finished, chat_ids = watch_registry.complete_poll(
+        sonde_id=sonde_id, fingerprint=fingerprint, flight_phase=flight_phase, text=text
+    )
+    if changed:
+        # An update that is still queued is outdated by now
+        send_watch_message(
+            chat_ids=chat_ids, text=text, replace_key=("watch", sonde_id)
+        )
+    if finished:
+        send_watch_message(
+            chat_ids=chat_ids,
+            text=f"<i>Radiosonde '{sonde_id}' has landed ({escape(probe_status or '')}); no longer watching it</i>",
+        )
+
+
+def poll_watched_sondes(context):
+    """
+    Job queue callback: hands all watched radiosondes that are due
+    over to the worker pool and ends the expired watches
+
+    Parameters
+    ==========
+    context: 'telegram.ext.CallbackContext'
+        job context
+
+    Returns
+    =======
+    """
+
+    for sonde_id, chat_ids in watch_registry.remove_expired_watches():
+        send_watch_message(
+            chat_ids=chat_ids,
+            text=f"<i>Watch for '{sonde_id}' has expired; use <pre>/watch {sonde_id}</pre> to continue watching it</i>",
+        )
+    for sonde_id in watch_registry.get_due_sondes():
+        pipeline_scheduler.submit(
+            watch_scheduler_key, run_traced_poll, sonde_id=sonde_id
+        )
+
+
+def run_traced_poll(sonde_id: str):
+    with start_trace("watch_poll", sonde_id=sonde_id):
+        poll_watched_sonde(sonde_id=sonde_id)
+
+
+def schedule_command(handler):
+    """
+    Wraps a command handler so that it gets executed on the command
+    scheduler instead of the dispatcher thread. If the scheduler is
+    overloaded, the user gets a 'busy' message instead
+
+    Parameters
+    ==========
+    handler: 'callable'
+        command handler function (update, context)
+
+    Returns
+    =======
+    scheduled_handler: 'callable'
+        command handler function for the dispatcher
+    """
+
+    def scheduled_handler(update, context):
+        chat_id = update.effective_chat.id
+        status, _ = command_scheduler.submit(
+            chat_id, run_timed_command, handler, time.monotonic(), update, context
+        )
+        if status == submit_accepted:
+            return
+        logger.info(f"Rejected command from chat {chat_id}: {status}")
+        if status == submit_key_queue_full:
+            text = "You have too many pending requests. Please wait until they have been answered."
+        else:
+            text = "The bot is very busy right now. Please try again in a few minutes."
+        outbox.send_message(chat_id=chat_id, text=text)
+
+    return scheduled_handler
+
+
+def run_timed_command(handler, received: float, update, context):
+    """
+    Executes a command handler, records the command's end-to-end
+    latency (including the time that it has waited in the queue)
+    and writes its trace
+
+    Parameters
+    ==========
+    handler: 'callable'
+        command handler function (update, context)
+    received: 'float'
+        time.monotonic() when the command was received
+    update / context:
+        command handler arguments
+
+    Returns
+    =======
+    """
+
+    try:
+        with start_trace(
+            handler.__name__,
+            start=received,
+            chat_id=update.effective_chat.id,
+            args=list(context.args or []),
+        ):
+            add_span("queue_wait", start=received, end=time.monotonic())
+            handler(update, context)
+    finally:
+        command_seconds.observe(time.monotonic() - received, command=handler.__name__)
+        get_command_profiler().command_finished()
+
+
+def get_admin_chat_ids(admin_chat_ids: str):
+    """
+    Parses the admin_chat_ids setting
+
+    Parameters
+    ==========
+    admin_chat_ids: 'str'
+        comma-separated Telegram chat IDs
+
+    Returns
+    =======
+    chat_ids: 'set'
+        Telegram chat IDs
+    """
+
+    chat_ids = set()
+    for chat_id in admin_chat_ids.split(","):
+        try:
+            chat_ids.add(int(chat_id))
+        except ValueError:
+            if chat_id.strip():
+                logger.info(f"Ignoring invalid admin chat ID '{chat_id}'")
+    return chat_ids
+
+
+def get_stats_message():
+    """
+    Renders the bot's metrics for the /stats command
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    text: 'str'
+        HTML-formatted message text
+    """
+
+    lines = ["<b>Commands</b> (count, avg, p95)"]
+    for labels, count, average, p95 in command_seconds.get_summaries():
+        lines.append(f"/{labels['command']}: {count}, {average:.2f}s, ≤{p95:g}s")
+
+    errors = {}
+    for labels, value in upstream_errors_total.get_samples():
+        errors[labels["endpoint"]] = errors.get(labels["endpoint"], 0) + value
+    lines.append("\n<b>Upstreams</b> (count, avg, p95, errors)")
+    for labels, count, average, p95 in sorted(
+        upstream_request_seconds.get_summaries(),
+        key=lambda summary: summary[0]["endpoint"],
+    ):
+        lines.append(
+            f"{labels['endpoint']}: {count}, {average:.2f}s, ≤{p95:g}s, {errors.pop(labels['endpoint'], 0)}"
+        )
+    for endpoint, count in sorted(errors.items()):
+        lines.append(f"{endpoint}: {count} errors")
+    for upstream in get_upstream_statistics():
+        if upstream["state"] == "open":
+            lines.append(f"{upstream['name']}: <b>circuit breaker open</b>")
+
+    lines.append("\n<b>Caches</b> (hit ratio, entries)")
+    for cache in get_cache_statistics():
+        lines.append(f"{cache['name']}: {cache['hit_ratio']:.0%}, {cache['entries']}")
+
+    retry_after = sum(
+        value
+        for labels, value in telegram_errors_total.get_samples()
+        if labels["reason"] == "retry_after"
+    )
+    lines.append(f"\n<b>Telegram</b> (count, avg, p95); {retry_after:g} x 429")
+    for labels, count, average, p95 in telegram_request_seconds.get_summaries():
+        lines.append(f"{labels['method']}: {count}, {average:.2f}s, ≤{p95:g}s")
+
+    statistics = outbox.get_statistics()
+    queued = ", ".join(
+        f"{lane} {count}" for lane, count in statistics["queued"].items()
+    )
+    lines.append(
+        f"\n<b>Outbox</b>: {statistics['sent']} sent, {statistics['merged']} merged, {statistics['superseded']} superseded, {statistics['failed']} failed; queued: {queued}"
+    )
+    for labels, count, average, p95 in telegram_delivery_seconds.get_summaries():
+        lines.append(f"{labels['lane']} delivery: {count}, {average:.2f}s, ≤{p95:g}s")
+
+    if prefetcher is not None:
+        statistics = prefetcher.get_statistics()
+        skipped = sum(statistics["skipped"].values())
+        lines.append(
+            f"\n<b>Prefetch</b>: {statistics['refreshes']} refreshes, {skipped} skipped, {sum(statistics['upstream_requests'].values())} upstream requests"
+        )
+        lines.append(
+            f"hot: {escape(', '.join(statistics['hot_sondes']) or '-')}; landed: {escape(', '.join(statistics['landed_sondes']) or '-')}"
+        )
+    return "\n".join(lines)
+
+
+def stats(update, context):
+    chat_id = update.effective_chat.id
+    if chat_id not in admin_chat_ids:
+        unknown(update, context)
+        return
+    outbox.send_message(
+        chat_id=chat_id, text=get_stats_message(), parse_mode=ParseMode.HTML
+    )
+
+
+def profile(update, context):
+    chat_id = update.effective_chat.id
+    if chat_id not in admin_chat_ids:
+        unknown(update, context)
+        return
+
+    profiler = get_command_profiler()
+    if context.args and context.args[0].lower() == "stop":
+        if not profiler.stop():
+            outbox.send_message(chat_id=chat_id, text="The profiler is not running.")
+        return
+
+    try:
+        commands = int(context.args[0]) if context.args else 10
+    except ValueError:
+        outbox.send_message(
+            chat_id=chat_id,
+            text="Use command <pre>/profile [number-of-commands]</pre> or <pre>/profile stop</pre>",
+            parse_mode=ParseMode.HTML,
+        )
+        return
+
+    def send_report(report: str):
+        outbox.send_message(
+            chat_id=chat_id,
+            text=f"<pre>{escape(report)}</pre>",
+            parse_mode=ParseMode.HTML,
+        )
+
+    started, commands = profiler.start(commands=commands, report_callback=send_report)
+    if started:
+        text = f"Profiling the next {commands} commands."
+    else:
+        text = (
+            "The profiler is already running; use <pre>/profile stop</pre> to stop it."
+        )
+    outbox.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
 
 
 def unknown(update, context):
-    context.bot.send_message(chat_id=update.effective_chat.id, text="Unknown command.")
-    context.bot.send_message(
+    outbox.send_message(chat_id=update.effective_chat.id, text="Unknown command.")
+    outbox.send_message(
         chat_id=update.effective_chat.id,
-        text="Use command <pre>/sonde [radiosonde-id]</pre> for requesting the landing prediction information",
+        text="Use command <pre>/sonde [radiosonde-id]</pre> for requesting the landing prediction information and <pre>/watch [radiosonde-id]</pre> for getting updates during the flight",
         parse_mode=ParseMode.HTML,
     )
-    context.bot.send_message(
+    outbox.send_message(
         chat_id=update.effective_chat.id,
         text="Source code & further info: https://www.github.com/joergschultzelutter/radiosonde-telegram-bot",
         parse_mode=ParseMode.HTML,
@@ -282,19 +1197,95 @@ if __name__ == "__main__":
         logger.info("Cannot read config file")
         exit(0)
 
+    radiobot_config = read_config_section(
+        section_name="radiobot_config", defaults=radiobot_config_defaults
+    )
+    live_message_editing = radiobot_config["live_message_editing"]
+    admin_chat_ids = get_admin_chat_ids(radiobot_config["admin_chat_ids"])
+    pipeline_scheduler = FairScheduler(
+        name="pipelines", worker_threads=radiobot_config["sonde_worker_threads"]
+    )
+    command_scheduler = FairScheduler(
+        name="commands",
+        worker_threads=radiobot_config["command_worker_threads"],
+        max_queued=radiobot_config["max_queued_commands"],
+        max_queued_per_key=radiobot_config["max_queued_commands_per_chat"],
+        max_running_per_key=radiobot_config["max_running_commands_per_chat"],
+    )
+    rendered_message_cache = ExpiringCache(
+        name="rendered_messages",
+        max_entries=1000,
+        default_ttl=radiobot_config["rendered_messages_ttl"],
+    )
+
+    watch_config = read_config_section(
+        section_name="watch_config", defaults=watch_config_defaults
+    )
+    watch_registry = WatchRegistry(watch_config=watch_config)
+
+    prefetcher = Prefetcher(
+        prefetch_config=read_config_section(
+            section_name="prefetch_config", defaults=prefetch_config_defaults
+        ),
+        refresh_function=prefetch_sonde,
+        scheduler=pipeline_scheduler,
+        scheduler_key=prefetch_scheduler_key,
+        landed_statuses=watch_config["landed_statuses"],
+    )
+    prefetcher.start()
+
+    metrics_config = read_config_section(
+        section_name="metrics_config", defaults=metrics_config_defaults
+    )
+    start_metrics_server(metrics_config=metrics_config)
+
+    # Load the offline reverse geocoder now rather than on the first command
+    get_offline_geocoder()
+
     # Register the SIGTERM handler; this will allow a safe shutdown of the program
     logger.info(msg="Registering SIGTERM handler for safe shutdown...")
     signal.signal(signal.SIGTERM, signal_term_handler)
 
-    updater = Updater(token=telegram_token, use_context=True)
+    # Same connection pool size as the Updater's default bot
+    updater = Updater(
+        bot=InstrumentedBot(token=telegram_token, request=Request(con_pool_size=8)),
+        use_context=True,
+    )
     dispatcher = updater.dispatcher
 
+    # All handlers queue their messages on the outbox and return
+    outbox = Outbox(
+        bot=updater.bot,
+        outbox_config=read_config_section(
+            section_name="outbox_config", defaults=outbox_config_defaults
+        ),
+    )
+
     start_handler = CommandHandler("start", start)
     dispatcher.add_handler(start_handler)
 
-    sonde_handler = CommandHandler("sonde", sonde)
+    sonde_handler = CommandHandler("sonde", schedule_command(sonde))
     dispatcher.add_handler(sonde_handler)
 
+    watch_handler = CommandHandler("watch", watch)
+    dispatcher.add_handler(watch_handler)
+
+    unwatch_handler = CommandHandler("unwatch", unwatch)
+    dispatcher.add_handler(unwatch_handler)
+
+    stats_handler = CommandHandler("stats", stats)
+    dispatcher.add_handler(stats_handler)
+
+    profile_handler = CommandHandler("profile", profile)
+    dispatcher.add_handler(profile_handler)
+
+    # Poll the watched radiosondes in the background
+    updater.job_queue.run_repeating(
+        poll_watched_sondes,
+        interval=watch_config["tick_interval"],
+        first=watch_config["tick_interval"],
+    )
+
     # must be last handler prior to polling start
     unknown_handler = MessageHandler(Filters.command, unknown)
     dispatcher.add_handler(unknown_handler)
@@ -307,3 +1298,9 @@ if __name__ == "__main__":
         )
         updater.stop()
         logger.info(msg="Have terminated the updater")
+        prefetcher.stop()
+        command_scheduler.shutdown(wait=False)
+        pipeline_scheduler.shutdown(wait=False)
+        # Deliver the replies that are still queued
+        if not outbox.flush(timeout=10.0):
+            logger.info(msg="Outbox not empty; some messages have not been sent")
@@ -18,15 +18,27 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
-from utility_modules import read_program_config
+from utility_modules import read_program_config, read_config_section
+import contextvars
+import hashlib
 import logging
-from aprsdotfi_modules import get_position_on_aprsfi
+import threading
+from aprsdotfi_modules import get_aprsfi_report
+from prediction_modules import (
+    get_ensemble_landing_prediction,
+    get_local_landing_prediction,
+    get_prediction_config,
+)
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from datetime import datetime, timedelta
 import re
-import requests
-import xmltodict
-import activesoup  # requires version 0.23 or greater
-from bs4 import BeautifulSoup
+from xml.parsers import expat
+from html.parser import HTMLParser
+from http_modules import get_http_session
+from track_modules import add_track_point, get_derived_clmb
+from record_modules import LandingPrediction, RadiosondySnapshot
+from cache_modules import ExpiringCache, SingleFlight
+from tracing_modules import trace_span
 from pprint import pformat
 
 logging.basicConfig(
@@ -34,6 +46,291 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Default settings for the optional 'habhub_cache' config file section
+# Habhub predictions get reused for identical (quantized) flight states:
+# latitude_precision / longitude_precision: number of decimal places
+# altitude_step: altitude quantization in meters
+# clmb_step: climb rate quantization in m/s
+# Together with the prediction's launch minute, these values form
+# the cache key. max_entries / ttl: cache size and entry lifetime
+habhub_cache_defaults = {
+    "latitude_precision": 3,
+    "longitude_precision": 3,
+    "altitude_step": 50.0,
+    "clmb_step": 0.5,
+    "max_entries": 500,
+    "ttl": 120.0,
+}
+
+# Default settings for the optional 'radiosondy_cache' config file section
+# For each radiosondy.info page, we keep its validators (ETag,
+# Last-Modified), a hash of its content and the parsed response. Pages
+# get requested conditionally; unchanged pages are not parsed again.
+# max_entries / ttl: cache size and entry lifetime in seconds
+radiosondy_cache_defaults = {
+    "max_entries": 500,
+    "ttl": 3600.0,
+}
+
+# Name and description format of the landing placemark in habhub's KML
+habhub_landing_placemark_name = "Predicted Balloon Landing"
+habhub_landing_regex = re.compile(
+    r"^Balloon landing at (-?\d*[.]\d*),\s*(-?\d*[.]\d*)\s*at\s*(\d*[:]\d* \d{2}\/\d{2}\/\d{4}).$",
+    flags=re.IGNORECASE,
+)
+
+# Text-based information blocks on the radiosondy.info pages. With the
+# exception of the APRS data, the data that we want / need is stored as
+# regular text; we use the text's icons in order to identify the content.
+# (icon, label) -> (target fields, regex for the block's value(s))
+radiosondy_html_blocks = {
+    ("balloon", "number"): (("sonde_number",), r"([\w\s]+)\<\/h4\>"),
+    ("house", "launch site"): (("launch_site",), r"(.*)\<\/h4\>"),
+    ("type", "type"): (("probe_type",), r"(.*)\<\/h4\>"),
+    ("aux", "aux"): (("probe_aux",), r"(.*)\<\/h4\>"),
+    ("freq", "frequency"): (("probe_freq",), r"(.*) MHz\<\/h4\>"),
+    ("found", "status"): (("probe_status",), r"(.*)\<\/h4\>"),
+    ("speed", "max speed"): (
+        ("max_speed", "max_speed_height"),
+        r"(.*) km\/h at (.*) m\<\/h4\>",
+    ),
+    ("speed", "average speed"): (("avg_speed_kmh",), r"(.*) km\/h\<\/h4\>"),
+    ("altitude", "max altitude"): (("max_altitude",), r"(.*) m\<\/h4\>"),
+    ("up", "average ascent speed"): (("avg_ascent_speed",), r"(.*) m\/s\<\/h4\>"),
+    ("down", "average descent speed"): (
+        ("avg_descent_speed",),
+        r"(.*) m\/s\<\/h4\>",
+    ),
+}
+radiosondy_html_blocks = {
+    block: (fields, re.compile(value_regex, flags=re.IGNORECASE))
+    for block, (fields, value_regex) in radiosondy_html_blocks.items()
+}
+radiosondy_html_fields = [
+    "sonde_number",
+    "launch_site",
+    "probe_type",
+    "probe_aux",
+    "probe_freq",
+    "probe_status",
+    "max_speed",
+    "max_speed_height",
+    "avg_speed_kmh",
+    "max_altitude",
+    "avg_ascent_speed",
+    "avg_descent_speed",
+]
+# Matches the icon and label of every information block
+radiosondy_html_block_regex = re.compile(
+    r"images\/(balloon|house|type|aux|freq|found|speed|altitude|up|down).png\"\> "
+    r"(Number|Launch Site|Type|AUX|Frequency|Status|Max Speed|Average Speed"
+    r"|Max Altitude|Average Ascent Speed|Average Descent Speed): ",
+    flags=re.IGNORECASE,
+)
+
+# radiosondy.info response fields, in the order of the snapshot record
+radiosondy_response_fields = RadiosondySnapshot._fields
+# Columns of the "Status Changes" table (Table2) on archive pages
+radiosondy_status_change_columns = [
+    "launch_site",
+    "probe_type",
+    "probe_aux",
+    "probe_freq",
+    "probe_status",
+    "probe_finder",
+    "landing_point",
+    "landing_description",
+    "changes_made",
+]
+# Columns of the APRS data table (Table1) on archive pages
+radiosondy_archive_aprs_columns = [
+    "receiver",
+    "sonde_number",
+    "datetime_utc",
+    "latitude",
+    "longitude",
+    "course_deg",
+    "speed_kmh",
+    "altitude_m",
+    "aprs_comment",
+]
+# Columns of the APRS data table (Table1) on dynamic pages
+radiosondy_dynamic_aprs_columns = [
+    "receiver",
+    "sonde_number",
+    "datetime_utc",
+    "latitude",
+    "longitude",
+    "course_deg",
+    "speed_kmh",
+    "altitude_m",
+    "climbing_meters_per_second",
+    "temperature_celsius",
+    "pressure_hpa",
+    "humidity_percent",
+    "aux_o3",
+]
+# Track store columns and the radiosondy.info fields they are taken from
+radiosondy_track_fields = {
+    "latitude": "latitude",
+    "longitude": "longitude",
+    "altitude": "altitude_m",
+    "climbing": "climbing_meters_per_second",
+    "course": "course_deg",
+    "speed": "speed_kmh",
+    "temperature": "temperature_celsius",
+    "pressure": "pressure_hpa",
+    "humidity": "humidity_percent",
+}
+# Units of measure that get removed from the dynamic pages' APRS data
+radiosondy_units_of_measure = {
+    "climbing_meters_per_second": " m/s",
+    "altitude_m": " m",
+    "aux_o3": " mPa",
+    "course_deg": " °",
+    "humidity_percent": " %",
+    "pressure_hpa": " hPa",
+    "speed_kmh": " km/h",
+    "temperature_celsius": " °C",
+    "latitude": " φ",
+    "longitude": " λ",
+}
+radiosondy_landing_point_regex = re.compile(
+    r"^(-?\d*[.]\d*),\s*(-?\d*[.]\d*)$", flags=re.IGNORECASE
+)
+# HTML elements without content / end tag (same list as BeautifulSoup's)
+html_void_elements = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "keygen",
+    "link",
+    "menuitem",
+    "meta",
+    "param",
+    "source",
+    "track",
+    "wbr",
+    "basefont",
+    "bgsound",
+    "command",
+    "frame",
+    "image",
+    "isindex",
+    "nextid",
+    "spacer",
+}
+
+habhub_cache = None
+habhub_cache_config = None
+habhub_cache_lock = threading.Lock()
+
+radiosondy_cache = None
+radiosondy_cache_lock = threading.Lock()
+
+# Concurrent queries for the same habhub prediction / radiosondy.info
+# data share one upstream request
+habhub_flights = SingleFlight(name="habhub")
+radiosondy_flights = SingleFlight(name="radiosondy")
+
+# habhub queries which race against the local prediction model
+race_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="habhub-race")
+
+
+def get_habhub_cache():
+    """
+    Returns the habhub prediction cache. The cache gets created on
+    first use, based on the 'habhub_cache' config file section
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    habhub_cache: 'ExpiringCache'
+        habhub prediction cache
+    """
+
+    global habhub_cache, habhub_cache_config
+
+    with habhub_cache_lock:
+        if habhub_cache is None:
+            habhub_cache_config = read_config_section(
+                section_name="habhub_cache", defaults=habhub_cache_defaults
+            )
+            habhub_cache = ExpiringCache(
+                name="habhub",
+                max_entries=habhub_cache_config["max_entries"],
+                default_ttl=habhub_cache_config["ttl"],
+            )
+    return habhub_cache
+
+
+def quantize(value: float, step: float):
+    """
+    Snaps a value to a multiple of 'step'
+
+    Parameters
+    ==========
+    value: 'float'
+        value that we want to quantize
+    step: 'float'
+        quantization step; values <= 0 disable quantization
+
+    Returns
+    =======
+    value: 'float'
+        quantized value
+    """
+
+    if step <= 0:
+        return value
+    return round(round(value / step) * step, 6)
+
+
+def get_habhub_cache_key(
+    latitude: float,
+    longitude: float,
+    altitude: float,
+    clmb: float,
+    launch_timestamp: datetime,
+):
+    """
+    Builds the habhub prediction cache key from the quantized flight state
+
+    Parameters
+    ==========
+    latitude: 'float'
+        latitude from aprs.fi position report
+    longitude: 'float'
+        longitude from aprs.fi position report
+    altitude: 'float'
+        altitude from aprs.fi position report
+    clmb: 'float'
+        extracted clmb value from aprs.fi position report
+    launch_timestamp: 'datetime'
+        launch time which is submitted to habhub
+
+    Returns
+    =======
+    cache_key: 'tuple'
+        habhub prediction cache key
+    """
+
+    get_habhub_cache()
+    return (
+        round(latitude, habhub_cache_config["latitude_precision"]),
+        round(longitude, habhub_cache_config["longitude_precision"]),
+        quantize(altitude, habhub_cache_config["altitude_step"]),
+        quantize(clmb, habhub_cache_config["clmb_step"]),
+        launch_timestamp.strftime("%Y%m%d%H%M"),
+    )
+
 
 def get_ascent_descent_burst(clmb: float, altitude: float):
     """
@@ -75,6 +372,10 @@ def get_ascent_descent_burst(clmb: float, altitude: float):
     return ascent_rate, descent_rate, burst_altitude
 
 
+# Climb rate in the aprs.fi comment of a radiosonde's position report
+clmb_regex = re.compile(r"Clb=(-?[0-9]\d*(?:\.\d+)?)", flags=re.IGNORECASE)
+
+
 def get_clmb_from_comment(probe_comment: str):
     """
     Gets the 'clmb' rate from the aprs.fi position
@@ -91,11 +392,7 @@ def get_clmb_from_comment(probe_comment: str):
         Climb rate in meters
     """
     clmb = None
-    matches = re.search(
-        pattern=r"Clb=(-?[0-9]\d*(?:\.\d+)?)",
-        string=probe_comment,
-        flags=re.IGNORECASE,
-    )
+    matches = clmb_regex.search(probe_comment)
 
     if matches:
         try:
@@ -105,6 +402,130 @@ def get_clmb_from_comment(probe_comment: str):
     return clmb
 
 
+class LandingPlacemarkFound(Exception):
+    """
+    Raised from within the KML parser callbacks in order to stop
+    parsing once we have found the landing placemark's description
+    """
+
+    def __init__(self, description: str):
+        super().__init__(description)
+        self.description = description
+
+
+def get_landing_description_from_kml(kml_chunks):
+    """
+    Incrementally parses a habhub KML document and returns the
+    description of its "Predicted Balloon Landing" placemark. Parsing
+    stops as soon as that description is known. Only the text of the
+    placemarks' name and description elements gets collected; the
+    trajectory data is skipped without being stored.
+
+    Parameters
+    ==========
+    kml_chunks: 'iterable'
+        KML content as an iterable of 'bytes' or 'str' chunks
+
+    Returns
+    =======
+    description: 'str'
+        description of the landing placemark (or None)
+    """
+
+    placemark = {"active": False, "name": None, "description": None}
+    captured_tag = None
+    captured_text = []
+
+    def start_element(tag, attributes):
+        nonlocal captured_tag
+        tag = tag.rpartition("}")[2]
+        if tag == "Placemark":
+            placemark["active"] = True
+            placemark["name"] = placemark["description"] = None
+        elif placemark["active"] and tag in ("name", "description"):
+            captured_tag = tag
+            captured_text.clear()
+
+    def end_element(tag):
+        nonlocal captured_tag
+        tag = tag.rpartition("}")[2]
+        if tag == captured_tag:
+            placemark[tag] = "".join(captured_text).strip()
+            captured_tag = None
+            if (
+                placemark["name"] == habhub_landing_placemark_name
+                and placemark["description"]
+            ):
+                raise LandingPlacemarkFound(placemark["description"])
+        elif tag == "Placemark":
+            placemark["active"] = False
+
+    def character_data(data):
+        if captured_tag:
+            captured_text.append(data)
+
+    parser = expat.ParserCreate(namespace_separator="}")
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    try:
+        for chunk in kml_chunks:
+            parser.Parse(chunk, False)
+        parser.Parse(b"", True)
+    except LandingPlacemarkFound as found:
+        return found.description
+    except expat.ExpatError:
+        logger.info("Cannot parse KML content from Habhub")
+    return None
+
+
+def parse_habhub_landing_description(description: str):
+    """
+    Extracts the landing position and time from the description
+    of habhub's "Predicted Balloon Landing" placemark
+
+    Parameters
+    ==========
+    description: 'str'
+        placemark description, e.g. 'Balloon landing at 51.1, 7.2 at 12:34 01/02/2021.'
+
+    Returns
+    =======
+    success: 'bool'
+        True if we were able to extract the landing coordinates and time
+    landing_latitude: 'float'
+        Latitude of the predicted probe landing (if success = True)
+    landing_longitude: 'float'
+        Longitude of the predicted probe landing (if success = True)
+    landing_timestamp: 'datetime'
+        Timestamp of the predicted probe landing (if success = True)
+    """
+
+    landing_latitude = landing_longitude = 0.0
+    landing_timestamp = datetime.min
+    success = False
+
+    matches = habhub_landing_regex.search(description)
+    if matches:
+        success = True
+        try:
+            landing_latitude = float(matches[1])
+            landing_longitude = float(matches[2])
+        except ValueError:
+            landing_latitude = landing_longitude = 0.0
+            success = False
+        ts_string = matches[3] + " UTC"  # timezone is UTC
+        try:
+            landing_timestamp = datetime.strptime(ts_string, "%H:%M %d/%m/%Y %Z")
+        except ValueError:
+            landing_latitude = landing_longitude = 0.0
+            landing_timestamp = datetime.min
+            success = False
+    return success, landing_latitude, landing_longitude, landing_timestamp
+
+
 def get_kml_data_from_habhub(
     latitude: float, longitude: float, altitude: float, clmb: float
 ):
@@ -125,23 +546,12 @@ def get_kml_data_from_habhub(
 
     Returns
     =======
-    success: 'bool'
-        True if we were able to determine landing coordinates etc
-    landing_latitude: 'float'
-        Latitude of the predicted probe landing (if success = True)
-    landing_longitude: 'float'
-        Longitude of the predicted probe landing (if success = True)
-    landing_timestamp: 'float'
-        Timestamp of the predicted probe landing (if success = True)
-    landing_url: 'str'
-        habhub.org URL with the uuid which was generated by our query
+    prediction: 'LandingPrediction'
+        success, latitude, longitude and timestamp of the predicted
+        probe landing, plus the habhub.org URL with the uuid which was
+        generated by our query
     """
 
-    landing_latitude = landing_longitude = 0.0
-    landing_timestamp = datetime.min
-    landing_url = None
-    success = False
-
     ascent_rate, descent_rate, burst_altitude = get_ascent_descent_burst(
         clmb=clmb, altitude=altitude
     )
@@ -152,6 +562,68 @@ def get_kml_data_from_habhub(
     # one minute to it
     timestamp = datetime.utcnow() + timedelta(minutes=1)
 
+    # Reuse an earlier prediction if the flight state has not changed
+    cache_key = get_habhub_cache_key(
+        latitude=latitude,
+        longitude=longitude,
+        altitude=altitude,
+        clmb=clmb,
+        launch_timestamp=timestamp,
+    )
+    found_in_cache, cached_prediction = get_habhub_cache().get(cache_key)
+    if found_in_cache:
+        logger.info("Using cached Habhub prediction")
+        return cached_prediction
+
+    return habhub_flights.do(
+        cache_key,
+        query_habhub_prediction,
+        cache_key=cache_key,
+        latitude=latitude,
+        longitude=longitude,
+        altitude=altitude,
+        ascent_rate=ascent_rate,
+        descent_rate=descent_rate,
+        burst_altitude=burst_altitude,
+        timestamp=timestamp,
+    )
+
+
+def query_habhub_prediction(
+    cache_key: tuple,
+    latitude: float,
+    longitude: float,
+    altitude: float,
+    ascent_rate: float,
+    descent_rate: float,
+    burst_altitude: float,
+    timestamp: datetime,
+):
+    """
+    Runs a prediction on predict.habhub.org and caches the result;
+    see get_kml_data_from_habhub()
+
+    Parameters
+    ==========
+    cache_key: 'tuple'
+        habhub cache key of the flight state
+    latitude / longitude / altitude: 'float'
+        position from aprs.fi position report
+    ascent_rate / descent_rate / burst_altitude: 'float'
+        see get_ascent_descent_burst()
+    timestamp: 'datetime'
+        launch time of the prediction
+
+    Returns
+    =======
+    see get_kml_data_from_habhub()
+    """
+
+    landing_latitude = landing_longitude = 0.0
+    landing_timestamp = datetime.min
+    landing_url = None
+    success = False
+
     # Create the payload item for the POST operation
     hubhab_payload = {
         "launchsite": "Other",
@@ -176,7 +648,7 @@ def get_kml_data_from_habhub(
     url = "http://predict.habhub.org/ajax.php?action=submitForm"
 
     try:
-        resp = requests.post(url=url, data=hubhab_payload)
+        resp = get_http_session().post(url=url, data=hubhab_payload)
     except:
         logger.info(f"Cannot connect to {url}")
         resp = None
@@ -199,80 +671,155 @@ def get_kml_data_from_habhub(
                     # We're going to download the KML file for this UUID
                     # Let's construct the respective URL
                     url = f"http://predict.habhub.org/kml.php?uuid={uuid}"
-                    resp = requests.get(url=url)
+                    try:
+                        resp = get_http_session().get(url=url, stream=True)
+                    except:
+                        logger.info(f"Cannot connect to {url}")
+                        resp = None
                     if resp:
                         if resp.status_code == 200:
+                            logger.info("Have received valid uuid response from Habhub")
 
-                            # We have received XML content. For better navigation throughout
-                            # the data structure, let's convert the content to a 'dict' object
-                            # (xmltodict converts to an OrderedDict)
-                            try:
-                                kml_dict = xmltodict.parse(resp.text)
-                            except:
-                                kml_dict = {}
+                            # We have received XML content. Stream it through the parser
+                            # and stop reading once we have found the landing placemark
+                            # the span includes the download of the KML body
+                            with resp, trace_span("habhub_kml_parse"):
+                                description = get_landing_description_from_kml(
+                                    kml_chunks=resp.iter_content(chunk_size=16384)
+                                )
+                            if description:
+                                (
+                                    success,
+                                    landing_latitude,
+                                    landing_longitude,
+                                    landing_timestamp,
+                                ) = parse_habhub_landing_description(
+                                    description=description
+                                )
+                                if success:
+                                    landing_url = (
+                                        f"https://predict.habhub.org/#!/uuid={uuid}"
+                                    )
+    prediction = LandingPrediction(
+        success=success,
+        latitude=landing_latitude,
+        longitude=landing_longitude,
+        timestamp=landing_timestamp,
+        url=landing_url,
+    )
+    if success:
+        get_habhub_cache().set(cache_key, prediction)
+    return prediction
+
+
+def get_landing_prediction(
+    latitude: float,
+    longitude: float,
+    altitude: float,
+    clmb: float,
+    course: float,
+    speed: float,
+    position_timestamp: datetime,
+):
+    """
+    Gets the landing prediction from habhub and / or the local
+    prediction model, depending on the configured prediction mode.
+    Unless disabled, the local model runs as a Monte Carlo ensemble
+    which also provides the landing ellipse for habhub's prediction
 
-                            logger.info("Have received valid uuid response from Habhub")
+    Parameters
+    ==========
+    latitude / longitude: 'float'
+        position from aprs.fi position report
+    altitude: 'float'
+        altitude from aprs.fi position report
+    clmb: 'float'
+        extracted clmb value from aprs.fi position report
+    course / speed: 'float'
+        course (degrees) and speed (km/h) from aprs.fi position report
+    position_timestamp: 'datetime'
+        time of the aprs.fi position report
 
-                            # Now navigate through the structure and get our data
-                            # The stuff that we want is in the "Placemark" subsection
-                            if "kml" in kml_dict:
-                                if "Document" in kml_dict["kml"]:
-                                    if "Placemark" in kml_dict["kml"]["Document"]:
-                                        placemarks = kml_dict["kml"]["Document"][
-                                            "Placemark"
-                                        ]
-
-                                        # Iterate through the available placemark objects and start
-                                        # parsing once we have hit the "Predicted Balloon Landing" entry
-                                        for placemark in placemarks:
-                                            if "name" in placemark:
-                                                name = placemark["name"]
-                                                if name == "Predicted Balloon Landing":
-                                                    # We have a winner! Our content is stored in the 'description' field
-                                                    if "description" in placemark:
-                                                        description = placemark[
-                                                            "description"
-                                                        ]
-
-                                                        # run some regex magic for extracting what we want
-                                                        regex_string = r"^Balloon landing at (-?\d*[.]\d*),\s*(-?\d*[.]\d*)\s*at\s*(\d*[:]\d* \d{2}\/\d{2}\/\d{4}).$"
-                                                        matches = re.search(
-                                                            pattern=regex_string,
-                                                            string=description,
-                                                            flags=re.IGNORECASE,
-                                                        )
-                                                        if matches:
-                                                            # extract lat/lon/timestamp
-                                                            # fmt: off
-                                                            success = True
-                                                            try:
-                                                                landing_latitude = float(matches[1])
-                                                                landing_longitude = float(matches[2])
-                                                            except ValueError:
-                                                                landing_latitude = landing_longitude = 0.0
-                                                                success = False
-                                                            ts_string = matches[3] + " UTC"  # timezone is UTC
-                                                            # fmt: on
-                                                            try:
-                                                                landing_timestamp = datetime.strptime(
-                                                                    ts_string,
-                                                                    "%H:%M %d/%m/%Y %Z",
-                                                                )
-                                                                pass
-                                                            except ValueError:
-                                                                landing_latitude = (
-                                                                    landing_longitude
-                                                                ) = 0
-                                                                landing_timestamp = (
-                                                                    datetime.min
-                                                                )
-                                                                success = False
-                                                            landing_url = f"https://predict.habhub.org/#!/uuid={uuid}"
-                                                            break  # we have what we want so let's finish up
-    return success, landing_latitude, landing_longitude, landing_timestamp, landing_url
+    Returns
+    =======
+    prediction: 'LandingPrediction'
+        success, latitude, longitude and timestamp of the predicted
+        probe landing. url is the habhub.org URL with the uuid which
+        was generated by our query (None for local predictions);
+        ellipse: see get_ensemble_landing_prediction(), None if the
+        ensemble is disabled or if success = False
+    """
 
+    prediction_config = get_prediction_config()
+    mode = prediction_config["mode"]
 
-def get_radiosonde_landing_prediction(aprsfi_callsign: str, aprsdotfi_api_key: str):
+    def get_habhub_prediction():
+        logger.info("Getting KML data from Habhub")
+        return get_kml_data_from_habhub(
+            latitude=latitude, longitude=longitude, altitude=altitude, clmb=clmb
+        )
+
+    ascent_rate, descent_rate, burst_altitude = get_ascent_descent_burst(
+        clmb=clmb, altitude=altitude
+    )
+    flight_state = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "altitude": altitude,
+        "course": course,
+        "speed": speed,
+        "ascent_rate": ascent_rate,
+        "descent_rate": descent_rate,
+        "burst_altitude": burst_altitude,
+        "descending": clmb < 0,
+        "position_timestamp": position_timestamp,
+        "prediction_config": prediction_config,
+    }
+
+    def get_local_prediction():
+        # The ensemble mean replaces the single local trajectory
+        if ensemble_prediction.success:
+            return ensemble_prediction._replace(ellipse=None)
+        with trace_span("local_prediction"):
+            return get_local_landing_prediction(**flight_state)
+
+    habhub_future = None
+    if mode == "race":
+        # habhub's prediction is preferred if it arrives in time; a late
+        # habhub response still ends up in the habhub cache
+        habhub_future = race_executor.submit(
+            contextvars.copy_context().run, get_habhub_prediction
+        )
+
+    with trace_span("ensemble_prediction"):
+        ensemble_prediction = get_ensemble_landing_prediction(**flight_state)
+
+    if mode == "local":
+        prediction = get_local_prediction()
+    elif mode == "fallback":
+        prediction = get_habhub_prediction()
+        if not prediction.success:
+            logger.info("No habhub prediction; using the local prediction model")
+            prediction = get_local_prediction()
+    elif mode == "race":
+        try:
+            prediction = habhub_future.result(timeout=prediction_config["race_timeout"])
+        except TimeoutError:
+            logger.info("habhub is too slow; using the local prediction model")
+            prediction = get_local_prediction()
+        except Exception:
+            logger.exception(msg="habhub prediction has failed")
+            prediction = get_local_prediction()
+        if not prediction.success:
+            prediction = get_local_prediction()
+    else:
+        prediction = get_habhub_prediction()
+    if not prediction.success:
+        return prediction
+    return prediction._replace(ellipse=ensemble_prediction.ellipse)
+
+
+def get_radiosonde_landing_report(aprsfi_callsign: str, aprsdotfi_api_key: str):
     """
     Provides a radiosonde landing prediction based on
     an aprs.fi call sign
@@ -286,21 +833,10 @@ def get_radiosonde_landing_prediction(aprsfi_callsign: str, aprsdotfi_api_key: s
 
     Returns
     =======
-    success: 'bool'
-        True if we were able to determine landing coordinates etc
-    landing_latitude: 'float'
-        Latitude of the predicted probe landing (if success = True)
-    landing_longitude: 'float'
-        Longitude of the predicted probe landing (if success = True)
-    landing_timestamp: 'float'
-        Timestamp of the predicted probe landing (if success = True)
-    landing_url: 'str'
-        habhub.org URL with the uuid which was generated by our query
+    prediction: 'LandingPrediction'
+        see get_landing_prediction()
     """
-    success = False
-    landing_latitude = landing_longitude = 0.0
-    landing_timestamp = datetime.min
-    landing_url = None
+    prediction = LandingPrediction(False, 0.0, 0.0, datetime.min)
 
     aprsfi_callsign = aprsfi_callsign.upper()
 
@@ -311,15 +847,7 @@ def get_radiosonde_landing_prediction(aprsfi_callsign: str, aprsdotfi_api_key: s
     # objects means that MPAD won't see them - so I removed that
     # restriction. It's not the most elegant way but seems
     # to work properly.
-    (
-        success,
-        latitude,
-        longitude,
-        altitude,
-        timestamp,
-        comment,
-        message_callsign,
-    ) = get_position_on_aprsfi(
+    position = get_aprsfi_report(
         aprsfi_callsign=aprsfi_callsign,
         aprsdotfi_api_key=aprsdotfi_api_key,
         #  aprs_target_type="o",
@@ -328,29 +856,80 @@ def get_radiosonde_landing_prediction(aprsfi_callsign: str, aprsdotfi_api_key: s
     logger.info("Running query on aprs.fi")
 
     # We found the entry - so let's continue
-    if success:
-        if comment:
-            # logger.info(comment)
-            clmb = get_clmb_from_comment(probe_comment=comment)
-            if clmb:
-                logger.info("Getting KML data from Habhub")
-                (
-                    success,
-                    landing_latitude,
-                    landing_longitude,
-                    landing_timestamp,
-                    landing_url,
-                ) = get_kml_data_from_habhub(
-                    latitude=latitude, longitude=longitude, altitude=altitude, clmb=clmb
-                )
-            else:
-                success = False
+    if position.success:
+        clmb = (
+            get_clmb_from_comment(probe_comment=position.comment)
+            if position.comment
+            else None
+        )
+        add_track_point(
+            aprsfi_callsign,
+            position.lasttime,
+            latitude=position.latitude,
+            longitude=position.longitude,
+            altitude=position.altitude,
+            climbing=clmb,
+            course=position.course,
+            speed=position.speed,
+        )
+        if clmb is None:
+            # No (or no usable) comment; use the previous fixes instead
+            clmb = get_derived_clmb(
+                sonde_id=aprsfi_callsign, timestamp=position.lasttime
+            )
+            if clmb is not None:
+                logger.info(f"Using climb rate {clmb} m/s from the stored track")
+        if clmb:
+            prediction = get_landing_prediction(
+                latitude=position.latitude,
+                longitude=position.longitude,
+                altitude=position.altitude,
+                clmb=clmb,
+                course=position.course,
+                speed=position.speed,
+                position_timestamp=position.lasttime,
+            )
         else:
-            success = False
-            logger.info("Found on aprs.fi but does not contain a comment")
+            logger.info("Found on aprs.fi but does not contain a climb rate")
     else:
         logger.info("Not found on aprs.fi")
-    return success, landing_latitude, landing_longitude, landing_timestamp, landing_url
+    return prediction
+
+
+def get_radiosonde_landing_prediction(aprsfi_callsign: str, aprsdotfi_api_key: str):
+    """
+    Provides a radiosonde landing prediction based on
+    an aprs.fi call sign
+
+    Parameters
+    ==========
+    aprsfi_callsign: 'str'
+        aprs.fi callsign
+    aprsdotfi_api_key: 'str'
+        aprs.fi API access key
+
+    Returns
+    =======
+    success: 'bool'
+        True if we were able to determine landing coordinates etc
+    landing_latitude: 'float'
+        Latitude of the predicted probe landing (if success = True)
+    landing_longitude: 'float'
+        Longitude of the predicted probe landing (if success = True)
+    landing_timestamp: 'datetime'
+        Timestamp of the predicted probe landing (if success = True)
+    landing_url: 'str'
+        habhub.org URL with the uuid which was generated by our query
+        (None for local predictions)
+
+    The first five fields of get_radiosonde_landing_report()'s record,
+    as a plain tuple for existing callers (e.g. MPAD); use that function
+    for the landing ellipse
+    """
+
+    return get_radiosonde_landing_report(
+        aprsfi_callsign=aprsfi_callsign, aprsdotfi_api_key=aprsdotfi_api_key
+    )[:5]
 
 
 def remove_trailing_content(source_string: str, trailing_content: str):
@@ -361,128 +940,509 @@ def remove_trailing_content(source_string: str, trailing_content: str):
 
 
 def parse_radiosondy_html_content(html_raw_content: str):
-    _sonde_number = _launch_site = _probe_type = None
-    _probe_aux = _probe_freq = _probe_status = None
-    _max_speed = _max_speed_height = _avg_speed_kmh = None
-    _max_altitude = _avg_ascent_speed = _avg_descent_speed = None
+    """
+    Extracts the radiosonde's text-based information blocks (launch site,
+    type, status, speeds etc) from a radiosondy.info page. Each block is
+    identified by its icon and label. The page is scanned only once; the
+    scan stops as soon as all blocks have been found.
+
+    Parameters
+    ==========
+    html_raw_content: 'str'
+        radiosondy.info page content
+
+    Returns
+    =======
+    response_dict: 'dict'
+        extracted values (None if not present)
+    """
+
+    response_dict = dict.fromkeys(radiosondy_html_fields)
+    unresolved_blocks = set(radiosondy_html_blocks)
+
+    for block_match in radiosondy_html_block_regex.finditer(html_raw_content):
+        block = (block_match[1].lower(), block_match[2].lower())
+        if block not in unresolved_blocks:
+            continue
+        fields, value_regex = radiosondy_html_blocks[block]
+        value_match = value_regex.match(html_raw_content, block_match.end())
+        if value_match:
+            for index, field in enumerate(fields, start=1):
+                response_dict[field] = value_match[index]
+            unresolved_blocks.discard(block)
+            if not unresolved_blocks:
+                break
+    return response_dict
+
+
+class RadiosondyTablesComplete(Exception):
+    """
+    Raised from within RadiosondyTableParser in order to stop
+    parsing once all target tables have been processed
+    """
+
+
+class RadiosondyTableParser(HTMLParser):
+    """
+    Streaming HTML parser which extracts the cells of the first 'bg_1'
+    row of the radiosondy.info tables that we are interested in. Only
+    the content of these rows gets materialized; everything else is
+    skipped. The cells' values follow BeautifulSoup's '.string'
+    semantics: a cell's value is its text if the cell contains nothing
+    but a single text (or a single tag with a single text), else None.
+    """
+
+    def __init__(self, table_ids: tuple):
+        super().__init__(convert_charrefs=True)
+        self.table_ids = set(table_ids)
+        # table id -> cell values of the first 'bg_1' row (None = no such row)
+        self.tables = {}
+        # open elements: [tag, table id, row capture, materialized node]
+        self.open_elements = []
+        # rows which are currently being materialized
+        self.captures = []
+        # tables whose result is final
+        self.completed_table_ids = set()
+        # True if the next text fragment starts a new text node
+        self.text_boundary = True
+
+    def handle_starttag(self, tag, attrs):
+        self.text_boundary = True
+        table_id = capture = node = None
+        if tag == "table":
+            element_id = dict(attrs).get("id")
+            if element_id in self.table_ids and element_id not in self.tables:
+                table_id = element_id
+                self.tables[table_id] = None
+
+        if self.captures:
+            # we are within a target row; materialize this element
+            node = [tag, []]
+            parent = self.get_parent_node()
+            if parent:
+                parent[1].append(node)
+            if tag == "td":
+                for active_capture in self.captures:
+                    active_capture["cells"].append(node)
+
+        if tag == "tr":
+            # this row is the first 'bg_1' row of all enclosing target
+            # tables which have not found such a row yet
+            claimed_table_ids = set()
+            for active_capture in self.captures:
+                claimed_table_ids.update(active_capture["table_ids"])
+            pending_table_ids = [
+                element[1]
+                for element in self.open_elements
+                if element[1]
+                and self.tables[element[1]] is None
+                and element[1] not in claimed_table_ids
+            ]
+            if pending_table_ids:
+                classes = (dict(attrs).get("class") or "").split()
+                if "bg_1" in classes:
+                    capture = {"table_ids": pending_table_ids, "cells": []}
+                    self.captures.append(capture)
+
+        if tag in html_void_elements:
+            return
+        self.open_elements.append((tag, table_id, capture, node))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in html_void_elements:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self.text_boundary = True
+        # close the most recent element with this tag (if any)
+        for index in range(len(self.open_elements) - 1, -1, -1):
+            if self.open_elements[index][0] == tag:
+                self.close_elements(index)
+                break
+
+    def close_elements(self, index: int):
+        while len(self.open_elements) > index:
+            _, table_id, capture, _ = self.open_elements.pop()
+            if capture:
+                cells = [get_node_string(cell) for cell in capture["cells"]]
+                for capture_table_id in capture["table_ids"]:
+                    self.tables[capture_table_id] = cells
+                    self.completed_table_ids.add(capture_table_id)
+                self.captures.remove(capture)
+            if table_id:
+                self.completed_table_ids.add(table_id)
+
+            # stop parsing once we have the rows of all target tables
+            if (capture or table_id) and self.completed_table_ids == self.table_ids:
+                raise RadiosondyTablesComplete()
+
+    def close(self):
+        super().close()
+        # implicitly close all elements which are still open
+        self.close_elements(0)
+
+    def handle_data(self, data):
+        parent = self.get_parent_node()
+        if parent:
+            # merge adjacent text fragments, just like BeautifulSoup
+            if not self.text_boundary and isinstance(parent[1][-1], str):
+                parent[1][-1] += data
+            else:
+                parent[1].append(data)
+        self.text_boundary = False
+
+    def handle_comment(self, data):
+        self.text_boundary = True
+        parent = self.get_parent_node()
+        if parent:
+            parent[1].append(["#comment", [data]])
+
+    def get_parent_node(self):
+        if not self.captures:
+            return None
+        for _, _, _, node in reversed(self.open_elements):
+            if node:
+                return node
+        return None
+
+
+def get_node_string(node: list):
+    """
+    Returns the '.string' value of an element materialized
+    by RadiosondyTableParser
+
+    Parameters
+    ==========
+    node: 'list'
+        [tag, children] element
+
+    Returns
+    =======
+    string: 'str'
+        element's only text (or None)
+    """
+
+    tag, children = node
+    if tag == "#comment":
+        return children[0]
+    if len(children) != 1:
+        return None
+    child = children[0]
+    if isinstance(child, str):
+        # BeautifulSoup collapses whitespace-only text
+        if not child.strip(" \n\t\f\r"):
+            return "\n" if "\n" in child else " "
+        return child
+    return get_node_string(child)
+
+
+def get_radiosondy_table_rows(html_raw_content: str, table_ids: tuple):
+    """
+    Extracts the cells of the first 'bg_1' row of the given tables.
+    The page is parsed only up to the point where the rows of all
+    target tables are known.
+
+    Parameters
+    ==========
+    html_raw_content: 'str'
+        radiosondy.info page content
+    table_ids: 'tuple'
+        ids of the tables that we are interested in, e.g. ("Table1", "Table2")
+
+    Returns
+    =======
+    tables: 'dict'
+        table id -> list of cell values of the table's first 'bg_1' row
+        (None if the table does not contain such a row). Tables which
+        are not present on the page are not part of the dictionary.
+    """
+
+    parser = RadiosondyTableParser(table_ids=table_ids)
+    try:
+        parser.feed(html_raw_content)
+        parser.close()
+    except RadiosondyTablesComplete:
+        pass
+    return parser.tables
+
+
+def get_empty_radiosondy_response():
+    """
+    Returns the dictionary that the radiosondy.info parsers fill
+    with the raw page values, all fields set to their default values
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    radiosondy_response: 'dict'
+        Dictionary with all possible response fields
+    """
+
+    radiosondy_response = dict.fromkeys(radiosondy_response_fields)
+    radiosondy_response["landing_point_latitude"] = 0.0
+    radiosondy_response["landing_point_longitude"] = 0.0
+    return radiosondy_response
+
+
+def parse_radiosondy_archive_page(html_raw_content: str):
+    """
+    Parses a radiosondy.info archive page (static content)
+
+    Parameters
+    ==========
+    html_raw_content: 'str'
+        content of the 'sonde_archive.php' page
+
+    Returns
+    =======
+    radiosondy_response: 'RadiosondySnapshot'
+        parsed page (value 'None' if not present)
+    """
+
+    radiosondy_response = get_empty_radiosondy_response()
+    tables = get_radiosondy_table_rows(
+        html_raw_content=html_raw_content, table_ids=("Table1", "Table2")
+    )
+
+    # Archived probe; we have proper tables and can parse them.
+    # Parse Table "Status Changes"
+    if "Table2" in tables:
+        cols = tables["Table2"]
+        if cols is not None:
+            # There was at least one minimal change for this radiosonde
+            if cols and len(cols) == 9:
+                radiosondy_response.update(zip(radiosondy_status_change_columns, cols))
+                landing_point = radiosondy_response["landing_point"]
+                matches = (
+                    radiosondy_landing_point_regex.search(landing_point)
+                    if landing_point
+                    else None
+                )
+                if matches:
+                    try:
+                        radiosondy_response["landing_point_latitude"] = float(
+                            matches[1]
+                        )
+                        radiosondy_response["landing_point_longitude"] = float(
+                            matches[2]
+                        )
+                    except ValueError:
+                        radiosondy_response["landing_point_latitude"] = 0.0
+                        radiosondy_response["landing_point_longitude"] = 0.0
+        else:
+            # This branch gets executed in case the probe's status has never changed since its inception
+            # With the exception of the APRS data, the data that we want / need is stored as regular
+            # text. We use the text's icons in order to identify the content
+            radiosondy_response.update(
+                parse_radiosondy_html_content(html_raw_content=html_raw_content)
+            )
+
+    # parse APRS data
+    cols = tables.get("Table1")
+    if cols and len(cols) == 9:
+        radiosondy_response.update(zip(radiosondy_archive_aprs_columns, cols))
+    return RadiosondySnapshot.from_fields(radiosondy_response)
+
+
+def parse_radiosondy_dynamic_page(html_raw_content: str):
+    """
+    Parses a radiosondy.info page of a probe that is either planned
+    or still in process (dynamic content)
+
+    Parameters
+    ==========
+    html_raw_content: 'str'
+        content of the 'dyn/get_sondeinfo.php' page
+
+    Returns
+    =======
+    radiosondy_response: 'RadiosondySnapshot'
+        parsed page (value 'None' if not present)
+    """
+
+    radiosondy_response = get_empty_radiosondy_response()
 
     # With the exception of the APRS data, the data that we want / need is stored as regular
     # text. We use the text's icons in order to identify the content
-    regex_string = r"images\/balloon.png\"\> Number: ([\w\s]+)\<\/h4\>"
-    matches = re.search(
-        pattern=regex_string,
-        string=html_raw_content,
-        flags=re.IGNORECASE,
+    radiosondy_response.update(
+        parse_radiosondy_html_content(html_raw_content=html_raw_content)
     )
-    if matches:
-        _sonde_number = matches[1]
 
-    regex_string = r"images\/house.png\"\> Launch Site: (.*)\<\/h4\>"
-    matches = re.search(
-        pattern=regex_string,
-        string=html_raw_content,
-        flags=re.IGNORECASE,
+    # Parse the APRS data
+    tables = get_radiosondy_table_rows(
+        html_raw_content=html_raw_content, table_ids=("Table1",)
     )
-    if matches:
-        _launch_site = matches[1]
+    cols = tables.get("Table1")
+    if cols and len(cols) == 13:
+        radiosondy_response.update(zip(radiosondy_dynamic_aprs_columns, cols))
 
-    regex_string = r"images\/type.png\"\> Type: (.*)\<\/h4\>"
-    matches = re.search(
-        pattern=regex_string,
-        string=html_raw_content,
-        flags=re.IGNORECASE,
-    )
-    if matches:
-        _probe_type = matches[1]
+        # Remove the additional content such as units of measure etc.
+        # Yes, this is quick and dirty
+        for field, trailing_content in radiosondy_units_of_measure.items():
+            radiosondy_response[field] = remove_trailing_content(
+                source_string=radiosondy_response[field],
+                trailing_content=trailing_content,
+            )
+    return RadiosondySnapshot.from_fields(radiosondy_response)
 
-    regex_string = r"images\/aux.png\"\> AUX: (.*)\<\/h4\>"
-    matches = re.search(
-        pattern=regex_string,
-        string=html_raw_content,
-        flags=re.IGNORECASE,
-    )
-    if matches:
-        _probe_aux = matches[1]
 
-    regex_string = r"images\/freq.png\"\> Frequency: (.*) MHz\<\/h4\>"
-    matches = re.search(
-        pattern=regex_string,
-        string=html_raw_content,
-        flags=re.IGNORECASE,
-    )
-    if matches:
-        _probe_freq = matches[1]
+def get_radiosondy_cache():
+    """
+    Returns the radiosondy.info page cache. The cache gets created on
+    first use, based on the 'radiosondy_cache' config file section
 
-    regex_string = r"images\/found.png\"\> Status: (.*)\<\/h4\>"
-    matches = re.search(
-        pattern=regex_string,
-        string=html_raw_content,
-        flags=re.IGNORECASE,
-    )
-    if matches:
-        _probe_status = matches[1]
+    Parameters
+    ==========
 
-    regex_string = r"images\/speed.png\"\> Max Speed: (.*) km\/h at (.*) m\<\/h4\>"
-    matches = re.search(
-        pattern=regex_string,
-        string=html_raw_content,
-        flags=re.IGNORECASE,
-    )
-    if matches:
-        _max_speed = matches[1]
-        _max_speed_height = matches[2]
-
-    regex_string = r"images\/speed.png\"\> Average Speed: (.*) km\/h\<\/h4\>"
-    matches = re.search(
-        pattern=regex_string,
-        string=html_raw_content,
-        flags=re.IGNORECASE,
-    )
-    if matches:
-        _avg_speed_kmh = matches[1]
+    Returns
+    =======
+    radiosondy_cache: 'ExpiringCache'
+        radiosondy.info page cache
+    """
 
-    regex_string = r"images\/altitude.png\"\> Max Altitude: (.*) m\<\/h4\>"
-    matches = re.search(
-        pattern=regex_string,
-        string=html_raw_content,
-        flags=re.IGNORECASE,
-    )
-    if matches:
-        _max_altitude = matches[1]
+    global radiosondy_cache
+
+    with radiosondy_cache_lock:
+        if radiosondy_cache is None:
+            radiosondy_cache_config = read_config_section(
+                section_name="radiosondy_cache", defaults=radiosondy_cache_defaults
+            )
+            radiosondy_cache = ExpiringCache(
+                name="radiosondy",
+                max_entries=radiosondy_cache_config["max_entries"],
+                default_ttl=radiosondy_cache_config["ttl"],
+            )
+    return radiosondy_cache
+
+
+def get_radiosondy_page(url: str, headers: dict, parse_page):
+    """
+    Gets and parses a radiosondy.info page. If we have seen the page
+    before, the request is sent with the page's validators; if the
+    server reports the page as unchanged (HTTP 304) or if its content
+    is identical to the previous one, the previous parse result is
+    returned without parsing the page again.
+
+    Parameters
+    ==========
+    url: 'str'
+        radiosondy.info URL
+    headers: 'dict'
+        HTTP request headers
+    parse_page: 'function'
+        page parser, called with the final (redirected) URL
+        and the page content
 
-    regex_string = r"images\/up.png\"\> Average Ascent Speed: (.*) m\/s\<\/h4\>"
-    matches = re.search(
-        pattern=regex_string,
-        string=html_raw_content,
-        flags=re.IGNORECASE,
+    Returns
+    =======
+    success: 'bool'
+        True if the page could be retrieved
+    page_url: 'str'
+        final URL of the page (after redirects)
+    response: 'object'
+        parse_page()'s result
+    """
+
+    cache = get_radiosondy_cache()
+    found_in_cache, cached_page = cache.get(url)
+
+    request_headers = dict(headers)
+    if found_in_cache:
+        if cached_page["etag"]:
+            request_headers["If-None-Match"] = cached_page["etag"]
+        if cached_page["last_modified"]:
+            request_headers["If-Modified-Since"] = cached_page["last_modified"]
+
+    try:
+        page = get_http_session().get(url=url, headers=request_headers)
+    except:
+        logger.info(f"Cannot access {url}")
+        return False, url, None
+
+    if found_in_cache and page.status_code == 304:
+        logger.info(f"{url} has not been modified")
+        cache.set(url, cached_page)
+        return True, cached_page["page_url"], cached_page["response"]
+    if page.status_code != 200:
+        return False, page.url, None
+
+    digest = hashlib.sha1(page.content).digest()
+    if (
+        found_in_cache
+        and cached_page["digest"] == digest
+        and cached_page["page_url"] == page.url
+    ):
+        logger.info(f"{url} is unchanged")
+        response = cached_page["response"]
+    else:
+        with trace_span("radiosondy_parse", page_url=page.url):
+            response = parse_page(page.url, page.text)
+
+    cache.set(
+        url,
+        {
+            "etag": page.headers.get("ETag"),
+            "last_modified": page.headers.get("Last-Modified"),
+            "digest": digest,
+            "page_url": page.url,
+            "response": response,
+        },
     )
-    if matches:
-        _avg_ascent_speed = matches[1]
+    return True, page.url, response
+
+
+def parse_radiosondy_main_page(page_url: str, html_raw_content: str):
+    """
+    Parses radiosondy.info's main page. Only archived radiosondes
+    (redirect to 'sonde_archive.php') provide data on this page.
+
+    Parameters
+    ==========
+    page_url: 'str'
+        final URL of the page
+    html_raw_content: 'str'
+        radiosondy.info page content
+
+    Returns
+    =======
+    radiosondy_response: 'RadiosondySnapshot'
+        parsed page (None if the radiosonde has not been archived)
+    """
+
+    if "sonde_archive.php" in page_url:
+        return parse_radiosondy_archive_page(html_raw_content=html_raw_content)
+    return None
+
+
+def add_radiosondy_track_point(sonde_id: str, radiosondy_response: RadiosondySnapshot):
+    """
+    Adds the APRS data (Table1) of a radiosondy.info page to the
+    radiosonde's track
+
+    Parameters
+    ==========
+    sonde_id: 'str'
+        Radiosonde ID (upper case)
+    radiosondy_response: 'RadiosondySnapshot'
+        parsed radiosondy.info page
 
-    regex_string = r"images\/down.png\"\> Average Descent Speed: (.*) m\/s\<\/h4\>"
-    matches = re.search(
-        pattern=regex_string,
-        string=html_raw_content,
-        flags=re.IGNORECASE,
+    Returns
+    =======
+    """
+
+    if radiosondy_response.datetime_utc is None:
+        return
+    add_track_point(
+        sonde_id,
+        radiosondy_response.datetime_utc,
+        **{
+            column: radiosondy_response[field]
+            for column, field in radiosondy_track_fields.items()
+        },
     )
-    if matches:
-        _avg_descent_speed = matches[1]
-
-    response_dict = {
-        "sonde_number": _sonde_number,
-        "launch_site": _launch_site,
-        "probe_type": _probe_type,
-        "probe_aux": _probe_aux,
-        "probe_freq": _probe_freq,
-        "probe_status": _probe_status,
-        "max_speed": _max_speed,
-        "max_speed_height": _max_speed_height,
-        "avg_speed_kmh": _avg_speed_kmh,
-        "max_altitude": _max_altitude,
-        "avg_ascent_speed": _avg_ascent_speed,
-        "avg_descent_speed": _avg_descent_speed,
-    }
-    return response_dict
 
 
 def get_radiosondy_data(sonde_id: str):
@@ -495,31 +1455,37 @@ def get_radiosondy_data(sonde_id: str):
     =======
     success: 'bool'
         True if operation was successful
-    radiosondy_response: 'dict'
-        Dictionary with all possible response fields
-        (value 'None' if not present)
+    radiosondy_response: 'RadiosondySnapshot'
+        parsed radiosondy.info data (value 'None' if not present).
+        The fields can also be read by name, like the former
+        response dictionary's values
     """
 
     sonde_id = sonde_id.upper()
 
-    # start the communication
-    d = activesoup.Driver()
+    # Concurrent requests for the same radiosonde share the upstream
+    # requests; the snapshot is immutable, so all callers share it
+    return radiosondy_flights.do(sonde_id, query_radiosondy_data, sonde_id=sonde_id)
+
+
+def query_radiosondy_data(sonde_id: str):
+    """
+    Queries radiosondy.info for a radiosonde; see get_radiosondy_data()
+
+    Parameters
+    ==========
+    sonde_id : 'str'
+        ID of the sonde (upper case)
+
+    Returns
+    =======
+    see get_radiosondy_data(); radiosondy_response may be a cached snapshot
+    """
+
     headers = {"User-Agent": "Mozilla"}
 
     # Init our target variables - this is the data that will be returned to the user
-    launch_site = probe_type = probe_aux = probe_freq = None
-    probe_status = probe_finder = landing_point = None
-    landing_point_latitude = landing_point_longitude = 0.0
-    landing_description = changes_made = None
-    receiver = sonde_number = datetime_utc = None
-    latitude = longitude = course_deg = speed_kmh = None
-    altitude_m = aprs_comment = None
-    climbing = temperature = pressure = humidity = aux_o3 = None
-    max_speed = max_speed_height = avg_speed_kmh = max_altitude = None
-    avg_ascent_speed = avg_descent_speed = None
-
-    # general success / failure boolean
-    success = False
+    radiosondy_response = RadiosondySnapshot()
 
     # We need to service up to two URLs:
     # main URL is of relevance if the probe has been archived (static content)
@@ -527,217 +1493,33 @@ def get_radiosondy_data(sonde_id: str):
     main_url = f"https://radiosondy.info/sonde.php?sondenumber={sonde_id}"
     dyn_url = f"https://radiosondy.info/dyn/get_sondeinfo.php?sondenumber={sonde_id}"
 
-    # Get the main URL
-    try:
-        page = d.get(url=main_url, headers=headers)
-    except:
-        logger.info(f"Cannot access {main_url}")
-        page = None
-
-    if page:
-        if page.last_response.status_code == 200:
-            success = True
-            # In case the response's URL indicates that the request got redirected to the archived data
-            if "sonde_archive.php" in page.last_response.url:
-                logger.info("Parsing static Radiosondy data")
-                soup = BeautifulSoup(page.last_response.response.text, "html.parser")
-                # Archived probe; we have proper tables and can parse them. Page has STATIC content
-                # Parse Table "Status Changes"
-                table = soup.find("table", attrs={"id": "Table2"})
-                if table:
-                    # get first row
-                    rows = table.find("tr", attrs={"class": "bg_1"})
-                    # There was at least one minimal change
-                    if rows:
-                        # There was at least one minimal change for this radiosonde
-                        cols = rows.find_all("td")
-                        if cols and len(cols) == 9:
-                            launch_site = cols[0].string
-                            probe_type = cols[1].string
-                            probe_aux = cols[2].string
-                            probe_freq = cols[3].string
-                            probe_status = cols[4].string
-                            probe_finder = cols[5].string
-                            landing_point = cols[6].string
-                            landing_description = cols[7].string
-                            changes_made = cols[8].string
-
-                            regex_string = r"^(-?\d*[.]\d*),\s*(-?\d*[.]\d*)$"
-                            matches = re.search(
-                                pattern=regex_string,
-                                string=landing_point,
-                                flags=re.IGNORECASE,
-                            )
-                            if matches:
-                                try:
-                                    landing_point_latitude = float(matches[1])
-                                    landing_point_longitude = float(matches[2])
-                                except ValueError:
-                                    landing_point_longitude = (
-                                        landing_point_longitude
-                                    ) = 0.0
-                    else:
-                        # This branch gets executed in case the probe's status has never changed since its inception
-                        # With the exception of the APRS data, the data that we want / need is stored as regular
-                        # text. We use the text's icons in order to identify the content
-                        html_response_dict = parse_radiosondy_html_content(
-                            html_raw_content=page.last_response.response.text
-                        )
-                        sonde_number = html_response_dict["sonde_number"]
-                        launch_site = html_response_dict["launch_site"]
-                        probe_type = html_response_dict["probe_type"]
-                        probe_freq = html_response_dict["probe_freq"]
-                        probe_aux = html_response_dict["probe_aux"]
-                        probe_status = html_response_dict["probe_status"]
-                        max_speed = html_response_dict["max_speed"]
-                        max_speed_height = html_response_dict["max_speed_height"]
-                        avg_speed_kmh = html_response_dict["avg_speed_kmh"]
-                        max_altitude = html_response_dict["max_altitude"]
-                        avg_ascent_speed = html_response_dict["avg_ascent_speed"]
-                        avg_descent_speed = html_response_dict["avg_descent_speed"]
-
-                # pparse APRS data
-                table = soup.find("table", attrs={"id": "Table1"})
-                if table:
-                    # get first row
-                    rows = table.find("tr", attrs={"class": "bg_1"})
-                    if rows:
-                        cols = rows.find_all("td")
-                        if cols and len(cols) == 9:
-                            receiver = cols[0].string
-                            sonde_number = cols[1].string
-                            datetime_utc = cols[2].string
-                            latitude = cols[3].string
-                            longitude = cols[4].string
-                            course_deg = cols[5].string
-                            speed_kmh = cols[6].string
-                            altitude_m = cols[7].string
-                            aprs_comment = cols[8].string
-            else:
-                # Probe is either planned or still in process. We have DYNAMIC content and need to get this from a different URL
-                logger.info("parsing dynamic URL")
-                try:
-                    page = d.get(url=dyn_url, headers=headers)
-                except:
-                    page = None
-                    success = False
-                if page:
-                    if page.last_response.status_code == 200:
-
-                        # With the exception of the APRS data, the data that we want / need is stored as regular
-                        # text. We use the text's icons in order to identify the content
-                        html_response_dict = parse_radiosondy_html_content(
-                            html_raw_content=page.last_response.response.text
-                        )
-                        sonde_number = html_response_dict["sonde_number"]
-                        launch_site = html_response_dict["launch_site"]
-                        probe_type = html_response_dict["probe_type"]
-                        probe_freq = html_response_dict["probe_freq"]
-                        probe_aux = html_response_dict["probe_aux"]
-                        probe_status = html_response_dict["probe_status"]
-                        max_speed = html_response_dict["max_speed"]
-                        max_speed_height = html_response_dict["max_speed_height"]
-                        avg_speed_kmh = html_response_dict["avg_speed_kmh"]
-                        max_altitude = html_response_dict["max_altitude"]
-                        avg_ascent_speed = html_response_dict["avg_ascent_speed"]
-                        avg_descent_speed = html_response_dict["avg_descent_speed"]
-
-                        soup = BeautifulSoup(
-                            page.last_response.response.text, "html.parser"
-                        )
-                        # Parse the APRS data
-                        table = soup.find("table", attrs={"id": "Table1"})
-                        if table:
-                            # get first row
-                            rows = table.find("tr", attrs={"class": "bg_1"})
-                            if rows:
-                                cols = rows.find_all("td")
-                                if cols and len(cols) == 13:
-                                    receiver = cols[0].string
-                                    sonde_number = cols[1].string
-                                    datetime_utc = cols[2].string
-                                    latitude = cols[3].string
-                                    longitude = cols[4].string
-                                    course_deg = cols[5].string
-                                    speed_kmh = cols[6].string
-                                    altitude_m = cols[7].string
-                                    climbing = cols[8].string
-                                    temperature = cols[9].string
-                                    pressure = cols[10].string
-                                    humidity = cols[11].string
-                                    aux_o3 = cols[12].string
-
-                                    # Remove the additional content such as units of measure etc.
-                                    # Yes, this is quick and dirty
-                                    climbing = remove_trailing_content(
-                                        source_string=climbing, trailing_content=" m/s"
-                                    )
-                                    altitude_m = remove_trailing_content(
-                                        source_string=altitude_m, trailing_content=" m"
-                                    )
-                                    aux_o3 = remove_trailing_content(
-                                        source_string=aux_o3, trailing_content=" mPa"
-                                    )
-                                    course_deg = remove_trailing_content(
-                                        source_string=course_deg, trailing_content=" °"
-                                    )
-                                    humidity = remove_trailing_content(
-                                        source_string=humidity, trailing_content=" %"
-                                    )
-                                    pressure = remove_trailing_content(
-                                        source_string=pressure, trailing_content=" hPa"
-                                    )
-                                    speed_kmh = remove_trailing_content(
-                                        source_string=speed_kmh,
-                                        trailing_content=" km/h",
-                                    )
-                                    temperature = remove_trailing_content(
-                                        source_string=temperature,
-                                        trailing_content=" °C",
-                                    )
-                                    latitude = remove_trailing_content(
-                                        source_string=latitude, trailing_content=" φ"
-                                    )
-                                    longitude = remove_trailing_content(
-                                        source_string=longitude, trailing_content=" λ"
-                                    )
-                    else:
-                        # We were unable to access the dynamic PHP data - return an error to the user
-                        success = False
-
-    radiosondy_response = {
-        "launch_site": launch_site,
-        "probe_type": probe_type,
-        "probe_aux": probe_aux,
-        "probe_freq": probe_freq,
-        "probe_status": probe_status,
-        "probe_finder": probe_finder,
-        "landing_point": landing_point,
-        "landing_point_latitude": landing_point_latitude,
-        "landing_point_longitude": landing_point_longitude,
-        "landing_description": landing_description,
-        "changes_made": changes_made,
-        "receiver": receiver,
-        "sonde_number": sonde_number,
-        "datetime_utc": datetime_utc,
-        "latitude": latitude,
-        "longitude": longitude,
-        "course_deg": course_deg,
-        "speed_kmh": speed_kmh,
-        "altitude_m": altitude_m,
-        "aprs_comment": aprs_comment,
-        "climbing_meters_per_second": climbing,
-        "temperature_celsius": temperature,
-        "pressure_hpa": pressure,
-        "humidity_percent": humidity,
-        "aux_o3": aux_o3,
-        "max_speed": max_speed,
-        "max_speed_height": max_speed_height,
-        "avg_speed_kmh": avg_speed_kmh,
-        "max_altitude": max_altitude,
-        "avg_ascent_speed": avg_ascent_speed,
-        "avg_descent_speed": avg_descent_speed,
-    }
+    # Get the main URL. Unchanged pages are served from our cache
+    success, _, archived_response = get_radiosondy_page(
+        url=main_url, headers=headers, parse_page=parse_radiosondy_main_page
+    )
+    if success:
+        # In case the response's URL indicates that the request got redirected to the archived data
+        if archived_response:
+            logger.info("Parsing static Radiosondy data")
+            radiosondy_response = archived_response
+        else:
+            # Probe is either planned or still in process. We have DYNAMIC content and need to get this from a different URL
+            logger.info("parsing dynamic URL")
+            success, _, dynamic_response = get_radiosondy_page(
+                url=dyn_url,
+                headers=headers,
+                parse_page=lambda _, html_raw_content: parse_radiosondy_dynamic_page(
+                    html_raw_content=html_raw_content
+                ),
+            )
+            if success:
+                radiosondy_response = dynamic_response
+
+    if success:
+        add_radiosondy_track_point(
+            sonde_id=sonde_id, radiosondy_response=radiosondy_response
+        )
+
     return success, radiosondy_response
 
 
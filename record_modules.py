@@ -0,0 +1,229 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: compact, typed result records for the aprs.fi positions,
+# landing predictions and radiosondy.info snapshots. Numeric values are
+# parsed once at the parse boundary. The records are named tuples:
+# they have no per-instance dictionary, pickle as their class plus a
+# plain tuple, and existing callers can still unpack them positionally
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Format of radiosondy.info's 'datetime_utc' field
+radiosondy_datetime_format = "%Y-%m-%d %H:%M:%S"
+
+
+class AprsfiPosition(NamedTuple):
+    """
+    aprs.fi position report; see get_aprsfi_report()
+    """
+
+    success: bool
+    latitude: float
+    longitude: float
+    altitude: float
+    lasttime: datetime
+    comment: Optional[str]
+    callsign: Optional[str]
+    course: Optional[float]
+    speed: Optional[float]
+
+    def __reduce__(self):
+        return type(self), tuple(self)
+
+
+class LandingPrediction(NamedTuple):
+    """
+    Landing prediction from habhub or the local prediction model;
+    see get_landing_prediction()
+    """
+
+    success: bool
+    latitude: float
+    longitude: float
+    timestamp: datetime
+    url: Optional[str] = None
+    ellipse: Optional[dict] = None
+
+    def __reduce__(self):
+        return type(self), tuple(self)
+
+
+class NearestPlace(NamedTuple):
+    """
+    Nearest populated place of a position; see OfflineGeocoder
+    """
+
+    name: str
+    region: Optional[str]
+    country: Optional[str]
+    latitude: float
+    longitude: float
+    distance_km: float
+    bearing: float
+
+    def __reduce__(self):
+        return type(self), tuple(self)
+
+
+class RadiosondySnapshot(NamedTuple):
+    """
+    Parsed radiosondy.info page of a radiosonde. Missing values are None.
+    For the callers of the former response dictionary, the fields can
+    also be read by name (snapshot["probe_status"], get(), keys(), items(),
+    'in'); positional access and iteration work as for any tuple
+    """
+
+    launch_site: Optional[str] = None
+    probe_type: Optional[str] = None
+    probe_aux: Optional[str] = None
+    probe_freq: Optional[str] = None
+    probe_status: Optional[str] = None
+    probe_finder: Optional[str] = None
+    landing_point: Optional[str] = None
+    landing_point_latitude: float = 0.0
+    landing_point_longitude: float = 0.0
+    landing_description: Optional[str] = None
+    changes_made: Optional[str] = None
+    receiver: Optional[str] = None
+    sonde_number: Optional[str] = None
+    datetime_utc: Optional[datetime] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    course_deg: Optional[float] = None
+    speed_kmh: Optional[float] = None
+    altitude_m: Optional[float] = None
+    aprs_comment: Optional[str] = None
+    climbing_meters_per_second: Optional[float] = None
+    temperature_celsius: Optional[float] = None
+    pressure_hpa: Optional[float] = None
+    humidity_percent: Optional[float] = None
+    aux_o3: Optional[float] = None
+    max_speed: Optional[float] = None
+    max_speed_height: Optional[float] = None
+    avg_speed_kmh: Optional[float] = None
+    max_altitude: Optional[float] = None
+    avg_ascent_speed: Optional[float] = None
+    avg_descent_speed: Optional[float] = None
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        # field names, as for the former response dictionary
+        return key in self._fields
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in self._fields else default
+
+    def keys(self):
+        return self._fields
+
+    def items(self):
+        return zip(self._fields, self)
+
+    def __reduce__(self):
+        return type(self), tuple(self)
+
+    @classmethod
+    def from_fields(cls, fields: dict):
+        """
+        Creates a snapshot from the raw (string) values of a
+        radiosondy.info page; numbers and the timestamp get parsed
+
+        Parameters
+        ==========
+        fields: 'dict'
+            field names and their raw values
+
+        Returns
+        =======
+        snapshot: 'RadiosondySnapshot'
+            parsed snapshot; invalid values become None
+        """
+        values = dict(fields)
+        for field in radiosondy_float_fields:
+            values[field] = get_float_value(values.get(field))
+        try:
+            values["datetime_utc"] = datetime.strptime(
+                values.get("datetime_utc"), radiosondy_datetime_format
+            )
+        except (TypeError, ValueError):
+            values["datetime_utc"] = None
+        for field in ("landing_point_latitude", "landing_point_longitude"):
+            if values.get(field) is None:
+                values[field] = 0.0
+        return cls(**{field: values.get(field) for field in cls._fields})
+
+
+# radiosondy.info fields which get parsed into floats
+radiosondy_float_fields = [
+    field
+    for field, field_type in RadiosondySnapshot.__annotations__.items()
+    if field_type in (float, Optional[float])
+]
+
+
+def get_float_value(value):
+    """
+    Converts a telemetry value to float
+
+    Parameters
+    ==========
+    value: 'str' or 'float'
+        value from an upstream response (or None)
+
+    Returns
+    =======
+    value: 'float'
+        float value; None if the value is missing or invalid
+    """
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+if __name__ == "__main__":
+    import pickle
+    import sys
+
+    raw_fields = {
+        "probe_status": "FLYING",
+        "latitude": "51.55010",
+        "longitude": "11.98120",
+        "altitude_m": "1200",
+        "datetime_utc": "2021-06-01 14:30:00",
+    }
+    snapshot = RadiosondySnapshot.from_fields(raw_fields)
+    logger.info(snapshot)
+    logger.info(
+        f"pickled: {len(pickle.dumps(snapshot))} bytes, instance: {sys.getsizeof(snapshot)} bytes"
+    )
@@ -0,0 +1,364 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: bounded worker pool which executes its tasks round-robin
+# across their keys (e.g. Telegram chats), so that a single chat with
+# many requests cannot starve all other chats
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextvars
+import logging
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, wait
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Results of FairScheduler.submit()
+submit_accepted = "accepted"
+submit_queue_full = "queue_full"
+submit_key_queue_full = "key_queue_full"
+submit_shutdown = "shutdown"
+
+# All schedulers that have been created so far; used for the statistics
+scheduler_registry = []
+scheduler_registry_lock = threading.Lock()
+
+
+class FairScheduler:
+    """
+    Thread pool with one FIFO queue per key. Idle workers serve the
+    keys with pending tasks round-robin; the number of queued tasks
+    (overall and per key) and the number of running tasks per key
+    can be limited. Tasks run in a copy of the submitter's context
+    (contextvars), e.g. for tracing.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        worker_threads: int,
+        max_queued: int = 0,
+        max_queued_per_key: int = 0,
+        max_running_per_key: int = 0,
+        wait_time_samples: int = 1000,
+    ):
+        """
+        Parameters
+        ==========
+        name: 'str'
+            Scheduler name, used for the statistics and the thread names
+        worker_threads: 'int'
+            Number of worker threads
+        max_queued: 'int'
+            Max number of queued tasks across all keys (0 = unlimited)
+        max_queued_per_key: 'int'
+            Max number of queued tasks per key (0 = unlimited)
+        max_running_per_key: 'int'
+            Max number of running tasks per key (0 = unlimited)
+        wait_time_samples: 'int'
+            Number of recent queue wait times for the percentiles
+        """
+        self.name = name
+        self.max_queued = max(0, max_queued)
+        self.max_queued_per_key = max(0, max_queued_per_key)
+        self.max_running_per_key = max(0, max_running_per_key)
+
+        self._queues = {}
+        self._ready_keys = deque()
+        self._ready_key_set = set()
+        self._running = Counter()
+        self._busy_threads = set()
+        self._queued = 0
+        self._shutdown = False
+        self._condition = threading.Condition()
+
+        self.submitted = self.completed = self.failed = 0
+        self.rejected = Counter()
+        self.max_queue_depth = 0
+        self.wait_time_total = self.wait_time_max = 0.0
+        self._wait_times = deque(maxlen=max(1, wait_time_samples))
+
+        self._workers = [
+            threading.Thread(target=self._work, name=f"{name}_{number}", daemon=True)
+            for number in range(max(1, worker_threads))
+        ]
+        for worker in self._workers:
+            worker.start()
+
+        with scheduler_registry_lock:
+            scheduler_registry.append(self)
+
+    def _may_run(self, key):
+        # Caller must hold the lock
+        return (
+            not self.max_running_per_key
+            or self._running[key] < self.max_running_per_key
+        )
+
+    def _mark_ready(self, key):
+        # Caller must hold the lock
+        if (
+            key not in self._ready_key_set
+            and self._queues.get(key)
+            and self._may_run(key)
+        ):
+            self._ready_keys.append(key)
+            self._ready_key_set.add(key)
+            self._condition.notify()
+
+    def submit(self, key, function, *args, **kwargs):
+        """
+        Queues a task
+
+        Parameters
+        ==========
+        key: 'hashable'
+            fairness key, e.g. the Telegram chat ID
+        function: 'callable'
+            task function
+        args / kwargs:
+            task function arguments
+
+        Returns
+        =======
+        status: 'str'
+            submit_accepted, submit_queue_full, submit_key_queue_full
+            or submit_shutdown
+        future: 'Future'
+            Future of the task (None if the task was rejected)
+        """
+
+        with self._condition:
+            if self._shutdown:
+                status = submit_shutdown
+            elif self.max_queued and self._queued >= self.max_queued:
+                status = submit_queue_full
+            elif (
+                self.max_queued_per_key
+                and len(self._queues.get(key, ())) >= self.max_queued_per_key
+            ):
+                status = submit_key_queue_full
+            else:
+                status = submit_accepted
+            if status != submit_accepted:
+                self.rejected[status] += 1
+                return status, None
+
+            future = Future()
+            self._queues.setdefault(key, deque()).append(
+                (
+                    future,
+                    function,
+                    args,
+                    kwargs,
+                    time.monotonic(),
+                    contextvars.copy_context(),
+                )
+            )
+            self._queued += 1
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._queued)
+            self._mark_ready(key)
+            return status, future
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._ready_keys and not self._shutdown:
+                    self._condition.wait()
+                if not self._ready_keys:
+                    return
+                key = self._ready_keys.popleft()
+                self._ready_key_set.discard(key)
+                queue = self._queues[key]
+                future, function, args, kwargs, queued_since, context = queue.popleft()
+                if not queue:
+                    del self._queues[key]
+                self._queued -= 1
+                self._running[key] += 1
+                self._busy_threads.add(threading.get_ident())
+                # the key goes to the end of the line
+                self._mark_ready(key)
+
+                wait_time = time.monotonic() - queued_since
+                self.wait_time_total += wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+                self._wait_times.append(wait_time)
+
+            failed = False
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(context.run(function, *args, **kwargs))
+                except Exception as exception:
+                    # the caller gets the exception through the future
+                    future.set_exception(exception)
+                    failed = True
+
+            with self._condition:
+                self._running[key] -= 1
+                self._busy_threads.discard(threading.get_ident())
+                if not self._running[key]:
+                    del self._running[key]
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+                self._mark_ready(key)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stops the scheduler. Queued tasks get cancelled
+
+        Parameters
+        ==========
+        wait: 'bool'
+            wait until the running tasks have finished
+
+        Returns
+        =======
+        """
+
+        with self._condition:
+            self._shutdown = True
+            for queue in self._queues.values():
+                for future, _, _, _, _, _ in queue:
+                    future.cancel()
+            self._queues.clear()
+            self._ready_keys.clear()
+            self._ready_key_set.clear()
+            self._queued = 0
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def get_busy_thread_ids(self):
+        """
+        Returns the IDs of the worker threads that are running a task
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        thread_ids: 'set'
+            thread identifiers (see threading.get_ident())
+        """
+        with self._condition:
+            return set(self._busy_threads)
+
+    def get_statistics(self):
+        """
+        Get the scheduler's statistics
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        statistics: 'dict'
+            name, queued, max_queue_depth, running, waiting_keys,
+            submitted, completed, failed, rejected (by reason) and
+            the queue wait times in seconds (average, 95th percentile
+            of the recent tasks, max)
+        """
+        with self._condition:
+            recent_wait_times = sorted(self._wait_times)
+            return {
+                "name": self.name,
+                "queued": self._queued,
+                "max_queue_depth": self.max_queue_depth,
+                "running": sum(self._running.values()),
+                "waiting_keys": len(self._queues),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": dict(self.rejected),
+                "wait_time_avg": (
+                    self.wait_time_total / (self.submitted - self._queued)
+                    if self.submitted > self._queued
+                    else 0.0
+                ),
+                "wait_time_p95": (
+                    recent_wait_times[
+                        min(
+                            len(recent_wait_times) - 1,
+                            int(0.95 * len(recent_wait_times)),
+                        )
+                    ]
+                    if recent_wait_times
+                    else 0.0
+                ),
+                "wait_time_max": self.wait_time_max,
+            }
+
+
+def get_busy_thread_ids():
+    """
+    Returns the IDs of the worker threads of all
+    schedulers that are currently running a task
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    thread_ids: 'set'
+        thread identifiers (see threading.get_ident())
+    """
+    with scheduler_registry_lock:
+        schedulers = list(scheduler_registry)
+    thread_ids = set()
+    for scheduler in schedulers:
+        thread_ids |= scheduler.get_busy_thread_ids()
+    return thread_ids
+
+
+def get_scheduler_statistics():
+    """
+    Get the statistics of all schedulers
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    statistics: 'list'
+        List of statistics dictionaries, one per scheduler
+    """
+    with scheduler_registry_lock:
+        schedulers = list(scheduler_registry)
+    return [scheduler.get_statistics() for scheduler in schedulers]
+
+
+if __name__ == "__main__":
+    scheduler = FairScheduler(name="demo", worker_threads=1)
+    order = []
+    futures = []
+    for chat_id, count in [("A", 3), ("B", 1), ("C", 1)]:
+        for number in range(count):
+            _, future = scheduler.submit(chat_id, order.append, f"{chat_id}{number}")
+            futures.append(future)
+    wait(futures)
+    scheduler.shutdown(wait=True)
+    logger.info(order)
+    logger.info(get_scheduler_statistics())
@@ -0,0 +1,402 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: per-command traces. Each stage of a command (upstream
+# requests, parsing, predictions, Telegram calls) gets wrapped in a
+# timed span; the trace of each command is written as one JSON line
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from utility_modules import read_config_section
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Default settings for the optional 'tracing_config' config file section
+# enabled: write a trace for each command
+# directory: directory for the trace files; there is one JSON lines
+# file per day (traces-YYYY-MM-DD.jsonl)
+# retention_days: trace files older than this get deleted
+tracing_config_defaults = {
+    "enabled": True,
+    "directory": "traces",
+    "retention_days": 7,
+}
+
+tracing_config = None
+tracing_config_lock = threading.Lock()
+trace_file_lock = threading.Lock()
+
+# Trace and span of the current command. Tasks on a FairScheduler
+# run in the context of their submitter, so the spans of the upstream
+# pipelines end up in the trace of the command that started them
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_span_id = contextvars.ContextVar("current_span_id", default=None)
+
+
+class Trace:
+    """
+    Trace of a single command: a list of spans with their start
+    time (relative to the trace's start) and duration
+    """
+
+    def __init__(self, name: str, start: float = None, **attributes):
+        """
+        Parameters
+        ==========
+        name: 'str'
+            trace name, e.g. the command name 'sonde'
+        start: 'float'
+            time.monotonic() when the command was received
+            (default: now)
+        attributes:
+            additional trace attributes, e.g. the chat ID
+        """
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = attributes
+        self.start = time.monotonic() if start is None else start
+        self.timestamp = time.time() - (time.monotonic() - self.start)
+        self.spans = []
+        self._next_span_id = 0
+        self._lock = threading.Lock()
+        self._tokens = None
+        # work which outlives the command, see hold_trace()
+        self._holds = 0
+        self._record = None
+
+    def add_span(self, span: dict):
+        with self._lock:
+            self.spans.append(span)
+
+    def hold(self):
+        with self._lock:
+            self._holds += 1
+
+    def release(self):
+        with self._lock:
+            self._holds -= 1
+            if self._holds or self._record is None:
+                return
+            record, self._record = self._record, None
+        self._write(record)
+
+    def get_span_id(self):
+        with self._lock:
+            self._next_span_id += 1
+            return self._next_span_id
+
+    def __enter__(self):
+        self._tokens = (current_trace.set(self), current_span_id.set(None))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        current_trace.reset(self._tokens[0])
+        current_span_id.reset(self._tokens[1])
+        record = {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "timestamp": datetime.fromtimestamp(
+                self.timestamp, timezone.utc
+            ).isoformat(),
+            "duration_ms": round((time.monotonic() - self.start) * 1000, 3),
+            **self.attributes,
+        }
+        if exc_type:
+            record["error"] = exc_type.__name__
+        with self._lock:
+            if self._holds:
+                # gets written once the last hold has been released
+                self._record = record
+                return False
+        self._write(record)
+        return False
+
+    def _write(self, record: dict):
+        with self._lock:
+            record["spans"] = sorted(self.spans, key=lambda span: span["start_ms"])
+        write_trace(record)
+
+
+class TraceSpan:
+    """
+    Timed stage of a command; see trace_span()
+    """
+
+    def __init__(self, trace: Trace, name: str, attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.span_id = trace.get_span_id()
+        self.start = None
+        self._token = None
+
+    def set_attribute(self, name: str, value):
+        self.attributes[name] = value
+
+    def __enter__(self):
+        self.parent_id = current_span_id.get()
+        self._token = current_span_id.set(self.span_id)
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.monotonic()
+        current_span_id.reset(self._token)
+        span = {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ms": round((self.start - self.trace.start) * 1000, 3),
+            "duration_ms": round((end - self.start) * 1000, 3),
+            "thread": threading.current_thread().name,
+            **self.attributes,
+        }
+        if exc_type:
+            span["error"] = exc_type.__name__
+        self.trace.add_span(span)
+        return False
+
+
+class NoTraceSpan:
+    """
+    Span outside of a trace; does nothing
+    """
+
+    def set_attribute(self, name: str, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+no_trace_span = NoTraceSpan()
+
+
+def trace_span(name: str, **attributes):
+    """
+    Returns a context manager which records a span in the
+    current command's trace (if there is one)
+
+    Parameters
+    ==========
+    name: 'str'
+        span name, e.g. 'habhub_kml'
+    attributes:
+        additional span attributes
+
+    Returns
+    =======
+    span: 'TraceSpan'
+        context manager
+    """
+
+    trace = current_trace.get()
+    if trace is None:
+        return no_trace_span
+    return TraceSpan(trace=trace, name=name, attributes=attributes)
+
+
+def add_span(name: str, start: float, end: float, **attributes):
+    """
+    Records a span whose start and end are already known,
+    e.g. the time that a command has waited in the queue
+
+    Parameters
+    ==========
+    name: 'str'
+        span name
+    start / end: 'float'
+        time.monotonic() values
+    attributes:
+        additional span attributes
+
+    Returns
+    =======
+    """
+
+    trace = current_trace.get()
+    if trace is None:
+        return
+    trace.add_span(
+        {
+            "span_id": trace.get_span_id(),
+            "parent_id": current_span_id.get(),
+            "name": name,
+            "start_ms": round((start - trace.start) * 1000, 3),
+            "duration_ms": round((end - start) * 1000, 3),
+            "thread": threading.current_thread().name,
+            **attributes,
+        }
+    )
+
+
+def hold_trace(context: contextvars.Context):
+    """
+    Defers writing the trace of a context (if any) until release_trace()
+    has been called, so that work which the command has handed over to
+    another thread (e.g. queued Telegram messages) still ends up in it
+
+    Parameters
+    ==========
+    context: 'contextvars.Context'
+        context of the command, see contextvars.copy_context()
+
+    Returns
+    =======
+    """
+
+    trace = context.get(current_trace)
+    if trace is not None:
+        trace.hold()
+
+
+def release_trace(context: contextvars.Context):
+    """
+    Releases a hold_trace() hold; the trace gets written if
+    its command has finished and there are no other holds
+
+    Parameters
+    ==========
+    context: 'contextvars.Context'
+        see hold_trace()
+
+    Returns
+    =======
+    """
+
+    trace = context.get(current_trace)
+    if trace is not None:
+        trace.release()
+
+
+def get_tracing_config():
+    """
+    Returns the 'tracing_config' settings; they get read on first use
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    tracing_config: 'dict'
+        see tracing_config_defaults
+    """
+
+    global tracing_config
+
+    with tracing_config_lock:
+        if tracing_config is None:
+            tracing_config = read_config_section(
+                section_name="tracing_config", defaults=tracing_config_defaults
+            )
+    return tracing_config
+
+
+def start_trace(name: str, start: float = None, **attributes):
+    """
+    Returns a context manager which traces a command
+
+    Parameters
+    ==========
+    name: 'str'
+        trace name, e.g. the command name 'sonde'
+    start: 'float'
+        time.monotonic() when the command was received
+    attributes:
+        additional trace attributes, e.g. the chat ID
+
+    Returns
+    =======
+    trace: 'Trace'
+        context manager (a no-op if tracing is disabled)
+    """
+
+    if not get_tracing_config()["enabled"]:
+        return no_trace_span
+    return Trace(name, start, **attributes)
+
+
+def write_trace(record: dict):
+    """
+    Appends a trace to the current day's trace file and
+    deletes the files that have exceeded their retention
+
+    Parameters
+    ==========
+    record: 'dict'
+        trace
+
+    Returns
+    =======
+    """
+
+    config = get_tracing_config()
+    directory = config["directory"]
+    today = datetime.now(timezone.utc).date()
+    file_name = os.path.join(directory, f"traces-{today.isoformat()}.jsonl")
+    line = json.dumps(record, default=str, separators=(",", ":")) + "\n"
+
+    with trace_file_lock:
+        try:
+            new_file = not os.path.exists(file_name)
+            os.makedirs(directory, exist_ok=True)
+            with open(file_name, "a", encoding="utf-8") as trace_file:
+                trace_file.write(line)
+        except OSError:
+            logger.info(f"Cannot write trace file {file_name}")
+            return
+        if new_file:
+            delete_expired_trace_files(
+                directory=directory,
+                oldest_date=today - timedelta(days=max(0, config["retention_days"])),
+            )
+
+
+def delete_expired_trace_files(directory: str, oldest_date):
+    for file_name in os.listdir(directory):
+        if not (file_name.startswith("traces-") and file_name.endswith(".jsonl")):
+            continue
+        try:
+            file_date = datetime.strptime(file_name[7:-6], "%Y-%m-%d").date()
+        except ValueError:
+            continue
+        if file_date < oldest_date:
+            try:
+                os.remove(os.path.join(directory, file_name))
+            except OSError:
+                logger.info(f"Cannot delete trace file {file_name}")
+
+
+if __name__ == "__main__":
+    with start_trace("demo", chat_id=1):
+        with trace_span("outer", sonde_id="S1250118"):
+            with trace_span("inner"):
+                time.sleep(0.01)
+    logger.info(f"Trace written to {get_tracing_config()['directory']}")
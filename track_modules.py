@@ -0,0 +1,455 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: append-only store for the telemetry of each radiosonde
+# (aprs.fi positions and radiosondy.info APRS data), kept in
+# memory-mapped column files
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from utility_modules import read_config_section
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Default settings for the optional 'track_store' config file section
+# enabled: False disables the track store
+# directory: directory for the track files
+# capacity: max number of points per radiosonde; once a track is full,
+# every other point of its older half gets dropped
+# max_open_tracks: max number of simultaneously mapped tracks
+# min_clmb_interval / max_clmb_age: a climb rate is only derived from
+# two fixes which are at least min_clmb_interval seconds apart and
+# not older than max_clmb_age seconds
+track_store_defaults = {
+    "enabled": True,
+    "directory": "tracks",
+    "capacity": 4096,
+    "max_open_tracks": 64,
+    "min_clmb_interval": 5.0,
+    "max_clmb_age": 300.0,
+}
+
+# Columns of a track. Time and position need double precision, all
+# other values are stored as float32. Missing values are NaN
+track_float64_columns = ["timestamp", "latitude", "longitude"]
+track_float32_columns = [
+    "altitude",
+    "climbing",
+    "course",
+    "speed",
+    "temperature",
+    "pressure",
+    "humidity",
+]
+track_columns = track_float64_columns + track_float32_columns
+
+track_store = None
+track_store_lock = threading.Lock()
+
+
+def get_epoch_seconds(timestamp: datetime):
+    """
+    Converts a (naive, UTC) datetime to seconds since the epoch
+
+    Parameters
+    ==========
+    timestamp: 'datetime'
+        UTC timestamp
+
+    Returns
+    =======
+    seconds: 'float'
+        seconds since 1970-01-01 00:00:00 UTC
+    """
+
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+class SondeTrack:
+    """
+    Telemetry of a single radiosonde: one memory-mapped column file for
+    the float64 columns and one for the float32 columns. The points
+    are sorted by time; unused slots have a NaN timestamp.
+    """
+
+    def __init__(self, file_name_prefix: str, capacity: int):
+        """
+        Parameters
+        ==========
+        file_name_prefix: 'str'
+            path and file name without the extension
+        capacity: 'int'
+            number of points for new track files. Existing track
+            files keep their capacity
+        """
+        self.float64_data = self._open_column_file(
+            f"{file_name_prefix}.f8.npy", np.float64, track_float64_columns, capacity
+        )
+        self.float32_data = self._open_column_file(
+            f"{file_name_prefix}.f4.npy", np.float32, track_float32_columns, capacity
+        )
+        self.capacity = min(self.float64_data.shape[1], self.float32_data.shape[1])
+        self.timestamps = self.float64_data[0]
+        self.count = int(np.count_nonzero(~np.isnan(self.timestamps[: self.capacity])))
+
+    @staticmethod
+    def _open_column_file(file_name: str, dtype, columns: list, capacity: int):
+        if os.path.isfile(file_name):
+            data = np.lib.format.open_memmap(file_name, mode="r+")
+            if data.dtype == dtype and data.ndim == 2 and data.shape[0] == len(columns):
+                return data
+            logger.info(f"Replacing incompatible track file {file_name}")
+            del data
+        data = np.lib.format.open_memmap(
+            file_name, mode="w+", dtype=dtype, shape=(len(columns), capacity)
+        )
+        data[:] = np.nan
+        return data
+
+    def _downsample(self):
+        # Drop every other point of the older half of the track
+        half = self.count // 2
+        keep = np.r_[0:half:2, half : self.count]
+        new_count = len(keep)
+        for data in (self.float64_data, self.float32_data):
+            data[:, :new_count] = data[:, keep]
+            data[:, new_count : self.count] = np.nan
+        self.count = new_count
+
+    def add_point(self, timestamp: float, values: dict):
+        """
+        Adds a point to the track. A point with the same timestamp as
+        an existing one gets merged into it (new values win)
+
+        Parameters
+        ==========
+        timestamp: 'float'
+            seconds since the epoch
+        values: 'dict'
+            column names and their values; missing values are None
+
+        Returns
+        =======
+        """
+
+        index = int(np.searchsorted(self.timestamps[: self.count], timestamp))
+        if index < self.count and self.timestamps[index] == timestamp:
+            self._set_values(index, values)
+            return
+
+        if self.count == self.capacity:
+            self._downsample()
+            index = int(np.searchsorted(self.timestamps[: self.count], timestamp))
+        if index < self.count:
+            # out-of-order point; make room for it
+            for data in (self.float64_data, self.float32_data):
+                data[:, index + 1 : self.count + 1] = data[:, index : self.count]
+                data[:, index] = np.nan
+        self.count += 1
+        self.timestamps[index] = timestamp
+        self._set_values(index, values)
+
+    def _set_values(self, index: int, values: dict):
+        for row, column in enumerate(track_float64_columns[1:], start=1):
+            if values.get(column) is not None:
+                self.float64_data[row, index] = values[column]
+        for row, column in enumerate(track_float32_columns):
+            if values.get(column) is not None:
+                self.float32_data[row, index] = values[column]
+
+    def get_points(self, start: float = None, end: float = None):
+        """
+        Returns the points within a time range
+
+        Parameters
+        ==========
+        start / end: 'float'
+            time range in seconds since the epoch (inclusive);
+            None for an open range
+
+        Returns
+        =======
+        points: 'dict'
+            column names and their values as numpy arrays
+        """
+
+        timestamps = self.timestamps[: self.count]
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, "left"))
+        last = (
+            self.count
+            if end is None
+            else int(np.searchsorted(timestamps, end, "right"))
+        )
+        points = {}
+        for row, column in enumerate(track_float64_columns):
+            points[column] = np.array(self.float64_data[row, first:last])
+        for row, column in enumerate(track_float32_columns):
+            points[column] = np.array(self.float32_data[row, first:last])
+        return points
+
+    def flush(self):
+        self.float64_data.flush()
+        self.float32_data.flush()
+
+
+class TrackStore:
+    """
+    Thread-safe collection of radiosonde tracks. Tracks are mapped on
+    first use; the least recently used track gets unmapped once more
+    than 'max_open_tracks' tracks are open.
+    """
+
+    def __init__(self, track_config: dict):
+        """
+        Parameters
+        ==========
+        track_config: 'dict'
+            'track_store' settings
+        """
+        self.track_config = track_config
+        self.directory = track_config["directory"]
+        self._tracks = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _get_track(self, sonde_id: str, create: bool):
+        # Caller must hold the lock
+        sonde_id = sonde_id.upper()
+        track = self._tracks.get(sonde_id)
+        if track is not None:
+            self._tracks.move_to_end(sonde_id)
+            return track
+        file_name_prefix = os.path.join(
+            self.directory, re.sub(r"[^A-Z0-9_-]", "_", sonde_id)
+        )
+        if not create and not os.path.isfile(f"{file_name_prefix}.f8.npy"):
+            return None
+        track = SondeTrack(
+            file_name_prefix=file_name_prefix,
+            capacity=max(2, self.track_config["capacity"]),
+        )
+        self._tracks[sonde_id] = track
+        while len(self._tracks) > max(1, self.track_config["max_open_tracks"]):
+            _, evicted_track = self._tracks.popitem(last=False)
+            evicted_track.flush()
+        return track
+
+    def add_point(self, sonde_id: str, timestamp: datetime, **values):
+        """
+        Adds a telemetry point to a radiosonde's track
+
+        Parameters
+        ==========
+        sonde_id: 'str'
+            Radiosonde ID
+        timestamp: 'datetime'
+            UTC time of the point
+        values: 'float'
+            values of the track columns (latitude, longitude,
+            altitude, ...); None for missing values
+
+        Returns
+        =======
+        """
+
+        with self._lock:
+            track = self._get_track(sonde_id=sonde_id, create=True)
+            track.add_point(timestamp=get_epoch_seconds(timestamp), values=values)
+
+    def get_track(self, sonde_id: str, start: datetime = None, end: datetime = None):
+        """
+        Returns a radiosonde's track within a time range
+
+        Parameters
+        ==========
+        sonde_id: 'str'
+            Radiosonde ID
+        start / end: 'datetime'
+            UTC time range (inclusive); None for an open range
+
+        Returns
+        =======
+        points: 'dict'
+            column names and their values as numpy arrays. Timestamps
+            are seconds since the epoch; all arrays are empty if
+            there is no track for this radiosonde
+        """
+
+        with self._lock:
+            track = self._get_track(sonde_id=sonde_id, create=False)
+            if track is None:
+                return {column: np.zeros(0) for column in track_columns}
+            return track.get_points(
+                start=get_epoch_seconds(start) if start else None,
+                end=get_epoch_seconds(end) if end else None,
+            )
+
+    def get_derived_clmb(self, sonde_id: str, timestamp: datetime):
+        """
+        Derives a radiosonde's climb rate from its two latest fixes
+        with altitude information
+
+        Parameters
+        ==========
+        sonde_id: 'str'
+            Radiosonde ID
+        timestamp: 'datetime'
+            UTC time of the latest fix
+
+        Returns
+        =======
+        clmb: 'float'
+            Climb rate in m/s (or None if there are not enough fixes)
+        """
+
+        points = self.get_track(
+            sonde_id=sonde_id,
+            start=timestamp - timedelta(seconds=self.track_config["max_clmb_age"]),
+            end=timestamp,
+        )
+        with_altitude = ~np.isnan(points["altitude"])
+        timestamps = points["timestamp"][with_altitude]
+        altitudes = points["altitude"][with_altitude]
+        if len(timestamps) < 2:
+            return None
+        earlier = np.nonzero(
+            timestamps <= timestamps[-1] - self.track_config["min_clmb_interval"]
+        )[0]
+        if not len(earlier):
+            return None
+        index = earlier[-1]
+        return round(
+            float(
+                (altitudes[-1] - altitudes[index])
+                / (timestamps[-1] - timestamps[index])
+            ),
+            1,
+        )
+
+    def flush(self):
+        with self._lock:
+            for track in self._tracks.values():
+                track.flush()
+
+
+def get_track_store():
+    """
+    Returns the track store. The store gets created on first use,
+    based on the 'track_store' config file section
+
+    Parameters
+    ==========
+
+    Returns
+    =======
+    track_store: 'TrackStore'
+        the track store (or None if it is disabled or
+        its directory cannot be created)
+    """
+
+    global track_store
+
+    with track_store_lock:
+        if track_store is None:
+            track_config = read_config_section(
+                section_name="track_store", defaults=track_store_defaults
+            )
+            if not track_config["enabled"]:
+                return None
+            try:
+                track_store = TrackStore(track_config=track_config)
+            except OSError:
+                logger.exception(msg="Cannot create the track store")
+                return None
+    return track_store
+
+
+def add_track_point(sonde_id: str, timestamp: datetime, **values):
+    """
+    Adds a telemetry point to the track store (if enabled). Errors
+    are logged but don't affect the caller
+
+    Parameters
+    ==========
+    sonde_id: 'str'
+        Radiosonde ID
+    timestamp: 'datetime'
+        UTC time of the point (or None / datetime.min if unknown)
+    values: 'float'
+        see TrackStore.add_point()
+
+    Returns
+    =======
+    """
+
+    if not timestamp or timestamp == datetime.min:
+        return
+    store = get_track_store()
+    if store is None:
+        return
+    try:
+        store.add_point(sonde_id, timestamp, **values)
+    except (OSError, ValueError):
+        logger.exception(msg=f"Cannot add track point for '{sonde_id}'")
+
+
+def get_derived_clmb(sonde_id: str, timestamp: datetime):
+    """
+    Derives a radiosonde's climb rate from the track store (if enabled)
+
+    Parameters
+    ==========
+    sonde_id: 'str'
+        Radiosonde ID
+    timestamp: 'datetime'
+        UTC time of the latest fix
+
+    Returns
+    =======
+    clmb: 'float'
+        Climb rate in m/s (or None)
+    """
+
+    if not timestamp or timestamp == datetime.min:
+        return None
+    store = get_track_store()
+    if store is None:
+        return None
+    try:
+        return store.get_derived_clmb(sonde_id=sonde_id, timestamp=timestamp)
+    except (OSError, ValueError):
+        logger.exception(msg=f"Cannot read the track of '{sonde_id}'")
+        return None
+
+
+if __name__ == "__main__":
+    store = TrackStore(track_config=dict(track_store_defaults, directory="/tmp"))
+    store.add_point("TEST1", datetime(2020, 10, 16, 12, 32), altitude=12000.0)
+    store.add_point("TEST1", datetime(2020, 10, 16, 12, 33), altitude=12300.0)
+    logger.info(store.get_track("TEST1"))
+    logger.info(store.get_derived_clmb("TEST1", datetime(2020, 10, 16, 12, 33)))
@@ -71,9 +71,7 @@ def read_program_config(config_file_name: str = "radiosonde.cfg"):
         try:
             config.read(config_file_name)
             aprsdotfi_cfg_key = config.get("radiosonde_config", "aprsdotfi_api_key")
-            telegram_token = config.get(
-                "radiosonde_config", "telegram_token"
-            )
+            telegram_token = config.get("radiosonde_config", "telegram_token")
             success = True
         except:
             success = False
@@ -83,5 +81,64 @@ def read_program_config(config_file_name: str = "radiosonde.cfg"):
         telegram_token,
     )
 
+
+def read_config_section(
+    section_name: str, defaults: dict, config_file_name: str = "radiosonde.cfg"
+):
+    """
+    Read an optional section from the configuration file. Every
+    setting that is not present in the config file (or whose value
+    cannot be converted) falls back to its default value
+
+    Parameters
+    ==========
+    section_name: 'str'
+        Name of the config file section, e.g. 'radiobot_config'
+    defaults: 'dict'
+        Setting names and their default values. The type of each
+        default value (bool, int, float, str) also determines the
+        type that the config file value gets converted to
+    config_file_name: 'str'
+        config file name
+
+    Returns
+    =======
+    settings: 'dict'
+        Setting names and their values
+    """
+
+    settings = dict(defaults)
+
+    config = configparser.ConfigParser()
+    if check_if_file_exists(config_file_name):
+        try:
+            config.read(config_file_name)
+        except:
+            logger.info(f"Cannot read config file {config_file_name}")
+            return settings
+
+    if not config.has_section(section_name):
+        return settings
+
+    for key, default_value in defaults.items():
+        if not config.has_option(section_name, key):
+            continue
+        try:
+            # bool needs to be checked first as it is a subclass of int
+            if isinstance(default_value, bool):
+                settings[key] = config.getboolean(section_name, key)
+            elif isinstance(default_value, int):
+                settings[key] = config.getint(section_name, key)
+            elif isinstance(default_value, float):
+                settings[key] = config.getfloat(section_name, key)
+            else:
+                settings[key] = config.get(section_name, key)
+        except ValueError:
+            logger.info(
+                f"Invalid value for '{key}' in section '{section_name}'; using default value '{default_value}'"
+            )
+    return settings
+
+
 if __name__ == "__main__":
-    logger.info(read_program_config())
\ No newline at end of file
+    logger.info(read_program_config())
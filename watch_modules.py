@@ -0,0 +1,436 @@
+#
+# Author: Joerg Schultze-Lutter, 2020
+#
+# Purpose: bookkeeping for the /watch command. Each watched radiosonde
+# gets polled once per interval, regardless of the number of chats that
+# have subscribed to it; the interval depends on the flight phase
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+import threading
+import time
+from datetime import datetime
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(module)s -%(levelname)s- %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Default settings for the optional 'watch_config' config file section
+# tick_interval: seconds between two checks for watches that are due
+# descent_interval / ascent_interval / unknown_interval: seconds between
+# two polls of a radiosonde, depending on its flight phase
+# landed_statuses: comma-separated radiosondy.info probe states which
+# end a watch (e.g. 'LANDED', 'FOUND'; case-insensitive exact matches)
+# landing_precision / position_precision: number of decimal places of
+# the predicted landing point / the current position; subscribers only
+# get a new message if one of the rounded values changes
+# max_watches_per_chat: max number of radiosondes per chat
+# max_watch_hours: watches end automatically after this many hours
+watch_config_defaults = {
+    "tick_interval": 5.0,
+    "descent_interval": 30.0,
+    "ascent_interval": 180.0,
+    "unknown_interval": 60.0,
+    "landed_statuses": "landed,found",
+    "landing_precision": 3,
+    "position_precision": 4,
+    "max_watches_per_chat": 5,
+    "max_watch_hours": 12.0,
+}
+
+# Flight phases of a watched radiosonde
+flight_phase_ascent = "ascent"
+flight_phase_descent = "descent"
+flight_phase_unknown = "unknown"
+flight_phase_landed = "landed"
+
+
+def get_flight_phase(probe_status: str, clmb: float, landed_statuses: str):
+    """
+    Determines the flight phase of a radiosonde
+
+    Parameters
+    ==========
+    probe_status: 'str'
+        radiosondy.info probe status (or None)
+    clmb: 'float'
+        climb rate in m/s (or None)
+    landed_statuses: 'str'
+        comma-separated probe states which indicate a landed sonde;
+        the probe status has to match one of them (ignoring case)
+
+    Returns
+    =======
+    flight_phase: 'str'
+        ascent, descent, landed or unknown
+    """
+
+    # exact matches only; e.g. 'not found' is no 'found'
+    if probe_status and probe_status.strip().lower() in {
+        landed_status.strip()
+        for landed_status in landed_statuses.lower().split(",")
+        if landed_status.strip()
+    }:
+        return flight_phase_landed
+    if clmb is None or clmb == 0:
+        return flight_phase_unknown
+    return flight_phase_ascent if clmb > 0 else flight_phase_descent
+
+
+def get_watch_fingerprint(
+    watch_config: dict,
+    prediction_success: bool,
+    landing_latitude: float,
+    landing_longitude: float,
+    landing_timestamp: datetime,
+    latitude: float,
+    longitude: float,
+    probe_status: str,
+):
+    """
+    Condenses the landing prediction and the position of a radiosonde
+    into a comparable value
+
+    Parameters
+    ==========
+    watch_config: 'dict'
+        'watch_config' settings
+    prediction_success: 'bool'
+        True if habhub provided a landing prediction
+    landing_latitude / landing_longitude: 'float'
+        predicted landing point
+    landing_timestamp: 'datetime'
+        predicted landing time
+    latitude / longitude: 'float'
+        current position (or None)
+    probe_status: 'str'
+        radiosondy.info probe status (or None)
+
+    Returns
+    =======
+    fingerprint: 'tuple'
+        rounded landing prediction and position
+    """
+
+    landing_precision = watch_config["landing_precision"]
+    position_precision = watch_config["position_precision"]
+
+    prediction = None
+    if prediction_success:
+        prediction = (
+            round(landing_latitude, landing_precision),
+            round(landing_longitude, landing_precision),
+            landing_timestamp.strftime("%Y%m%d%H%M"),
+        )
+    position = None
+    if latitude is not None and longitude is not None:
+        position = (
+            round(latitude, position_precision),
+            round(longitude, position_precision),
+        )
+    return prediction, position, probe_status
+
+
+def merge_watch_fingerprints(previous_fingerprint: tuple, fingerprint: tuple):
+    """
+    Merges a new fingerprint into the previous one. Parts of the new
+    fingerprint that are missing (e.g. because an upstream site did not
+    respond) keep their previous value, so they don't count as a change
+
+    Parameters
+    ==========
+    previous_fingerprint: 'tuple'
+        fingerprint that the subscribers have seen so far (or None)
+    fingerprint: 'tuple'
+        see get_watch_fingerprint()
+
+    Returns
+    =======
+    fingerprint: 'tuple'
+        merged fingerprint
+    """
+
+    if previous_fingerprint is None:
+        return fingerprint
+    return tuple(
+        previous if current is None else current
+        for previous, current in zip(previous_fingerprint, fingerprint)
+    )
+
+
+class SondeWatch:
+    """
+    A watched radiosonde and the chats that have subscribed to it
+    """
+
+    def __init__(self, sonde_id: str, now: float):
+        self.sonde_id = sonde_id
+        self.chat_ids = set()
+        self.created = now
+        self.next_poll = now
+        self.polling = False
+        self.flight_phase = flight_phase_unknown
+        self.fingerprint = None
+        self.last_text = None
+
+
+class WatchRegistry:
+    """
+    Thread-safe registry of all watched radiosondes. A radiosonde that
+    is watched by several chats is only polled once per interval.
+    """
+
+    def __init__(self, watch_config: dict):
+        """
+        Parameters
+        ==========
+        watch_config: 'dict'
+            'watch_config' settings
+        """
+        self.watch_config = watch_config
+        self._watches = {}
+        self._lock = threading.Lock()
+
+    def get_poll_interval(self, flight_phase: str):
+        return self.watch_config[f"{flight_phase}_interval"]
+
+    def watch(self, chat_id: int, sonde_id: str):
+        """
+        Subscribes a chat to a radiosonde
+
+        Parameters
+        ==========
+        chat_id: 'int'
+            Telegram chat ID
+        sonde_id: 'str'
+            Radiosonde ID (upper case)
+
+        Returns
+        =======
+        status: 'str'
+            'added', 'already_watching' or 'limit_reached'
+        last_text: 'str'
+            most recent message for this radiosonde (if another
+            chat is already watching it), otherwise None
+        """
+
+        with self._lock:
+            watch = self._watches.get(sonde_id)
+            if watch and chat_id in watch.chat_ids:
+                return "already_watching", None
+            watched_sondes = sum(
+                1 for other in self._watches.values() if chat_id in other.chat_ids
+            )
+            if watched_sondes >= self.watch_config["max_watches_per_chat"]:
+                return "limit_reached", None
+            if not watch:
+                watch = SondeWatch(sonde_id=sonde_id, now=time.monotonic())
+                self._watches[sonde_id] = watch
+            watch.chat_ids.add(chat_id)
+            return "added", watch.last_text
+
+    def unwatch(self, chat_id: int, sonde_id: str = None):
+        """
+        Unsubscribes a chat from a radiosonde (or from all radiosondes)
+
+        Parameters
+        ==========
+        chat_id: 'int'
+            Telegram chat ID
+        sonde_id: 'str'
+            Radiosonde ID (upper case). If not set, the chat gets
+            unsubscribed from all radiosondes
+
+        Returns
+        =======
+        sonde_ids: 'list'
+            radiosondes that the chat has been unsubscribed from
+        """
+
+        unwatched = []
+        with self._lock:
+            for watch in list(self._watches.values()):
+                if sonde_id and watch.sonde_id != sonde_id:
+                    continue
+                if chat_id in watch.chat_ids:
+                    watch.chat_ids.discard(chat_id)
+                    unwatched.append(watch.sonde_id)
+                if not watch.chat_ids:
+                    del self._watches[watch.sonde_id]
+        return unwatched
+
+    def get_watched_sondes(self, chat_id: int):
+        """
+        Returns the radiosondes that a chat has subscribed to
+
+        Parameters
+        ==========
+        chat_id: 'int'
+            Telegram chat ID
+
+        Returns
+        =======
+        sonde_ids: 'list'
+            Radiosonde IDs and their flight phases as (id, phase) tuples
+        """
+
+        with self._lock:
+            return sorted(
+                (watch.sonde_id, watch.flight_phase)
+                for watch in self._watches.values()
+                if chat_id in watch.chat_ids
+            )
+
+    def remove_expired_watches(self):
+        """
+        Removes all watches that have exceeded their max. duration
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        expired_watches: 'list'
+            (sonde_id, chat_ids) tuples of the removed watches
+        """
+
+        max_age = self.watch_config["max_watch_hours"] * 3600
+        now = time.monotonic()
+        expired_watches = []
+        with self._lock:
+            for watch in list(self._watches.values()):
+                if now - watch.created > max_age and not watch.polling:
+                    del self._watches[watch.sonde_id]
+                    expired_watches.append((watch.sonde_id, sorted(watch.chat_ids)))
+        return expired_watches
+
+    def get_due_sondes(self):
+        """
+        Returns the radiosondes that are due for polling and
+        marks them as 'polling' until complete_poll() gets called
+
+        Parameters
+        ==========
+
+        Returns
+        =======
+        sonde_ids: 'list'
+            Radiosonde IDs that need to be polled now
+        """
+
+        now = time.monotonic()
+        due_sondes = []
+        with self._lock:
+            for watch in self._watches.values():
+                if not watch.polling and watch.next_poll <= now:
+                    watch.polling = True
+                    due_sondes.append(watch.sonde_id)
+        return due_sondes
+
+    def has_changed(self, sonde_id: str, fingerprint: tuple):
+        """
+        Checks if a poll result differs from what the subscribers
+        of a radiosonde have seen so far
+
+        Parameters
+        ==========
+        sonde_id: 'str'
+            Radiosonde ID (upper case)
+        fingerprint: 'tuple'
+            see get_watch_fingerprint()
+
+        Returns
+        =======
+        changed: 'bool'
+            True if the subscribers need to get a new message
+        """
+
+        with self._lock:
+            watch = self._watches.get(sonde_id)
+            if not watch:
+                return False
+            return (
+                merge_watch_fingerprints(watch.fingerprint, fingerprint)
+                != watch.fingerprint
+            )
+
+    def complete_poll(
+        self,
+        sonde_id: str,
+        fingerprint: tuple = None,
+        flight_phase: str = flight_phase_unknown,
+        text: str = None,
+    ):
+        """
+        Stores the result of a radiosonde poll and schedules the next one.
+        Landed radiosondes are no longer watched.
+
+        Parameters
+        ==========
+        sonde_id: 'str'
+            Radiosonde ID (upper case)
+        fingerprint: 'tuple'
+            see get_watch_fingerprint(). None if the poll has failed
+        flight_phase: 'str'
+            flight phase of the radiosonde
+        text: 'str'
+            rendered message; only required if the fingerprint has changed.
+            If it is missing, the change is not stored and gets reported
+            by the next poll
+
+        Returns
+        =======
+        changed: 'bool'
+            True if the subscribers need to get the new message
+        finished: 'bool'
+            True if the watch has ended because the radiosonde has landed
+        chat_ids: 'list'
+            subscribers of this radiosonde
+        """
+
+        with self._lock:
+            watch = self._watches.get(sonde_id)
+            if not watch:
+                # all subscribers are gone
+                return False, False, []
+            watch.polling = False
+            chat_ids = sorted(watch.chat_ids)
+
+            if fingerprint is not None:
+                fingerprint = merge_watch_fingerprints(watch.fingerprint, fingerprint)
+            # Without a rendered message (the watch was created while the
+            # poll was running), the change is picked up by the next poll
+            changed = (
+                fingerprint is not None
+                and text is not None
+                and fingerprint != watch.fingerprint
+            )
+            if changed:
+                watch.fingerprint = fingerprint
+                watch.last_text = text
+
+            if fingerprint is not None:
+                watch.flight_phase = flight_phase
+            if watch.flight_phase == flight_phase_landed:
+                del self._watches[sonde_id]
+                return changed, True, chat_ids
+
+            watch.next_poll = time.monotonic() + self.get_poll_interval(
+                watch.flight_phase
+            )
+            return changed, False, chat_ids